@@ -0,0 +1,248 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+######################################################################################
+#
+#    Writers of the archives of the modules (IMSCC zip and EDX tar.gz), whose files
+#    are given from memory. Compression is done by zlib, which releases the GIL, so
+#    with more than one worker the entries of a zip, or the blocks of a tar.gz, are
+#    compressed concurrently by a pool of threads, and written in order as soon as
+#    they are ready.
+#
+######################################################################################
+
+import contextlib
+import gzip
+import io
+import logging
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import deque
+from io import open
+from multiprocessing.pool import ThreadPool
+
+COMPRESS_LEVEL = 6 # zlib compression level of the zip archives, from 0 (none) to 9 (best), as used by zipfile
+TAR_GZ_COMPRESS_LEVEL = 9 # compression level of the tar.gz archives, as used by tarfile
+GZIP_BLOCK_SIZE = 128*1024 # size of the data compressed as one gzip member by ParallelGzipFile
+SPOOL_MAX_SIZE = 1024*1024 # data kept in memory by spoolChunks(), beyond which they go to a temporary file
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0) # date of the zip entries when SOURCE_DATE_EPOCH is not set, the earliest a zip archive can hold
+
+
+def sourceDateEpoch():
+    """ returns the timestamp given to the files of the archives by the SOURCE_DATE_EPOCH environment variable (see reproducible-builds.org), None if it is not set.
+        Archives are dated from it, or from a fixed date, so that building the same sources again gives the same archives, byte for byte """
+    value = os.environ.get('SOURCE_DATE_EPOCH')
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning("[archives] ignoring invalid SOURCE_DATE_EPOCH %r", value)
+        return None
+
+
+def zipDateTime():
+    """ returns the date of the entries of the zip archives (see sourceDateEpoch()), ZIP_EPOCH by default """
+    epoch = sourceDateEpoch()
+    if epoch is None:
+        return ZIP_EPOCH
+    return max(ZIP_EPOCH, time.gmtime(epoch)[:6])
+
+
+def tarMtime():
+    """ returns the modification time of the files of the tar.gz archives, and of the archives themselves in their gzip header (see sourceDateEpoch()), 0 by default """
+    epoch = sourceDateEpoch()
+    return 0 if epoch is None else epoch
+
+
+def deflate(data, level):
+    """ returns the raw deflated bytes of 'data', with its size and CRC-32, as stored in zip archives """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data)+compressor.flush(), len(data), zlib.crc32(data)
+
+
+def gzipMember(data, level):
+    """ returns 'data' compressed as a complete gzip member (header, deflated data and trailer) """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16+15)
+    return compressor.compress(data)+compressor.flush()
+
+
+class OrderedPool(object):
+    """ Pool of 'workers' threads whose results are given back in the order of the tasks, at most 2*'workers' tasks being pending at a time.
+        With a single worker, tasks are run when they are submitted """
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = ThreadPool(workers) if workers > 1 else None
+        self.pending = deque()
+
+    def submit(self, func, args):
+        """ runs func(*args) and returns the results of the first tasks submitted that are over, in order """
+        if self.pool is None:
+            return [func(*args)]
+        self.pending.append(self.pool.apply_async(func, args))
+        done = []
+        while self.pending and (len(self.pending) > 2*self.workers or self.pending[0].ready()):
+            done.append(self.pending.popleft().get())
+        return done
+
+    def drain(self):
+        """ waits for the pending tasks, and returns their results in order """
+        done = [result.get() for result in self.pending]
+        self.pending.clear()
+        return done
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class DeflatedZipFile(zipfile.ZipFile):
+    """ Zip archive written from memory, whose entries are deflated with the zlib compression level 'level'
+        (python 2 zipfile always uses the default one), by 'workers' threads. All entries have the same date, given by zipDateTime().
+
+    :param file: path or binary file object of the archive, opened for writing
+    :param level: compression level, from 0 to 9 (None for COMPRESS_LEVEL)
+    :param workers: number of threads compressing the entries (default 1, no threads)
+    """
+    def __init__(self, file, level=None, workers=1):
+        zipfile.ZipFile.__init__(self, file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.level = COMPRESS_LEVEL if level is None else level
+        self.date_time = zipDateTime()
+        self.compressors = OrderedPool(workers)
+        self.names = deque() # names of the entries being compressed, in order
+
+    def writestr(self, arcname, data):
+        """ add the bytes 'data' as the file 'arcname' of the archive, written once compressed """
+        self.names.append(arcname)
+        for deflated in self.compressors.submit(deflate, (data, self.level)):
+            self.writeDeflated(self.names.popleft(), *deflated)
+
+    def writeDeflated(self, arcname, deflated, size, crc):
+        """ add the file 'arcname' given by its raw deflated data, with the size and the CRC-32 of the original data """
+        zinfo = zipfile.ZipInfo(arcname, self.date_time)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0o644 << 16
+        zinfo.file_size = size
+        zinfo.compress_size = len(deflated)
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.header_offset = self.fp.tell()
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader(max(size, zinfo.compress_size) > zipfile.ZIP64_LIMIT))
+        self.fp.write(deflated)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+    def close(self):
+        """ write the entries still being compressed, then the central directory """
+        try:
+            if self.fp is not None:
+                for deflated in self.compressors.drain():
+                    self.writeDeflated(self.names.popleft(), *deflated)
+        finally:
+            self.compressors.close()
+        zipfile.ZipFile.close(self)
+
+
+class ParallelGzipFile(object):
+    """ Binary file object compressing what is written to it in gzip format, like pigz: data are cut into blocks of 'block_size' bytes, compressed
+        by 'workers' threads as independent gzip members, concatenated in order in the file 'path'. gzip and tar read them as a single stream.
+
+    :param path: path of the gzip file
+    :param level: compression level, from 0 to 9 (None for COMPRESS_LEVEL)
+    :param workers: number of threads compressing the blocks
+    """
+    def __init__(self, path, level=None, workers=1, block_size=GZIP_BLOCK_SIZE):
+        self.fileobj = open(path, 'wb')
+        self.level = COMPRESS_LEVEL if level is None else level
+        self.block_size = block_size
+        self.compressors = OrderedPool(workers)
+        self.buffer = []
+        self.buffered = 0
+        self.offset = 0 # uncompressed data written
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.offset += len(data)
+        if self.buffered >= self.block_size:
+            data = b''.join(self.buffer)
+            end = len(data) - len(data) % self.block_size
+            for start in range(0, end, self.block_size):
+                self.writeMembers(self.compressors.submit(gzipMember, (data[start:start+self.block_size], self.level)))
+            self.buffer = [data[end:]]
+            self.buffered = len(data) - end
+
+    def writeMembers(self, members):
+        for member in members:
+            self.fileobj.write(member)
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        """ compress the last block, wait for all the blocks and close the file """
+        if self.fileobj.closed:
+            return
+        try:
+            if self.buffered or not self.offset: # an empty file is still one gzip member
+                self.writeMembers(self.compressors.submit(gzipMember, (b''.join(self.buffer), self.level)))
+            self.writeMembers(self.compressors.drain())
+        finally:
+            self.compressors.close()
+            self.fileobj.close()
+
+
+def spoolChunks(chunks):
+    """ returns a binary file object holding the bytes of the iterable 'chunks' (such as a rendered template, see templateRegistry.streamTemplate()),
+        rewound, kept in memory up to SPOOL_MAX_SIZE and in a temporary file beyond """
+    spool = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+    for chunk in chunks:
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+def addTarMember(tar, name, data, mtime=None):
+    """ add 'data' as the regular file 'name' of the archive 'tar' (tarfile.TarFile opened for writing), modified at 'mtime' (default tarMtime())
+
+    :param data: bytes, or binary file object read from its current position to its end (see spoolChunks())
+    """
+    if isinstance(data, bytes):
+        data = io.BytesIO(data)
+    start = data.tell()
+    data.seek(0, io.SEEK_END)
+    info = tarfile.TarInfo(name)
+    info.size = data.tell() - start
+    info.mode = 0o644
+    info.mtime = tarMtime() if mtime is None else mtime
+    data.seek(start)
+    tar.addfile(info, data)
+
+
+@contextlib.contextmanager
+def openTarGz(path, level=None, workers=1):
+    """ context manager giving a tarfile.TarFile writing the tar.gz archive 'path', compressed by a ParallelGzipFile with more than one worker,
+        else by a gzip.GzipFile dated from tarMtime(). The archive is complete once the context is left, e.g::
+
+            with openTarGz('module1_edx.tar.gz', workers=4) as tar:
+                addTarMember(tar, 'EDX/course.xml', course_xml)
+
+    :param level: compression level, from 0 to 9 (None for TAR_GZ_COMPRESS_LEVEL)
+    :param workers: number of threads compressing the archive
+    """
+    level = TAR_GZ_COMPRESS_LEVEL if level is None else level
+    if workers <= 1:
+        gz_file = gzip.GzipFile(path, 'wb', level, mtime=tarMtime())
+    else:
+        gz_file = ParallelGzipFile(path, level, workers)
+    try:
+        with tarfile.open(mode='w', fileobj=gz_file) as tar:
+            yield tar
+    finally:
+        gz_file.close()
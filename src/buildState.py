@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+######################################################################################
+#
+#    Build state of a module between two exports. Each subsection is stored with a
+#    hash of its content and the outputs rendered from it (HTML, GIFT code, IMS QTI
+#    test, EDX problems), so that a subsection that did not change since the last
+#    build is not rendered again: its outputs are taken back from the state file, and
+#    the questions of an unchanged activity are not even processed.
+#
+######################################################################################
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from io import open
+
+import model
+import utils
+
+STATE_SUFFIX = '.build.json'
+# version of the layout of the fragments, a state file of another version is ignored
+STATE_VERSION = '2'
+
+
+class BuildState:
+    """ Outputs of the subsections of one module, kept in the file 'cache_dir'/<hash of module_dir>.build.json
+
+    :param cache_dir: path of the cache directory (created if needed)
+    :type cache_dir: string
+
+    :param module_dir: path of the module source directory
+    :type module_dir: string
+
+    :param questions_index: index the questions of the rendered activities are processed through (see fromGIFT.QuestionsIndex)
+    :type questions_index: fromGIFT.QuestionsIndex
+    """
+    def __init__(self, cache_dir, module_dir, questions_index=None):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        name = hashlib.sha1(os.path.abspath(module_dir).encode('utf-8')).hexdigest()
+        self.path = os.path.join(cache_dir, name+STATE_SUFFIX)
+        self.questions_index = questions_index
+        self.previous = self.load()
+        self.current = {}
+        self.reused = 0
+        self.rendered = 0
+
+    def load(self):
+        """ returns the subsections stored by the previous build, an empty dict if there are none """
+        try:
+            with open(self.path, encoding='utf-8') as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            logging.warning("[buildState] ignoring unreadable build state %s", self.path)
+            return {}
+        if state.get('parser_version') != model.PARSER_VERSION or state.get('state_version') != STATE_VERSION:
+            return {}
+        return state.get('subsections', {})
+
+    def save(self):
+        """ write the subsections of the current build, under a temporary name renamed afterwards """
+        state = {'parser_version': model.PARSER_VERSION, 'state_version': STATE_VERSION, 'subsections': self.current}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as state_file:
+                state_file.write(json.dumps(state, sort_keys=True).encode('utf-8'))
+            os.rename(tmp_path, self.path)
+        except Exception:
+            logging.exception("[buildState] cannot save build state %s", self.path)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        logging.info("[buildState] %d subsections reused, %d rendered", self.reused, self.rendered)
+        return True
+
+    def getHash(self, sub, feedback_option):
+        """ returns the hash of everything the outputs of subsection 'sub' depend on, including the module and the base url its media links are made absolute with """
+        h = hashlib.sha1()
+        for part in (model.PARSER_VERSION, sub.section.module, sub.section.base_url, sub.__class__.__name__, sub.num, sub.title, str(feedback_option), sub.src):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def toHTML(self, sub, feedback_option=False):
+        """ Assign the html_src attribute of subsection 'sub', from the previous build if its content did not change, else through sub.toHTML()
+        (the questions of an activity being processed through the questions index first)
+
+        :rtype: True if the previous output has been reused
+        """
+        digest = self.getHash(sub, feedback_option)
+        fragment = self.previous.get(sub.num)
+        if fragment and fragment['hash'] == digest:
+            sub.html_src = fragment['html_src']
+            self.current[sub.num] = fragment
+            self.reused += 1
+            return True
+        if isinstance(sub, model.AnyActivity):
+            sub.loadQuestions(self.questions_index)
+        sub.toHTML(feedback_option)
+        self.current[sub.num] = {'hash': digest, 'html_src': sub.html_src}
+        self.rendered += 1
+        return False
+
+    def getFragment(self, sub):
+        # subsections not seen by toHTML() are not recorded
+        return self.current.get(sub.num, {})
+
+    def getOutput(self, sub, key, render):
+        """ returns the output 'key' of activity 'sub', rendered with render() only if it is not in the build state yet, e.g. when the
+        previous build did not export this target. The questions of 'sub' are then processed through the questions index """
+        fragment = self.getFragment(sub)
+        if key not in fragment:
+            sub.loadQuestions(self.questions_index)
+            fragment[key] = render()
+        return fragment[key]
+
+    def toGift(self, sub):
+        """ returns the GIFT code of the questions of activity 'sub' (see AnyActivity.writeGift()) """
+        def render():
+            buf = utils.StringBuffer()
+            sub.writeGift(buf)
+            return buf.getvalue()
+        return self.getOutput(sub, 'gift', render)
+
+    def toXMLMoodle(self, sub):
+        """ returns the IMS QTI test of activity 'sub' (see AnyActivity.toXMLMoodle()) """
+        return self.getOutput(sub, 'qti', sub.toXMLMoodle)
+
+    def toEdxProblems(self, sub, render):
+        """ returns the EDX problems of activity 'sub' as a list of [id, xml] in the order of its questions, each rendered with render(question) """
+        return self.getOutput(sub, 'edx', lambda: [[str(question.id), render(question)] for question in sub.questions])
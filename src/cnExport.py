@@ -1,6 +1,7 @@
 #!cnappenv/bin/python
 # -*- coding: utf-8 -*-
 import argparse
+import codecs
 import json
 import os
 import sys
@@ -11,23 +12,35 @@ import tarfile
 
 from lxml import etree
 from lxml import html
-import markdown
 from yattag import indent
 from yattag import Doc
 from lxml.html.clean import Cleaner
 from io import open
-from jinja2 import Template, Environment, FileSystemLoader
 
 import utils
+import archives
 import toIMS
 import toEDX
 import model
+import fromGIFT
+import parseCache
+import buildState
+import videoProviders
+import templateRegistry
 
 
-MARKDOWN_EXT = ['markdown.extensions.extra', 'superscript']
 BASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 TEMPLATES_PATH = os.path.join(BASE_PATH, 'templates' )
+CACHE_PATH = os.path.join(BASE_PATH, 'cache')
 LOGFILE = 'logs/cnExport.log'
+QUESTIONS_BANK_FILE = 'questions_bank.gift.txt' # course-wide bank of distinct questions (target 'bank')
+TARGETS = ['site', 'json', 'gift', 'videos', 'ims', 'edx', 'bank']
+DEFAULT_TARGETS = ['site', 'json', 'gift', 'videos']
+HTML_TARGETS = ['site', 'json', 'ims', 'edx'] # targets needing the html of subsections
+QUESTIONS_TARGETS = HTML_TARGETS + ['gift', 'bank'] # targets needing the questions of activities
+# targets written one section at a time (see streamModule()). The others need the whole module: the EDX course.xml, the IMS manifest and
+# the pages of the site list all its sections, and the site is only built once all modules are processed
+STREAM_TARGETS = ['gift', 'videos', 'bank']
 
 def writeHtml(module, outModuleDir, html):
     module_file_name = os.path.join(outModuleDir, module)+'.html'
@@ -36,34 +49,119 @@ def writeHtml(module, outModuleDir, html):
     moduleHtml.close()
 
 
-def processModule(args, repoDir, outDir, module):
-    """ given input paramaters, process a module  """
+def loadModule(args, repoDir, module, parse=True):
+    """ Fetch and parse the md file of a module, unless the cache has it already (with the questions stored by storeQuestions()).
+    Returns the module object, or None if 'parse' is False and the cache does not have it """
+    filein = utils.fetchMarkdownFile(os.path.join(repoDir, module))
+    m = None
+    if args.cacheDir:
+        cache = parseCache.ParseCache(args.cacheDir)
+        cache_key = cache.getKey(filein, module, args.baseUrl)
+        m = cache.load(cache_key)
+    if m is None and parse:
+        with model.openSource(filein) as md_file:
+            m = model.Module(md_file, module, args.baseUrl)
+        if args.cacheDir:
+            cache.store(cache_key, m)
+    return m
+
+
+def storeQuestions(args, repoDir, module, m):
+    """ store the questions processed for the module object 'm' in the cache, next to the module (see loadModule()) """
+    cache = parseCache.ParseCache(args.cacheDir)
+    cache.storeQuestions(cache.getKey(utils.fetchMarkdownFile(os.path.join(repoDir, module)), module, args.baseUrl), m)
+
+
+def resolveVideos(args, modules):
+    """ Fetch the metadata of the videos of all modules at once, and set their thumbnails """
+    if args.cacheDir:
+        cache_path = os.path.join(args.cacheDir, 'videos.json')
+    else:
+        cache_path = None
+    resolver = videoProviders.VideoMetadataResolver(cache_path, offline=(args.videoMetadata == 'offline'))
+    videos = [video for m in modules for sec in m.sections for sub in sec.subsections for video in sub.videos]
+    metadata = resolver.resolveAll([video['video_link'] for video in videos])
+    for video in videos:
+        data = metadata.get(video['video_link'])
+        if data and data.get('thumbnail'):
+            video['video_thumbnail'] = data['thumbnail']
+
+
+def streamModule(args, repoDir, outDir, module, questions_index=None):
+    """ process a module for targets written one section at a time (STREAM_TARGETS). Unless the parse cache has the module already, its sections are parsed
+    with model.Module.iterSections() while being processed, so that only one of them is in memory at a time. Returns the module object, without its sections in this case """
+    m = loadModule(args, repoDir, module, parse=False)
+    if m is not None:
+        return processModule(args, repoDir, outDir, module, m, questions_index)
+    m = model.Module(None, module, args.baseUrl)
+    with model.openSource(utils.fetchMarkdownFile(os.path.join(repoDir, module))) as md_file:
+        return processModule(args, repoDir, outDir, module, m, questions_index, m.iterSections(md_file))
+
+
+def processModule(args, repoDir, outDir, module, m, questions_index=None, sections=None):
+    """ given input paramaters and the module object 'm' (see loadModule()), process a module. If given, questions_index (see fromGIFT.QuestionsIndex)
+    provides the questions already processed for other modules of the build, and 'sections' the sections to process, parsed one at a time (default m.sections) """
 
     moduleDir = os.path.join(repoDir, module)
     moduleOutDir = os.path.join(outDir,module)
     utils.copyMediaDir(repoDir, moduleOutDir, module)
 
-    # Fetch and parse md file
-    filein = utils.fetchMarkdownFile(moduleDir)
-    with open(filein, encoding='utf-8') as md_file:
-        m = model.Module(md_file, module, args.baseUrl)
-
-    m.toHTML(args.feedback) # only generate html for all subsections
-
-    # write html, XML, and JSon files
-    utils.write_file(m.toGift(), moduleOutDir, '', module+'.questions_bank.gift.txt')
-    utils.write_file(m.toVideoList(), moduleOutDir, '', module+'.video_iframe_list.txt')
-    mod_config = utils.write_file(m.toJson(), moduleOutDir, '',  module+'.config.json') # FIXME : this file should be optionnaly written
+    # only the requested targets are computed
+    render_html = any(target in HTML_TARGETS for target in args.targets)
+    # outputs of the subsections that did not change since the last build are taken back from the build state
+    # and the questions of the unchanged activities are not processed at all
+    state = buildState.BuildState(args.cacheDir, moduleDir, questions_index) if args.cacheDir and render_html else None
+
+    load_questions = not state and questions_index is not None and any(target in QUESTIONS_TARGETS for target in args.targets)
+    # number of activities whose questions came from the parse cache
+    loaded_questions = len(m.getLoadedQuestions())
+
+    if not os.path.isdir(moduleOutDir):
+        os.makedirs(moduleOutDir)
+    writers = []
+    if 'gift' in args.targets:
+        writers.append((lambda fp, sections: m.writeGift(fp, sections, state), codecs.open(os.path.join(moduleOutDir, module+'.questions_bank.gift.txt'), 'w', encoding='utf-8')))
+    if 'videos' in args.targets:
+        writers.append((m.writeVideoList, codecs.open(os.path.join(moduleOutDir, module+'.video_iframe_list.txt'), 'w', encoding='utf-8')))
+    try:
+        for section in (m.sections if sections is None else sections):
+            if load_questions:
+                m.loadQuestions(questions_index, [section])
+            if render_html and state:
+                for sub in section.subsections:
+                    state.toHTML(sub, args.feedback)
+            elif render_html:
+                section.toHTML(args.feedback) # only generate html for all subsections
+            # write GIFT and video list section by section
+            for write, fp in writers:
+                write(fp, [section])
+    finally:
+        for write, fp in writers:
+            fp.close()
+
+    # questions processed for a module held whole are cached with it, for the next builds
+    if args.cacheDir and sections is None and len(m.getLoadedQuestions()) > loaded_questions:
+        storeQuestions(args, repoDir, module, m)
+
+    # write JSon file
+    if 'json' in args.targets:
+        mod_config = utils.write_file(m.toJson(), moduleOutDir, '',  module+'.config.json')
+        # write offset index of the source file, allowing to parse a single section or subsection again (see model.Module.readSection())
+        with codecs.open(os.path.join(moduleOutDir, module+'.index.json'), 'w', encoding='utf-8') as index_file:
+            m.writeIndex(index_file)
 
     # EDX files
-    if args.edx:
-        m.edx_archive_path = toEDX.generateEDXArchive(m, moduleOutDir)
+    if 'edx' in args.targets:
+        m.edx_archive_path = toEDX.generateEDXArchive(m, moduleOutDir, state, args.compressLevel, args.compressJobs, args.edxTree)
 
     # if chosen, generate IMS archive
-    if args.ims:
-        m.ims_archive_path = toIMS.generateImsArchive(m, module, moduleOutDir)
+    if 'ims' in args.targets:
+        m.ims_archive_path = toIMS.generateImsArchive(m, module, moduleOutDir, state, args.compressLevel, args.compressJobs)
         logging.warn('*Path to IMS = %s*' % m.ims_archive_path)
 
+    if state:
+        state.save()
+
     # return module object
     return m
 
@@ -76,19 +174,38 @@ def processRepository(args, repoDir, outDir):
         listt = glob.glob("module[0-9]")
         args.modules = sorted(listt,key=lambda a: a.lstrip('module'))
 
-    for module in args.modules:
-        logging.info("\nStart Processing %s", module)
-        course_obj.modules.append(processModule(args, repoDir, outDir, module))
+    # questions found in several activities or modules are processed and rendered once for the whole course
+    index = fromGIFT.QuestionsIndex()
+    if all(target in STREAM_TARGETS for target in args.targets):
+        # modules are processed section by section, none of them being held whole in memory
+        for module in args.modules:
+            logging.info("\nStart Processing %s", module)
+            course_obj.modules.append(streamModule(args, repoDir, outDir, module, index))
+    else:
+        modules = [loadModule(args, repoDir, module) for module in args.modules]
+        if args.videoMetadata != 'none':
+            resolveVideos(args, modules)
+        for module, m in zip(args.modules, modules):
+            logging.info("\nStart Processing %s", module)
+            course_obj.modules.append(processModule(args, repoDir, outDir, module, m, index))
+    if 'bank' in args.targets:
+        writeQuestionsBank(course_obj.modules, index, outDir)
+    logging.info("questions index: %(questions)d distinct questions, %(duplicates)d duplicates" % index.stats())
 
     return course_obj
 
 
+def writeQuestionsBank(modules, index, outDir):
+    """ write the GIFT code of the distinct questions of all 'modules' (see fromGIFT.QuestionsIndex) in the file QUESTIONS_BANK_FILE of 'outDir' """
+    for m in modules:
+        m.loadQuestions(index)
+    with codecs.open(os.path.join(outDir, QUESTIONS_BANK_FILE), 'w', encoding='utf-8') as bank_file:
+        index.writeGift(bank_file)
+
+
 def buildSite(course_obj, repoDir, outDir):
     """ Generate full site from result of parsing repository """
 
-    jenv = Environment(loader=FileSystemLoader(TEMPLATES_PATH))
-    jenv.filters['slugify'] = utils.cnslugify
-    site_template = jenv.get_template("site_layout.html")
     #if found, copy logo.png, else use default
     logo_files = glob.glob(os.path.join(repoDir, 'logo.*'))
     if len(logo_files) > 0:
@@ -117,7 +234,7 @@ def buildSite(course_obj, repoDir, outDir):
         home_file = os.path.join(repoDir, 'home.md')
         with open(home_file, 'r', encoding='utf-8') as f:
             home_data = f.read()
-        home_html = markdown.markdown(home_data, MARKDOWN_EXT)
+        home_html = utils.render_markdown(home_data)
         custom_home = True
     except Exception as err:
         ## use default from template
@@ -125,15 +242,13 @@ def buildSite(course_obj, repoDir, outDir):
         with open(os.path.join(TEMPLATES_PATH, 'default_home.html'), 'r', encoding='utf-8') as f:
             home_html = f.read()
     ## write index.html file
-    html = site_template.render(course=course_obj, module_content=home_html,body_class="home", logo=logo, custom_home=custom_home)
-    utils.write_file(html, os.getcwd(), outDir, 'index.html')
+    templateRegistry.renderToFile("site_layout.html", os.path.join(outDir, 'index.html'),
+                                  course=course_obj, module_content=home_html, body_class="home", logo=logo, custom_home=custom_home)
 
-    # Loop through modules
+    # Loop through modules, whose pages are streamed to their file (site_layout.html includes module.html)
     for module in course_obj.modules:
-        module_template = jenv.get_template("module.html")
-        module_html_content = module_template.render(module=module)
-        html = site_template.render(course=course_obj, module_content=module_html_content, body_class="modules", logo=logo)
-        utils.write_file(html, os.getcwd(), outDir, module.module+'.html')
+        templateRegistry.renderToFile("site_layout.html", os.path.join(outDir, module.module+'.html'),
+                                      course=course_obj, module=module, body_class="modules", logo=logo)
 
 
 ############### main ################
@@ -156,7 +271,27 @@ if __name__ == "__main__":
     parser.add_argument("-f", "--feedback", action='store_true', help="Add feedbacks for all questions in web export", default=False)
     parser.add_argument("-i", "--ims", action='store_true', help="Also generate IMS archive for each module", default=False)
     parser.add_argument("-e", "--edx", action='store_true', help="Also generate EDX archive for each module", default=False)
+    parser.add_argument("--edx-tree", dest="edxTree", action='store_true', help="Also write the files of the EDX archive in moduleX/EDX, for debugging", default=False)
+    parser.add_argument("-t", "--targets", nargs='+', choices=TARGETS, help="Only generate these outputs (default: %s, plus ims and edx when -i and -e are given). 'bank' writes a bank of the distinct questions of all modules" % ' '.join(DEFAULT_TARGETS))
+    parser.add_argument("-c", "--cache-dir", dest="cacheDir", help="Set the dir where parsed modules are cached between builds", default=CACHE_PATH)
+    parser.add_argument("--no-cache", dest="cacheDir", action='store_const', const=None, help="Do not use the parsed modules cache")
+    parser.add_argument("--compress-level", dest="compressLevel", type=int, choices=range(10), metavar='0-9', help="zlib compression level of the IMS and EDX archives, from 0 (none) to 9 (best). Default is %d for IMS and %d for EDX" % (archives.COMPRESS_LEVEL, archives.TAR_GZ_COMPRESS_LEVEL), default=None)
+    parser.add_argument("--compress-jobs", dest="compressJobs", type=int, help="Number of threads compressing the IMS and EDX archives (default 1). With more than one, the EDX tar.gz is made of independently compressed blocks, like pigz does", default=1)
+    parser.add_argument("--video-metadata", dest="videoMetadata", choices=['none', 'online', 'offline'], help="Fetch thumbnails of videos from their provider ('online'), or only take the ones fetched by previous builds ('offline'). Default is 'none'", default='none')
+    parser.add_argument("--compiled-templates", dest="compiledTemplates", help="Load the templates compiled ahead of time in this dir by 'python src/templateRegistry.py dir'")
+    parser.add_argument("--markdown-cache-size", dest="markdownCacheSize", type=int, help="Set the memory budget of the markdown conversions cache, in characters of html (0 to disable it)", default=utils.MARKDOWN_CACHE_SIZE)
     args = parser.parse_args()
+    if args.targets is None:
+        args.targets = list(DEFAULT_TARGETS)
+    if args.ims and 'ims' not in args.targets:
+        args.targets.append('ims')
+    if args.edx and 'edx' not in args.targets:
+        args.targets.append('edx')
+
+    utils.markdown_cache.max_size = args.markdownCacheSize
+    # templates are compiled once per build, their bytecode being kept in the cache dir
+    templateRegistry.configure(bytecode_dir=args.cacheDir and os.path.join(os.path.abspath(args.cacheDir), 'templates'),
+                               compiled_dir=args.compiledTemplates and os.path.abspath(args.compiledTemplates))
 
     # ** Logging **
     logfile = utils.create_empty_file(os.path.join(BASE_PATH, 'logs'), 'cnExport.log')
@@ -182,7 +317,10 @@ if __name__ == "__main__":
     course_obj = processRepository(args, repoDir, outDir)
 
     # ** Build site **
-    buildSite(course_obj, repoDir, outDir)
+    if 'site' in args.targets:
+        buildSite(course_obj, repoDir, outDir)
+
+    logging.info("markdown conversions cache: %(hits)d hits, %(misses)d misses, %(entries)d entries" % utils.markdown_cache.stats())
 
     # ** Exit and print path to build files: **
     os.chdir(BASE_PATH)
@@ -1,17 +1,18 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import hashlib
 import os
-import sys
 import re
 import json
-import markdown
 import zipfile
 import random
 from datetime import datetime
 import time
 import logging
+import threading
 import uuid
+from collections import OrderedDict
 
 from lxml import etree
 from lxml import html
@@ -19,6 +20,7 @@ from yattag import indent
 from yattag import Doc
 
 import utils
+import giftParser
 
 HEADER = """
     <!DOCTYPE html><html lang="fr"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, user-scalable=yes, initial-scale=1.0"></head><body>
@@ -28,7 +30,6 @@ FOOTER = """
     </body></html>
     """
 
-MARKDOWN_EXT = ['markdown.extensions.extra', 'superscript']
 # GIFT syntax (from https://docs.moodle.org/28/en/GIFT_format):
     # * Questions separated by new line
     # * Question made of 3 parts:
@@ -52,54 +53,137 @@ MARKDOWN_EXT = ['markdown.extensions.extra', 'superscript']
     #    SHORTANSWER for Short Answer questions
     #    MISSINGWORD for fill-in-the-blank
     #    MATCH for Matching questions
+    #
+    # Questions are read by giftParser, which also recognizes SHORTANSWER and MATCH
+    # questions; exports do not handle them, nor descriptions, so they are given as ESSAY.
+# Namespace of the ids of questions, see question_id()
+QUESTION_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/CultureNumerique/cn_app/question')
+
+EXPORTED_TYPES = {
+    'DESCRIPTION': 'ESSAY',
+    'SHORTANSWER': 'ESSAY',
+    'MATCH': 'ESSAY',
+}
+
+class GiftAnswer(object):
+    """
+        One possible answer of a question. Slotted, since a questions bank holds a lot of them.
 
-class GiftQuestion():
+        Fields can also be read with the item syntax, e.g answer['is_right'].
+    """
+    __slots__ = ('answer_text', 'is_right', 'feedback', 'credit')
+
+    def __init__(self, answer_text='', is_right=True, feedback='', credit=0):
+        self.answer_text = answer_text
+        self.is_right = is_right
+        self.feedback = feedback
+        self.credit = credit
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+
+class GiftQuestion(object):
     """
         A class to describe all possible fields of a GIFT question. We keep it minimal
         with only fields used after processing Gift source text.
 
+        A question is parsed and its text and global feedback converted to html once, by load().
+        Its outputs (html for the site, IMS QTI item, EDX problem...) are then rendered only once
+        and kept by output(), so fields should not be changed once outputs have been asked.
     """
+    __slots__ = ('id', 'gift_src', 'old_src', 'type', 'title', 'text', 'text_format', 'answers', 'poststate', 'question_is_true',
+                 'global_feedback', 'global_feedback_format', 'feedback_for_right', 'feedback_for_wrong', '_outputs')
+
     def __init__(self):
-        self.id = uuid.uuid4()
+        self.id = None # given by load(), from the source and position of the question (see question_id())
         self.gift_src = ''
         self.type = ''
         self.title = ''
         self.text = ''
         self.text_format = 'moodle' # possible values = html, moodle, plain and markdown
-        self.answers = [] # a list of possible answers objects
+        self.answers = [] # a list of GiftAnswer objects
         self.poststate = '' # bit of text possibly added in case of MISSINGWORD questions
         self.question_is_true = True # for TRUEFALSE questions, by default considered TRUE
         self.global_feedback = ''
         self.global_feedback_format = '[markdown]'
         self.feedback_for_right = '' # for TRUEFALSE questions, given when giving the right answer
         self.feedback_for_wrong = '' # for TRUEFALSE questions, given when giving the wrong answer
-
-    def md_src_to_html(self):
-        """ Convert question or feedback src from markdown to html ( useful for easier export) """
-        new_src = self.gift_src
-        # A / look for question text, and if format is markdown, convert in html
-        m1 = re.search('(?P<titre>::.*::){0,1}\s*(?P<format>\[[^\]]*\]){0,1}\s*(?P<qtext>[^\{]*)', new_src, flags=re.M)
-        if m1:
-            if m1.group('qtext'):
-                qtext = markdown.markdown(m1.group('qtext'), MARKDOWN_EXT, output_format='xhtml')
-                qtext = utils.add_target_blank(qtext)
-                new_src = new_src.replace(m1.group('qtext'), qtext)
-            if m1.group('format'):
-                new_src = new_src.replace(m1.group('format'), '[html]')
-        # B / same for global feedback if any)
-        p2 = re.compile('####\s*(?P<format>\[[^\]]*\]){0,1}\s*(?P<gf>[^\}]*)', flags=re.M)
-        m2 = p2.search(self.gift_src)
-        if m2:
-            if m2.group('format'):
-                new_src = new_src.replace(m2.group('format'), '[html]')
-            if m2.group('gf'):
-                gf = markdown.markdown(m2.group('gf'), MARKDOWN_EXT)
-                gf = utils.add_target_blank(gf)
-                pos = m2.start() # replace only in the relevant part of the string and not the entire string
-                new_src = new_src[:pos]+new_src[pos:].replace(m2.group('gf'), gf)
-
+        self._outputs = {} # outputs of the question already rendered, by key (see output())
+
+    def load(self, gift_src, position=''):
+        """ Read all fields of the question from its GIFT source, with text and global feedback converted to html.
+        Its id is given by its source and 'position' (see question_id())
+        """
+        self.id = question_id(gift_src, position)
+        self.gift_src = gift_src
+        node = giftParser.parse(gift_src)
+        self.parse_gift_src(node)
+        self.md_src_to_html(node)
+
+    def copy(self, id):
+        """ returns a question with the same fields as this one, except its 'id', and sharing its outputs (rendered once for both) """
+        question = GiftQuestion.__new__(GiftQuestion)
+        for name in self.__slots__:
+            if hasattr(self, name):
+                setattr(question, name, getattr(self, name))
+        question.id = id
+        return question
+
+    def output(self, key, render):
+        """ returns the output of the question identified by 'key', given by render() the first time only.
+        Outputs are shared by the copies of a question, so the key of an output depending on the id must hold it
+        """
+        try:
+            return self._outputs[key]
+        except KeyError:
+            value = self._outputs[key] = render()
+            return value
+
+    def rendered_html(self, field):
+        """ returns the html rendering of 'field' (name of a rich-text field, text or global_feedback), converted once for all outputs """
+        return self.output(('markdown', field), lambda: utils.render_markdown(getattr(self, field), 'xhtml'))
+
+    def md_src_to_html(self, node=None):
+        """ Convert question text and global feedback of the src from markdown to html ( useful for easier export).
+        The text and global_feedback fields are given the same html, as when parsing the new src.
+
+        :param node: the tree of the src given by giftParser.parse(), parsed again if not given
+        :type node: giftParser.QuestionNode
+        """
+        if node is None:
+            node = giftParser.parse(self.gift_src)
+        replacements = [] # (start, end, new source) of the converted parts
+        # A / question text and its format
+        if node.format_span:
+            replacements.append(node.format_span + ('[html]',))
+            self.text_format = 'html'
+        if node.text_span:
+            start = giftParser.SPACES.match(self.gift_src, node.text_span[0]).end()
+            qtext = self.gift_src[start:node.text_span[1]]
+            if qtext:
+                qtext = utils.postprocess_html(utils.render_markdown(giftParser.unescape(qtext), 'xhtml'), method='xml')
+                replacements.append((start, node.text_span[1], giftParser.escape(qtext)))
+                self.text = self.gift_src[node.text_span[0]:start]+qtext
+        # B / same for global feedback if any
+        if node.global_feedback_format_span:
+            replacements.append(node.global_feedback_format_span + ('[html]',))
+            self.global_feedback_format = '[html]'
+        if node.global_feedback_span:
+            start = giftParser.SPACES.match(self.gift_src, node.global_feedback_span[0]).end()
+            gf = self.gift_src[start:node.global_feedback_span[1]]
+            if gf:
+                gf = utils.postprocess_html(utils.render_markdown(giftParser.unescape(gf)), method='xml')
+                replacements.append((start, node.global_feedback_span[1], giftParser.escape(gf)))
+                self.global_feedback = self.gift_src[node.global_feedback_span[0]:start]+gf
 
         # C FIXME : should also check for per-answer feedbacks
+        new_src = self.gift_src
+        for start, end, converted in sorted(replacements, reverse=True):
+            new_src = new_src[:start]+converted+new_src[end:]
         # convert self src
         self.old_src = self.gift_src
         self.gift_src = new_src
@@ -108,7 +192,10 @@ class GiftQuestion():
 
 
     def to_html(self, feedback_option=False):
-        """ From a question object, write HTML representation """
+        """ From a question object, write HTML representation (rendered once for each feedback option) """
+        return self.output(('html', bool(feedback_option)), lambda: self.render_html(feedback_option))
+
+    def render_html(self, feedback_option=False):
         doc, tag, text = Doc().tagtext()
         # FIXME : add comment line here ?
         doc.asis('\n')
@@ -120,15 +207,13 @@ class GiftQuestion():
                 if self.text_format == 'html':
                     doc.asis(self.text)
                 else:
-                    logging.info ("printing Markdown/ source = %s" % (self.text))
-                    html_text = markdown.markdown(self.text, MARKDOWN_EXT, output_format='xhtml')
-                    doc.asis(html_text)
+                    doc.asis(self.rendered_html('text'))
             # If type MULTICHOICE, MULTIANSWER give choices
             if self.type in ['MULTICHOICE', 'MULTIANSWER', 'TRUEFALSE']:
                 with tag('ul', klass=self.type.lower()):
                     for answer in self.answers:
                         if self.type in ['MULTICHOICE', 'TRUEFALSE']:
-                            if answer['is_right'] and bool(feedback_option):
+                            if answer.is_right and bool(feedback_option):
                                 answer_class = 'right_answer'
                             elif bool(feedback_option):
                                 answer_class = 'wrong_answer'
@@ -136,9 +221,9 @@ class GiftQuestion():
                                 answer_class = ''
                             with tag('li', klass=answer_class):
                                 doc.stag('input', type='radio', name="name")
-                                doc.asis(answer['answer_text'].strip('</p>'))
+                                doc.asis(answer.answer_text.strip('</p>'))
                         elif self.type == 'MULTIANSWER':
-                            if float(answer['credit']) > 0.0 and feedback_option:
+                            if float(answer.credit) > 0.0 and feedback_option:
                                 answer_class = 'right_answer'
                             elif feedback_option:
                                 answer_class = 'wrong_answer'
@@ -146,7 +231,7 @@ class GiftQuestion():
                                 answer_class = ''
                             with tag('li', klass=answer_class):
                                 doc.stag('input', type='checkbox', name="name")
-                                doc.asis(answer['answer_text'].strip('</p>'))
+                                doc.asis(answer.answer_text.strip('</p>'))
 
             if (feedback_option and len(self.global_feedback) > 1):
                 with tag('div', klass='global_feedback'):
@@ -155,100 +240,104 @@ class GiftQuestion():
         return((doc.getvalue()))
 
 
-    def parse_gift_src(self):
-        # 1. Separate in 3 parts: q_prestate { q_answers } q_poststate
-        split_1 = self.gift_src.split('{', 1)
-        q_prestate = split_1[0]
-        if len(split_1) <= 1:
-            # description type with no {}
-            self.text = self.gift_src
-            self.type = 'DESCRIPTION'
-            q_answers = ''
-        else:
-            tmp = split_1[1]
-            split_2 = tmp.split('}', 1)
-            q_answers = tmp.split('}', 1)[0]
-            if len(split_2) > 1:
-                q_poststate = tmp.split('}', 1)[1]
-
-        # 2. Process q_prestate
-        r0 = re.compile('(::(?P<title>.*)::){0,1}\s*(\[(?P<text_format>[^\]]*)\]){0,1}(?P<text>.*)', flags=re.M+re.S)
-        m0 = r0.search(q_prestate)
-        if m0.group('title'):
-            self.title = m0.group('title')
-            #pprint(" Question title= %s" % self.title)
-        if m0.group('text_format'):
-            self.text_format = m0.group('text_format')
-            #pprint(" Question format = %s" % self.text_format)
-        if m0.group('text'):
-            self.text = m0.group('text')
-            #pprint(" Question part = %s" % self.text)
-
-        # 3. Process answers
-        ## Retrieve global feedback, if any, and remove it for simpler further processing
-        r1 = re.compile('####(?P<fb_format>\[.*\]){0,1}(?P<global_fb>.*)', flags=re.M+re.S)
-        m1 = r1.search(q_answers)
-        if m1 is not None:
-            self.global_feedback = m1.group('global_fb')
-            self.global_feedback_format = m1.group('fb_format')
-            q_answers = r1.sub('', q_answers)
-        ## Then, process the remaining types
-        logging.info(" ++++ Answer part after retrieving global feedback =%s=" % (q_answers))
-        if q_answers.isspace() or q_answers == '':
-            self.type = 'ESSAY'
-        ## TRUEFALSE questions
-        elif q_answers.startswith(('T','F','TRUE','FALSE')):
-            self.type = 'TRUEFALSE'
-            r2 = re.compile("#{1}(?P<wrong_fb>[^#]*)#{0,1}(?P<right_fb>[^#]*){0,1}")
-            m2 = r2.search(q_answers)
-            if m2 is not None:
-                self.feedback_for_wrong = m2.group('wrong_fb')
-                self.feedback_for_right = m2.group('right_fb')
-            if q_answers.startswith(('F','FALSE')):
-                self.question_is_true = False # default is True
-                new_answers = [{'answer_text' : 'Vrai', 'is_right' :False, 'feedback' : self.feedback_for_wrong, 'credit':0},
-                    {'answer_text' : 'Faux', 'is_right' :True, 'feedback' : self.feedback_for_right, 'credit':100}]
+    def parse_gift_src(self, node=None):
+        """ Fill the fields of the question from its GIFT source
+
+        :param node: the tree of the source given by giftParser.parse(), parsed again if not given
+        :type node: giftParser.QuestionNode
+        """
+        if node is None:
+            node = giftParser.parse(self.gift_src)
+        if node.title:
+            self.title = node.title
+        if node.format:
+            self.text_format = node.format
+        if node.text:
+            self.text = node.text
+        self.poststate = node.poststate
+        self.type = EXPORTED_TYPES.get(node.kind, node.kind)
+        if node.global_feedback is not None:
+            self.global_feedback = node.global_feedback
+            self.global_feedback_format = node.global_feedback_format and '[%s]' % node.global_feedback_format
+        logging.info(" ++++ Question of type %s with %d answers" % (node.kind, len(node.answers or [])))
+
+        if node.kind == 'TRUEFALSE':
+            self.question_is_true = node.is_true
+            self.feedback_for_wrong = node.feedback_for_wrong
+            self.feedback_for_right = node.feedback_for_right
+            if self.question_is_true:
+                self.answers = [GiftAnswer('Vrai', True, self.feedback_for_right, 100),
+                    GiftAnswer('Faux', False, self.feedback_for_wrong, 0)]
             else:
-                new_answers = [{'answer_text' : 'Vrai', 'is_right' :True, 'feedback' : self.feedback_for_right, 'credit':100},
-                    {'answer_text' : 'Faux', 'is_right' :False, 'feedback' : self.feedback_for_wrong, 'credit':0}]
-            self.answers = new_answers
-            return
-        ## NUMERIC questions
-        elif q_answers.startswith('#'):
-            self.type = 'NUMERIC'
-            # FIXME: for NUMERIC questions with a single anwser, get possible value and range #3.1415:0.0005
-
-        ## MULTICHOICE / MULTIANSWERS / NUMERIC / MATCHING
-        ### split answers
-        right_answer_count = 0
-        false_answer_count = 0
-
-        for answer_raw in re.findall('([~=][^~=]*)', q_answers):
-            new_answer = {'credit':0,'answer_text':'','feedback':'','is_right':True}
-            # MULTIANSWERS <=> right_answer_count =  AND false_answer_count > 0
-            if answer_raw.startswith('='):
-                new_answer['is_right'] = True
-                right_answer_count+=1
-            elif answer_raw.startswith('~'):
-                new_answer['is_right'] = False
-                false_answer_count+=1
-            if len(answer_raw) > 0:
-                ### get text and create new answer object
-                # FIXME : MATCHING questions have answers like "=subquestion1 -> subanswer1"
-                # FIXME : NUMERIC with several possible values indicate ranges like "X:range"
-                m = re.search('^[=|~](?P<credit>\%-*\d+\.*\d*\%){0,1}(?P<format>\[[^\]]*\]){0,1}(?P<answer>[^#]*)#*?(?P<feedback>.*)', answer_raw)
-                if m.group('credit'):
-                    new_answer['credit'] = m.group('credit').strip('%')
-                new_answer['answer_text'] = m.group('answer').lstrip('~=')
-                new_answer['feedback'] = m.group('feedback').lstrip('#')
-            self.answers.append(new_answer)
-
-        if right_answer_count == 0 and false_answer_count > 0:
-            self.type = 'MULTIANSWER'
-        elif false_answer_count > 0:
-            self.type = 'MULTICHOICE'
-        elif self.type == '': # FIXME we should recognize NUMERIC and MATCHING here
-            self.type = 'ESSAY'
+                self.answers = [GiftAnswer('Vrai', False, self.feedback_for_wrong, 0),
+                    GiftAnswer('Faux', True, self.feedback_for_right, 100)]
+        elif node.answers:
+            # values of numeric questions given without = are not kept as answers
+            self.answers = [GiftAnswer(answer.text, answer.is_right, answer.feedback, answer.credit if answer.credit is not None else 0)
+                            for answer in node.answers if answer.is_right is not None]
+
+
+def normalize_source(gift_src):
+    """ returns the GIFT source of a question with its line endings normalized and its outer whitespace stripped. Whitespace inside the source is
+    kept as is, as Markdown gives it a meaning (line breaks after two spaces, indented code, paragraphs) """
+    return gift_src.replace('\r\n', '\n').replace('\r', '\n').strip()
+
+
+def question_id(gift_src, position):
+    """ returns the id of a question, a UUID derived from its GIFT source (see normalize_source()) and its position, e.g 'module1/2-3/0'.
+    Unlike random ids, it does not change from one build to another as long as the question does not change
+    """
+    name = position+'\0'+normalize_source(gift_src)
+    return uuid.uuid5(QUESTION_ID_NAMESPACE, name.encode('utf-8'))
+
+
+class QuestionsIndex(object):
+    """
+        Index of the questions processed during a build, by hash of their GIFT source (see normalize_source()). A question found again,
+        in the same module or in another one, is not processed again: it is a copy of the first one, sharing its fields and
+        its rendered outputs (see GiftQuestion.copy()), only its id being its own.
+    """
+    def __init__(self):
+        self.questions = OrderedDict() # hash of the normalized source -> first question processed with this source
+        self.duplicates = 0
+        self.lock = threading.Lock()
+
+    def getKey(self, gift_src):
+        return hashlib.sha1(normalize_source(gift_src).encode('utf-8')).hexdigest()
+
+    def load(self, gift_src, position=''):
+        """ returns the question of source 'gift_src' at 'position', processed only if no question of the same source has been """
+        key = self.getKey(gift_src)
+        with self.lock:
+            first = self.questions.get(key)
+        if first is None:
+            question = GiftQuestion()
+            question.load(gift_src, position)
+            with self.lock:
+                first = self.questions.setdefault(key, question)
+            if first is question:
+                return question
+        with self.lock:
+            self.duplicates += 1
+        return first.copy(question_id(gift_src, position))
+
+    def add(self, question):
+        """ indexes 'question', processed before (e.g. taken from the parse cache), unless a question of the same source is indexed already """
+        key = self.getKey(question.gift_src)
+        with self.lock:
+            self.questions.setdefault(key, question)
+
+    def writeGift(self, fp):
+        """ writes the GIFT code of each distinct question to the file object 'fp', in the order they were first processed """
+        with self.lock:
+            questions = list(self.questions.values())
+        for question in questions:
+            fp.write('\n'+question.gift_src+'\n')
+
+    def stats(self):
+        """ returns a dict with the number of distinct questions and of duplicates """
+        with self.lock:
+            return {'questions': len(self.questions), 'duplicates': self.duplicates}
 
 
 def clean_question_src(question):
@@ -258,24 +347,22 @@ def clean_question_src(question):
         question = question.replace('\\n', '')
     return question
 
-def extract_questions(some_text):
-    """ From a piece of text, extract and returns a list of single line strings with GIFT formated questions """
+def iter_questions(lines):
+    """ Generator of the single line strings with GIFT formated questions read from 'lines' (iterable of lines, e.g a file object), one question at a time """
 
-    questions_src = []
-    new_question = None
+    new_question = None # list of the lines of the current question
 
-    for line in some_text.splitlines(True):
+    for line in lines:
         # if blank line (or line with only spaces), starts a new question
         if line == '' or line.isspace():
             if new_question is not None:
                 if len(new_question) > 0:
-                    new_question = clean_question_src(new_question)
-                    questions_src.append(new_question)
-                    new_question = "" # we start over a new question
+                    yield clean_question_src(''.join(new_question))
+                    new_question = [] # we start over a new question
                 else:
                     pass
             else:
-                new_question = ""
+                new_question = []
         # if starts with '//' it's a comment
         elif line.startswith('//'):
             # FIXME get question number from pattern " question: xxxx "
@@ -286,57 +373,36 @@ def extract_questions(some_text):
         # else,  line should be aggregated to the current question; for one-liners, this is a new question in its own
         else:
             if new_question is None:
-                new_question = ""
-            new_question+=line
+                new_question = []
+            new_question.append(line)
 
     # for txt src with only 1 question and no blank lines:
     if new_question is not None:
         if len(new_question) > 0:
-            new_question = clean_question_src(new_question)
-            questions_src.append(new_question)
+            yield clean_question_src(''.join(new_question))
+
 
+def extract_questions(some_text):
+    """ From a piece of text, extract and returns a list of single line strings with GIFT formated questions """
+
+    questions_src = list(iter_questions(some_text.splitlines(True)))
     logging.info(" Extracted  %d questions" % (len(questions_src)))
     return questions_src
 
 
-def process_questions(questions_src):
+def process_questions(questions_src, position='', index=None):
     """ given a list of questions sources, process each question to retrieve all fields;
-        each question_source is a one liner string of text. Return a list of question objects
+        each question_source is a one liner string of text. Return a list of question objects.
+        Ids of questions are given by their source and index, after 'position' (position of the list, e.g 'module1/2-3').
+        If given, 'index' (QuestionsIndex of the current build, see cnExport.processRepository()) provides the questions already processed.
     """
     question_objects = []
-    for q_src in questions_src:
-        q_obj = GiftQuestion()
-        q_obj.gift_src = q_src
-        q_obj.md_src_to_html()
-        q_obj.parse_gift_src()
+    for idx, q_src in enumerate(questions_src):
+        if index is not None:
+            q_obj = index.load(q_src, '%s/%d' % (position, idx))
+        else:
+            q_obj = GiftQuestion()
+            q_obj.load(q_src, '%s/%d' % (position, idx))
         question_objects.append(q_obj)
 
     return question_objects
-
-
-def main(argv):
-    """
-        fromGIFT : take Gift file 'filein' and turn it into  'filein.html'
-    """
-    if len(sys.argv) != 2:
-        print(" mini 1 argument")
-    filein = sys.argv[1]
-    with open(filein, encoding='utf-8') as gift_file:
-        # load module data from filin
-        gift_src = gift_file.read()
-    # Extract raw Gift questions in a *list*
-    raw_gift_questions = extract_questions(gift_src)
-    # Process them and store them in a *list of objects*
-    questions = process_questions(raw_gift_questions)
-    # Write them in HTML
-    filename = filein+'.html'
-    fileout = open(filename, 'w')
-    fileout.write(HEADER)
-    for question in questions:
-        fileout.write(question.to_html())
-    fileout.write(FOOTER)
-    fileout.close()
-
-############### main ################
-if __name__ == "__main__":
-    main(sys.argv)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+######################################################################################
+#
+#    Conversion of banks of GIFT questions, of any size, to HTML and optionally to an
+#    IMS QTI test and EDX problems. Questions are read, processed by worker processes
+#    and written as they come. Run as 'python src/giftBank.py filein [OPTIONS]': the
+#    conversion lives apart from fromGIFT.py, as the IMS and EDX exporters rendering the
+#    questions depend on fromGIFT themselves.
+#
+######################################################################################
+
+import argparse
+import codecs
+import io
+import multiprocessing
+import os
+import sys
+from collections import deque
+
+import toEDX
+import toIMS
+import fromGIFT
+import utils
+
+QUESTIONS_CHUNK_SIZE = 50 # number of questions processed at once by a worker process, see convert_questions()
+
+
+def render_questions(task):
+    """ Process the questions of 'task' and returns their outputs. Run by the worker processes of convert_questions().
+
+    :param task: (position, formats, feedback_option, questions), questions being a list of (index, GIFT source)
+    :type task: tuple
+
+    :rtype: list of dicts giving the output of each question in each format: 'html', 'qti' (item of an IMS QTI test, in utf-8) and 'edx' ((id, EDX problem))
+    """
+    position, formats, feedback_option, questions = task
+    outputs = []
+    for idx, q_src in questions:
+        question = fromGIFT.GiftQuestion()
+        question.load(q_src, '%s/%d' % (position, idx))
+        output = {}
+        if 'html' in formats:
+            output['html'] = question.to_html(feedback_option)
+        if 'qti' in formats:
+            output['qti'] = toIMS.create_ims_item(question, idx, position)
+        if 'edx' in formats:
+            output['edx'] = (str(question.id), toEDX.toEdxProblemXml(question))
+        outputs.append(output)
+    return outputs
+
+
+def iter_chunks(iterable, size):
+    """ Generator of the lists of 'size' consecutive items of 'iterable' (the last one being possibly shorter) """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def convert_questions(questions_src, position='', formats=('html',), feedback_option=False, processes=None, chunk_size=QUESTIONS_CHUNK_SIZE):
+    """ Generator of the outputs of the questions of 'questions_src' (see render_questions()), in the same order.
+        Questions are processed by chunks in 'processes' worker processes, only a few chunks being read ahead, so that
+        a questions bank of any size can be converted with a bounded memory.
+
+    :param questions_src: iterable of GIFT sources, e.g given by iter_questions()
+    :param position: prefix of the ids of the questions, and title of their IMS QTI test
+    :param formats: outputs to render, among 'html', 'qti' and 'edx'
+    :param processes: number of worker processes, None for the number of CPUs, 1 to process the questions in this process
+    """
+    chunks = ((position, formats, feedback_option, chunk) for chunk in iter_chunks(enumerate(questions_src), chunk_size))
+    if processes == 1:
+        for chunk in chunks:
+            for output in render_questions(chunk):
+                yield output
+        return
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    pending = deque() # results of the chunks given to the pool, in order
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(render_questions, (chunk,)))
+            if len(pending) >= 2*processes:
+                for output in pending.popleft().get():
+                    yield output
+        while pending:
+            for output in pending.popleft().get():
+                yield output
+    finally:
+        pool.terminate()
+
+
+def main(argv):
+    """
+        giftBank : take Gift file 'filein' and turn it into 'filein.html', and optionally into an IMS QTI test 'filein.qti.xml'
+        and EDX problems 'filein_edx/problem/*.xml'. Questions are read, processed and written as they come, by several processes
+    """
+    parser = argparse.ArgumentParser(description="Converts a bank of GIFT questions to HTML, and optionally to IMS QTI and EDX.")
+    parser.add_argument("filein", help="GIFT file")
+    parser.add_argument("-f", "--feedback", action='store_true', help="Add feedbacks of the questions in HTML", default=False)
+    parser.add_argument("-q", "--qti", action='store_true', help="Also write an IMS QTI test filein.qti.xml", default=False)
+    parser.add_argument("-e", "--edx", action='store_true', help="Also write EDX problems in filein_edx/problem", default=False)
+    parser.add_argument("-j", "--jobs", type=int, help="Number of worker processes (default: number of CPUs)", default=None)
+    args = parser.parse_args(argv[1:])
+    filein = args.filein
+    name = os.path.basename(filein)
+    formats = ['html'] + (['qti'] if args.qti else []) + (['edx'] if args.edx else [])
+
+    with io.open(filein, encoding='utf-8') as gift_file, codecs.open(filein+'.html', 'w', encoding='utf-8') as html_file:
+        outputs = convert_questions(fromGIFT.iter_questions(gift_file), name, formats, args.feedback, args.jobs)
+
+        def write_outputs():
+            """ writes the html and EDX outputs of each question, and yields its IMS QTI item, if any, to be written in turn """
+            for output in outputs:
+                html_file.write(output['html'])
+                if 'edx' in output:
+                    qid, problem = output['edx']
+                    utils.write_file(problem.encode('utf-8'), filein+'_edx', 'problem', qid+'.xml')
+                yield output.get('qti')
+
+        html_file.write(fromGIFT.HEADER)
+        if args.qti:
+            with io.open(filein+'.qti.xml', 'wb') as qti_file:
+                toIMS.write_ims_test(qti_file, write_outputs(), utils.cnslugify(name), name)
+        else:
+            for _ in write_outputs():
+                pass
+        html_file.write(fromGIFT.FOOTER)
+
+############### main ################
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,314 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+######################################################################################
+#
+#    Tokenizer and parser of the GIFT source of one question (see fromGIFT.py for the
+#    syntax). tokenize() reads the source once, as a state machine going through the
+#    parts of the question (prestate, answers, global feedback, poststate), and
+#    parse() builds a QuestionNode from its tokens: title, format and text, answers
+#    with their credit and feedback, global feedback, and the values of numeric and
+#    matching answers. Special characters escaped with a backslash (\~ \= \# \{ \}
+#    \:) are plain text.
+#
+######################################################################################
+
+import re
+from collections import namedtuple
+
+FORMATS = ('html', 'moodle', 'plain', 'markdown')
+
+# Stops of the text scanned in each state, escaped characters being matched first to be skipped
+ESCAPED = '\\\\[~=#{}:]'
+TITLE_STOP = re.compile(ESCAPED+'|::')
+PRESTATE_STOP = re.compile(ESCAPED+'|\{')
+ANSWERS_STOP = re.compile(ESCAPED+'|[=~#}]')
+GLOBAL_FEEDBACK_STOP = re.compile(ESCAPED+'|\}')
+UNESCAPE = re.compile(ESCAPED)
+SPACES = re.compile('\s*')
+CREDIT = re.compile('-?\d+(\.\d*)?$')
+
+# States of the tokenizer
+START, PRESTATE, ANSWERS_START, ANSWERS, GLOBAL_FEEDBACK, POSTSTATE = range(6)
+
+
+class GiftToken(namedtuple('GiftToken', ['kind', 'value', 'start', 'end'])):
+    """ Token of a GIFT source: kind, value (unescaped text, title or format name) and [start, end[ span in the source.
+    Kinds are 'title', 'format', 'text', 'open' ({), 'close' (}), 'right' (=), 'wrong' (~), 'credit' (%50%),
+    'numeric' (# opening numeric answers), 'feedback' (#) and 'global_feedback' (####) """
+    __slots__ = ()
+
+
+def unescape(text):
+    """ returns 'text' without the backslashes escaping GIFT special characters """
+    return UNESCAPE.sub(lambda m: m.group()[1], text)
+
+
+def escape(text, chars='{}'):
+    """ returns 'text' with the GIFT special characters in 'chars' escaped by a backslash """
+    for char in chars:
+        text = text.replace(char, '\\'+char)
+    return text
+
+
+def scan(src, pos, stop):
+    """ returns the position of the first character from 'pos' matched by the regex 'stop' and not escaped, len(src) if there are none """
+    while True:
+        m = stop.search(src, pos)
+        if m is None:
+            return len(src)
+        if m.group()[0] != '\\':
+            return m.start()
+        pos = m.end()
+
+
+def readFormat(src, pos):
+    """ returns the GiftToken of the format in brackets at 'pos', None if there is no known format """
+    if src.startswith('[', pos):
+        end = src.find(']', pos)
+        if end > 0 and src[pos+1:end] in FORMATS:
+            return GiftToken('format', src[pos+1:end], pos, end+1)
+    return None
+
+
+def tokenize(src):
+    """ Generator of the GiftTokens of 'src', GIFT source of one question, read in a single pass """
+    state = START
+    pos = 0
+    length = len(src)
+    while pos < length:
+        if state == START:
+            # [::title::] [[format]] text
+            if src.startswith('::', pos):
+                end = scan(src, pos+2, TITLE_STOP)
+                if end < length:
+                    yield GiftToken('title', unescape(src[pos+2:end]), pos, end+2)
+                    pos = end+2
+            pos = SPACES.match(src, pos).end()
+            token = readFormat(src, pos)
+            if token:
+                yield token
+                pos = token.end
+            state = PRESTATE
+        elif state == PRESTATE:
+            end = scan(src, pos, PRESTATE_STOP)
+            if end > pos:
+                yield GiftToken('text', unescape(src[pos:end]), pos, end)
+            if end < length:
+                yield GiftToken('open', '{', end, end+1)
+            pos = end+1
+            state = ANSWERS_START
+        elif state == ANSWERS_START:
+            # answers of numeric questions start with a single #
+            start = SPACES.match(src, pos).end()
+            if src.startswith('#', start) and not src.startswith('####', start):
+                yield GiftToken('numeric', '#', start, start+1)
+                pos = start+1
+            state = ANSWERS
+        elif state == ANSWERS:
+            char = src[pos]
+            if char in '=~':
+                yield GiftToken('right' if char == '=' else 'wrong', char, pos, pos+1)
+                pos += 1
+                if src.startswith('%', pos):
+                    end = src.find('%', pos+1)
+                    if end > 0 and CREDIT.match(src, pos+1, end):
+                        yield GiftToken('credit', src[pos+1:end], pos, end+1)
+                        pos = end+1
+                token = readFormat(src, pos)
+                if token:
+                    yield token
+                    pos = token.end
+            elif char == '#':
+                if src.startswith('####', pos):
+                    yield GiftToken('global_feedback', '####', pos, pos+4)
+                    pos += 4
+                    state = GLOBAL_FEEDBACK
+                else:
+                    yield GiftToken('feedback', '#', pos, pos+1)
+                    pos += 1
+            elif char == '}':
+                yield GiftToken('close', '}', pos, pos+1)
+                pos += 1
+                state = POSTSTATE
+            else:
+                end = scan(src, pos, ANSWERS_STOP)
+                yield GiftToken('text', unescape(src[pos:end]), pos, end)
+                pos = end
+        elif state == GLOBAL_FEEDBACK:
+            # the text follows the format, if any, else directly the ####
+            token = readFormat(src, SPACES.match(src, pos).end())
+            if token:
+                yield token
+                pos = token.end
+            end = scan(src, pos, GLOBAL_FEEDBACK_STOP)
+            if end > pos:
+                yield GiftToken('text', unescape(src[pos:end]), pos, end)
+            pos = end
+            state = ANSWERS
+        elif state == POSTSTATE:
+            yield GiftToken('text', unescape(src[pos:]), pos, length)
+            pos = length
+
+
+class AnswerNode(object):
+    """ One answer of a question. 'is_right' is True for '=' answers, False for '~' ones, and None for the value of a numeric question given without marker.
+    'credit' is the string between % (None if not given), 'numeric' the (value, tolerance) of numeric answers and 'match' the (question, answer) pair of matching ones
+    """
+    __slots__ = ('is_right', 'credit', 'format', 'text', 'feedback', 'numeric', 'match')
+
+    def __init__(self, is_right=None):
+        self.is_right = is_right
+        self.credit = None
+        self.format = None
+        self.text = ''
+        self.feedback = ''
+        self.numeric = None
+        self.match = None
+
+
+class QuestionNode(object):
+    """ Tree of a GIFT question, given by parse(). Texts are kept as in the source, only unescaped.
+
+    'kind' is one of DESCRIPTION (no answers part), ESSAY, TRUEFALSE, NUMERIC, MATCH, SHORTANSWER, MULTIANSWER and MULTICHOICE.
+    'answers' is None for descriptions, and empty for true/false questions whose answer is given by 'is_true'.
+    'global_feedback' is None if there is none. Spans are the (start, end) positions in the source of the question format, text,
+    global feedback format and global feedback text (None if absent).
+    """
+    __slots__ = ('title', 'format', 'text', 'answers', 'kind', 'is_true', 'feedback_for_wrong', 'feedback_for_right',
+                 'global_feedback', 'global_feedback_format', 'poststate',
+                 'format_span', 'text_span', 'global_feedback_format_span', 'global_feedback_span')
+
+    def __init__(self):
+        self.title = ''
+        self.format = None
+        self.text = ''
+        self.answers = None
+        self.kind = 'DESCRIPTION'
+        self.is_true = True
+        self.feedback_for_wrong = ''
+        self.feedback_for_right = ''
+        self.global_feedback = None
+        self.global_feedback_format = None
+        self.poststate = ''
+        self.format_span = None
+        self.text_span = None
+        self.global_feedback_format_span = None
+        self.global_feedback_span = None
+
+
+def parseNumeric(text):
+    """ returns the (value, tolerance) of a numeric answer written 'value', 'value:tolerance' or 'min..max', None if it is not a number """
+    text = text.strip()
+    try:
+        if '..' in text:
+            low, high = [float(bound) for bound in text.split('..', 1)]
+            return ((low+high)/2, (high-low)/2)
+        if ':' in text:
+            value, tolerance = text.split(':', 1)
+            return (float(value), float(tolerance))
+        return (float(text), 0.0)
+    except ValueError:
+        return None
+
+
+def parse(src):
+    """ Parse the GIFT source of one question
+
+    :param src: GIFT source of the question, on one or several lines
+    :type src: string
+
+    :rtype: QuestionNode
+    """
+    question = QuestionNode()
+    numeric = False
+    head = [] # text of the answers part before the first answer, e.g TRUE or a numeric value
+    head_feedbacks = [] # feedbacks given before the first answer (true/false and numeric questions)
+    answer = None
+    in_feedback = False
+    closed = False
+    for token in tokenize(src):
+        kind = token.kind
+        if kind == 'title':
+            question.title = token.value
+        elif kind == 'format':
+            if question.answers is None:
+                question.format = token.value
+                question.format_span = (token.start, token.end)
+            elif question.global_feedback is not None:
+                question.global_feedback_format = token.value
+                question.global_feedback_format_span = (token.start, token.end)
+            else:
+                answer.format = token.value
+        elif kind == 'text':
+            if question.answers is None:
+                question.text = token.value
+                question.text_span = (token.start, token.end)
+            elif closed:
+                question.poststate = token.value
+            elif question.global_feedback is not None:
+                question.global_feedback = token.value
+                question.global_feedback_span = (token.start, token.end)
+            elif answer is None:
+                if in_feedback:
+                    head_feedbacks[-1] += token.value
+                else:
+                    head.append(token.value)
+            elif in_feedback:
+                answer.feedback += token.value
+            else:
+                answer.text += token.value
+        elif kind == 'open':
+            question.answers = []
+        elif kind == 'numeric':
+            numeric = True
+        elif kind in ('right', 'wrong'):
+            answer = AnswerNode(kind == 'right')
+            question.answers.append(answer)
+            in_feedback = False
+        elif kind == 'credit':
+            answer.credit = token.value
+        elif kind == 'feedback':
+            if answer is None:
+                head_feedbacks.append('')
+            elif in_feedback:
+                answer.feedback += token.value # only one feedback per answer
+            in_feedback = True
+        elif kind == 'global_feedback':
+            question.global_feedback = ''
+            question.global_feedback_span = (token.end, token.end)
+        elif kind == 'close':
+            closed = True
+
+    # Kind of question, given by its answers
+    head = ''.join(head).strip()
+    answers = question.answers
+    if answers is None:
+        question.kind = 'DESCRIPTION'
+    elif numeric:
+        question.kind = 'NUMERIC'
+        if head and not answers:
+            answer = AnswerNode()
+            answer.text = head
+            answer.feedback = head_feedbacks[0] if head_feedbacks else ''
+            answers.append(answer)
+        for answer in answers:
+            answer.numeric = parseNumeric(answer.text)
+    elif head in ('T', 'TRUE', 'F', 'FALSE'):
+        question.kind = 'TRUEFALSE'
+        question.is_true = head in ('T', 'TRUE')
+        feedbacks = head_feedbacks + ['', '']
+        question.feedback_for_wrong, question.feedback_for_right = feedbacks[:2]
+    elif not answers:
+        question.kind = 'ESSAY'
+    elif all(answer.is_right and '->' in answer.text for answer in answers):
+        question.kind = 'MATCH'
+        for answer in answers:
+            answer.match = tuple(part.strip() for part in answer.text.split('->', 1))
+    elif all(answer.is_right for answer in answers):
+        question.kind = 'SHORTANSWER'
+    elif not any(answer.is_right for answer in answers):
+        question.kind = 'MULTIANSWER'
+    else:
+        question.kind = 'MULTICHOICE'
+    return question
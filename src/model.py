@@ -14,14 +14,14 @@
 ######################################################################################
 
 
+import io
 import sys
 import re
 import json
-import markdown
 import requests
 import logging
 from unidecode import unidecode
-from inspect import isclass
+from collections import namedtuple
 
 from lxml import etree
 from lxml import html
@@ -31,12 +31,12 @@ from fromGIFT import extract_questions, process_questions
 import toIMS
 import toEDX
 import utils
+import videoProviders
 
 
-MARKDOWN_EXT = ['markdown.extensions.extra', 'superscript']
-VIDEO_THUMB_API_URL = 'https://vimeo.com/api/v2/video/'
-DEFAULT_VIDEO_THUMB_URL = 'https://i.vimeocdn.com/video/536038298_640.jpg'
+DEFAULT_VIDEO_THUMB_URL = videoProviders.DEFAULT_VIDEO_THUMB_URL
 DEFAULT_BASE_URL = 'http://culturenumerique.univ-lille3.fr'
+PARSER_VERSION = '11' # to be increased whenever parsing or the model objects change, so that cached modules get invalidated (see parseCache.py)
 
 # Regexps
 reEndHead = re.compile('^#')
@@ -46,50 +46,251 @@ reStartActivity = re.compile('^```(?P<type>.*)$')
 reEndActivity = re.compile('^```\s*$')
 reMetaData = re.compile('^(?P<meta>.*?):\s*(?P<value>.*)\s*$')
 
+# Token kinds produced by tokenize()
+TOKEN_META = 'META'                 # header line, value is the reMetaData match (or None)
+TOKEN_SECTION = 'SECTION'           # value is the section title
+TOKEN_SUBSECTION = 'SUBSECTION'     # value is the subsection title
+TOKEN_ACTIVITY = 'ACTIVITY'         # opening fence of a known activity, value is the activity class
+TOKEN_ACTIVITY_END = 'ACTIVITY_END' # closing fence of an activity block
+TOKEN_FENCE = 'FENCE'               # any other ``` line, value is the fence label
+TOKEN_TEXT = 'TEXT'                 # plain line of content
+
+# start and end are byte offsets of the line in the (utf-8) source file, lineno its line number (starting at 1)
+Token = namedtuple('Token', ['kind', 'line', 'value', 'lineno', 'start', 'end'])
+
+# Activity registry: normalized fence label -> AnyActivity subclass. Filled once at import time (see end of file)
+ACTIVITY_TYPES = {}
+# memo of raw fence labels already resolved through ACTIVITY_TYPES
+_activity_labels = {}
+
+def activityClass(label):
+    """ returns the AnyActivity subclass matching the 'label' of an opening fence (e.g 'activité-avancée' gives ActiviteAvancee), None otherwise
+
+    :param label: text following the ``` of a fence line
+    :type label: string
+    """
+    try:
+        return _activity_labels[label]
+    except KeyError:
+        act = ACTIVITY_TYPES.get(re.sub('[ ._-]','',unidecode(label).title()))
+        _activity_labels[label] = act
+        return act
+
 def goodActivity(match):
-    """ utility function used with 'reStartActivity' regex pattern to determine wether the 'type' variable of the given matched pattern fits the name of class defined in this module
+    """ utility function used with 'reStartActivity' regex pattern to determine wether the 'type' variable of the given matched pattern fits the name of an activity class defined in this module
 
     :param match: result of reStartActivity.match(some_parsed_line) (see Regex expressions defined above)
     :type match: re.MatchObject
      """
-    m = sys.modules[__name__]
-    typeSection = re.sub('[ ._-]','',unidecode(match.group('type')).title())
-    if typeSection in m.__dict__ :
-        act = getattr(m,typeSection)
-        if isclass(act):
-            return act
-    return None
+    return activityClass(match.group('type'))
+
+def classifyLine(line):
+    """ returns a (kind, value) tuple for a line of the body of a module (i.e after the header). Regexps are only tried on lines whose first characters can match them """
+    if line.startswith('#'):
+        match = reStartSection.match(line)
+        if match:
+            return TOKEN_SECTION, match.group('title')
+        match = reStartSubsection.match(line)
+        if match:
+            return TOKEN_SUBSECTION, match.group('title')
+    elif line.startswith('```'):
+        label = reStartActivity.match(line).group('type')
+        act = activityClass(label)
+        if act:
+            return TOKEN_ACTIVITY, act
+        return TOKEN_FENCE, label
+    return TOKEN_TEXT, None
+
+def tokenize(f, in_head=True):
+    """ Generator reading the lines of a module source file only once and yielding a Token for each of them. Lines are classified according to where they stand:
+
+        - in the header: TOKEN_META
+        - within an activity block: TOKEN_TEXT until the closing fence (TOKEN_ACTIVITY_END)
+        - elsewhere: see classifyLine()
+
+    Byte offsets are those of the lines as read from 'f', whose line endings are then turned into '\n' (as is a leading byte order mark removed) for the parser.
+
+    :param f: module source file pointer, opened with newline='' (see openSource()) for the offsets to match the file whatever its line endings
+    :type f: File
 
+    :param in_head: wether reading starts in the header of the module (default True). False when reading a block of a module (see Module.readSection())
+    :type in_head: Boolean
+    """
+    in_activity = False
+    start = 0
+    for lineno, line in enumerate(f, 1):
+        end = start + len(line.encode('utf-8'))
+        if line.endswith(u'\r\n'):
+            line = line[:-2]+u'\n'
+        elif line.endswith(u'\r'):
+            line = line[:-1]+u'\n'
+        if lineno == 1 and line.startswith(u'\ufeff'):
+            line = line[1:]
+        if in_activity:
+            if line.startswith('```') and reEndActivity.match(line):
+                in_activity = False
+                yield Token(TOKEN_ACTIVITY_END, line, None, lineno, start, end)
+            else:
+                yield Token(TOKEN_TEXT, line, None, lineno, start, end)
+            start = end
+            continue
+        if in_head:
+            if not reEndHead.match(line):
+                yield Token(TOKEN_META, line, reMetaData.match(line), lineno, start, end)
+                start = end
+                continue
+            in_head = False
+        kind, value = classifyLine(line)
+        in_activity = (kind == TOKEN_ACTIVITY)
+        yield Token(kind, line, value, lineno, start, end)
+        start = end
+
+def openSource(filein):
+    """ Opens the module source file 'filein' for tokenize(): utf-8 text whose line endings are kept as they are, so that byte offsets can be counted """
+    return io.open(filein, encoding='utf-8', newline='')
+
+class TokenStream:
+    """ Wraps tokenize() with a one token push back, so that a parser reading the token that ends its block can hand it back to its caller.
+    Keeps track of the position (byte offset and line number) following the last token read
+
+    :param f: module source file pointer
+    :type f: File
+
+    :param in_head: see tokenize()
+    """
+    def __init__(self, f, in_head=True):
+        self._tokens = tokenize(f, in_head)
+        self._pending = None
+        self.offset = 0
+        self.lineno = 0
+
+    def read(self):
+        """ returns the next Token, or None at the end of the file """
+        if self._pending is not None:
+            token, self._pending = self._pending, None
+        else:
+            token = next(self._tokens, None)
+            if token is None:
+                return None
+        self.offset = token.end
+        self.lineno = token.lineno
+        return token
+
+    def pushBack(self, token):
+        """ token will be returned again by the next call to read() """
+        self._pending = token
+        self.offset = token.start
+        self.lineno = token.lineno - 1
+
+class ParseContext(TokenStream):
+    """ State of the parsing of one module: the token stream of its source file, plus the numbering of sections and subsections, the count of each type of activity
+    and the offset index of the blocks parsed (see indexSection()).
+    Nothing is shared between two contexts, so several modules can be parsed at the same time (e.g from a thread pool)
+
+    :param f: module source file pointer
+    :type f: File
+
+    :param in_head: see tokenize()
+
+    :param section_num: number of the section preceding the parsed text (default 0)
+    :param subsection_num: number of the subsection preceding the parsed text (default 0)
+    """
+    def __init__(self, f, in_head=True, section_num=0, subsection_num=0):
+        TokenStream.__init__(self, f, in_head)
+        self.section_num = section_num
+        self.subsection_num = subsection_num
+        self.act_counter = dict((name, 0) for name in ACTIVITY_TYPES)
+        self.index = []
+        self.subsections_index = [] # entries of the subsections of the section being parsed
+
+    def newSectionNum(self):
+        """ returns the number (string) of a new section and restarts subsections numbering """
+        self.section_num += 1
+        self.subsection_num = 0
+        return str(self.section_num)
+
+    def newSubsectionNum(self, section):
+        """ returns the number (string) of a new subsection in 'section', e.g '2-3' """
+        self.subsection_num += 1
+        return section.num+'-'+str(self.subsection_num)
+
+    def countActivity(self, act):
+        """ increments the counter of the type of activity 'act' """
+        self.act_counter[act.__class__.__name__] += 1
+
+    def indexEntry(self, obj, first, last=None):
+        """ returns the index entry of 'obj', parsed from token 'first' up to token 'last' (default: up to the current position) """
+        return {
+            'num': obj.num,
+            'type': obj.__class__.__name__,
+            'start': first.start,
+            'end': last.end if last else self.offset,
+            'line': first.lineno,
+            'end_line': last.lineno if last else self.lineno,
+        }
+
+    def indexSubsection(self, sub, first, last=None):
+        """ records the offsets of subsection 'sub' (see indexEntry()) """
+        self.subsections_index.append(self.indexEntry(sub, first, last))
+
+    def indexSection(self, section, first):
+        """ records the offsets of 'section' parsed from token 'first', along with the ones of its subsections """
+        entry = self.indexEntry(section, first)
+        entry['title'] = section.title
+        entry['subsections'] = self.subsections_index
+        self.subsections_index = []
+        self.index.append(entry)
+
+
+def jsonFields(cls):
+    """ returns the names of the slots of class 'cls' and of its base classes, except the ones listed in their JSON_EXCLUDED attribute """
+    fields = _json_fields.get(cls)
+    if fields is None:
+        excluded = getattr(cls, 'JSON_EXCLUDED', ())
+        fields = tuple(name for klass in reversed(cls.__mro__) for name in klass.__dict__.get('__slots__', ()) if name not in excluded)
+        _json_fields[cls] = fields
+    return fields
+
+_json_fields = {}
 
 class ComplexEncoder(json.JSONEncoder):
-    """ Encoder for Json serialization: just delete recursive structures. Used in toJson instance methods """
+    """ Encoder for Json serialization: just delete recursive structures and the offset index (written apart, see Module.toIndexJson()). Used in toJson instance methods.
+    Slotted objects (sections and subsections) are encoded from the fields given by jsonFields(), leaving out the ones never assigned """
     def default(self, obj):
-        if isinstance(obj, Section) or isinstance(obj,Module):
-            return obj.__dict__
-        elif isinstance(obj, Subsection):
+        if isinstance(obj, (Section, Subsection)):
+            d = {}
+            for name in jsonFields(obj.__class__):
+                try:
+                    d[name] = getattr(obj, name)
+                except AttributeError:
+                    pass
+            return d
+        elif isinstance(obj,Module):
             d = obj.__dict__.copy()
-            del d['section']
-            if isinstance(obj,AnyActivity):
-                del d['questions']
+            d.pop('index', None)
             return d
         return json.JSONEncoder.default(self, obj)
 
 
 
-class Subsection:
+class Subsection(object):
     """
-    Abstract class for any type of subsection: lectures and activities
+    Abstract class for any type of subsection: lectures and activities. Subsections are slotted, so subclasses must declare their own attributes in __slots__
 
     :param section: section object to which this subsection belongs
     :type section: Section object
 
+    :param context: context of the module parsing, giving the subsection number
+    :type context: ParseContext
+
     """
-    num = 1 #class-wise instance counter
-    def __init__(self, section):
+    __slots__ = ('section', 'num', 'videos', 'title', 'folder', 'src', 'html_src', 'lastLine', 'filename')
+    JSON_EXCLUDED = ('section',)
+
+    def __init__(self, section, context):
         self.section = section
-        self.num = self.section.num+'-'+str(Subsection.num) # mere string for display the subsection number
+        self.num = context.newSubsectionNum(section) # mere string for display the subsection number
         self.videos = []
-        Subsection.num +=1
 
     def getFilename(self, term='html'):
         """returns the filename associated to this subsection
@@ -104,6 +305,12 @@ class Subsection:
     def toGift(self):
         return ''
 
+    def writeGift(self, fp):
+        pass
+
+    def writeEdxProblemsList(self, fp):
+        pass
+
     def toXMLMoodle(self):
         pass
 
@@ -115,48 +322,55 @@ class Subsection:
 
 class Cours(Subsection):
     """
-    Class for a lecture. If src is not empty and no file is given, then this means that the content has already been parsed in Section.parse().
-    Else if a file pointer is given and param 'src' is empty,this means that Section.parse() has detected a new 'Cours' instance that we keep on parsing here.
+    Class for a lecture. If src is not empty, then this means that the content has already been parsed in Section.parse().
+    Else if param 'src' is empty,this means that Section.parse() has detected a new 'Cours' instance that we keep on parsing here from the context tokens.
 
     :param section:  containing section object (to be deleted in JSON representation, see ComplexEncoder class)
     :type section: Section object
 
-    :param file:  parsed file (default None)
-    :type file: File pointer
+    :param context:  context of the module parsing
+    :type context: ParseContext
 
     :param src: text string with source of the parsed subsection (default: empty string)
 
     :param title: text string that gives the Cours title (default 'Cours')
     """
-    def __init__(self, section, file=None, src='' ,title = 'Cours'):
-        Subsection.__init__(self,section)
+    __slots__ = ()
+
+    def __init__(self, section, context, src='' ,title = 'Cours'):
+        Subsection.__init__(self,section,context)
         self.title = title
         self.folder = 'webcontent'
         if src: # case when the content has already been parsed
             self.src = src
         else: # case when only the begining of a Course has been detected, so we resume the parsing here
             self.src=''
-            self.parse(file)
+            self.parse(context)
         self.parseVideoLinks()
         self.absolutizeMediaLinks()
 
 
-    def parse(self,f):
-        """Read lines in file pointer 'f' until:
+    def parse(self, tokens):
+        """Read tokens until:
 
             - start of a new section
             - start of another subsection
             - start of a new (checked) activity
+
+        The token ending the lecture is pushed back to the stream for Section.parse()
         """
-        self.lastLine = f.readline()
-        while self.lastLine and not reStartSection.match(self.lastLine) and not reStartSubsection.match(self.lastLine) :
-            # Is it really the end of the section?
-            # blocks that are not activities are included!
-            match = reStartActivity.match(self.lastLine)
-            if match and goodActivity(match):
-                return
-            self.src += self.lastLine
-            self.lastLine = f.readline()
+        lines = []
+        token = tokens.read()
+        # blocks that are not activities are included!
+        while token and token.kind not in (TOKEN_SECTION, TOKEN_SUBSECTION, TOKEN_ACTIVITY):
+            lines.append(token.line)
+            token = tokens.read()
+        self.src = ''.join(lines)
+        if token:
+            self.lastLine = token.line
+            tokens.pushBack(token)
+        else:
+            self.lastLine = ''
 
 
     def toHTML(self, feedback_option=False):
@@ -166,9 +380,8 @@ class Cours(Subsection):
 
         - feedback_option -- determines wether or not it must include feedback and correct answer (default False)
         """
-        self.html_src = markdown.markdown(self.src, MARKDOWN_EXT)
-        self.html_src = utils.iframize_video_anchors(self.html_src, 'lien_video')
-        self.html_src = utils.add_target_blank(self.html_src)
+        self.html_src = utils.postprocess_html(utils.render_markdown(self.src), video_class='lien_video',
+                                               media_url=self.section.base_url+'/'+self.section.module+'/media/')
         return self.html_src
 
 
@@ -177,21 +390,27 @@ class Cours(Subsection):
         return True if the number of videos found is above 0, False otherwise"""
         videos_findall = re.findall('^\[(?P<video_title>.*)\]\s*\((?P<video_link>.*)\){:\s*\.cours_video\s*.*}', self.src, flags=re.M)
         for video_match in videos_findall:
+            embed = videoProviders.getEmbed(video_match[1])
             new_video = {
                 'video_title':video_match[0],
                 'video_link':video_match[1].strip(),
-                'video_src_link':utils.get_video_src(video_match[1].strip()),
-                'video_thumbnail':DEFAULT_VIDEO_THUMB_URL
+                'video_src_link':embed.src if embed else '',
+                'video_thumbnail':(embed and embed.thumbnail) or DEFAULT_VIDEO_THUMB_URL
             }
             self.videos.append(new_video)
         return (len(videos_findall) > 0)
 
     def videoIframeList(self):
         """generates and returns a text string containing all the iframe codes for a course subsection"""
-        video_list = "\n"+self.num+' '+self.title+'\n'
+        buf = utils.StringBuffer()
+        self.writeVideoIframeList(buf)
+        return buf.getvalue()
+
+    def writeVideoIframeList(self, fp):
+        """writes all the iframe codes for a course subsection to the file object 'fp' """
+        fp.write("\n"+self.num+' '+self.title+'\n')
         for v in self.videos:
-            video_list += '<iframe src='+v['video_src_link']+' width="500" height="281" frameborder="0" webkitallowfullscreen mozallowfullscreen allowfullscreen></iframe>\n'
-        return video_list
+            fp.write('<iframe src='+v['video_src_link']+' width="500" height="281" frameborder="0" webkitallowfullscreen mozallowfullscreen allowfullscreen></iframe>\n')
 
 
 class AnyActivity(Subsection):
@@ -200,31 +419,58 @@ class AnyActivity(Subsection):
     :param section:  containing section object (to be deleted in JSON representation, see ComplexEncoder class)
     :type section: Section object
 
-    :param file:  parsed file (default None)
-    :type file: File pointer
+    :param context:  context of the module parsing
+    :type context: ParseContext
     """
-    def __init__(self,section,f):
-        Subsection.__init__(self,section)
+    __slots__ = ('_questions',)
+    JSON_EXCLUDED = ('section', '_questions')
+
+    def __init__(self,section,context):
+        Subsection.__init__(self,section,context)
         self.src = ''
-        self.parse(f)
+        self.parse(context)
         self.absolutizeMediaLinks()
-        self.questions = process_questions(extract_questions(self.src))
 
-
-    def parse(self,f):
-        """Read lines in file pointer f until the end of the activity"""
-        self.lastLine = f.readline()
-        while self.lastLine and not reEndActivity.match(self.lastLine):
-            self.src += self.lastLine
-            self.lastLine = f.readline()
+    @property
+    def questions(self):
+        """list of the questions (GiftQuestion objects) of this activity, only processed from the src attribute when first needed (see loadQuestions())"""
+        return self.loadQuestions()
+
+    def loadQuestions(self, index=None):
+        """returns the questions of this activity, processed from the src attribute if not done yet. If given, 'index' (see fromGIFT.QuestionsIndex)
+        provides the questions already processed in the current build, and gets the ones processed before it (e.g. taken from the parse cache)"""
+        try:
+            questions = self._questions
+        except AttributeError:
+            self._questions = process_questions(extract_questions(self.src), self.section.module+'/'+self.num, index)
+            return self._questions
+        if index is not None:
+            for question in questions:
+                index.add(question)
+        return questions
+
+
+    def parse(self, tokens):
+        """Read tokens until the end of the activity"""
+        lines = []
+        token = tokens.read()
+        while token and token.kind != TOKEN_ACTIVITY_END:
+            lines.append(token.line)
+            token = tokens.read()
+        self.src = ''.join(lines)
+        self.lastLine = token.line if token else ''
 
 
     def toGift(self):
         """Returns a text string containing the gift code of all the questions of this AnyActivity instance"""
-        gift_src=''
+        buf = utils.StringBuffer()
+        self.writeGift(buf)
+        return buf.getvalue()
+
+    def writeGift(self, fp):
+        """Writes the gift code of all the questions of this AnyActivity instance to the file object 'fp' """
         for question in self.questions:
-            gift_src+='\n'+question.gift_src+'\n'
-        return gift_src
+            fp.write('\n'+question.gift_src+'\n')
 
 
     def toHTML(self, feedback_option=False):
@@ -235,16 +481,11 @@ class AnyActivity(Subsection):
 
         :rtype: text string with html code
         """
-        self.html_src = ''
-        for question in self.questions:
-            # append each question to html output
-            self.html_src+=question.to_html(feedback_option)
-            if self.html_src == '': # fallback when question is not yet properly formated
-                self.html_src = '<p>'+self.src+'</p>'
-            # post-process Gift source replacing markdown formated questions text by html equivalent
-            if question.text_format in (("markdown")):
-                question.md_src_to_html()
-                return self.html_src
+        # questions are rendered once, their text being already converted to html when processed (see GiftQuestion.load())
+        self.html_src = ''.join(question.to_html(feedback_option) for question in self.questions)
+        if self.questions and self.html_src == '': # fallback when question is not yet properly formated
+            self.html_src = '<p>'+self.src+'</p>'
+        return self.html_src
 
 
     def toEdxProblemsList(self):
@@ -252,10 +493,14 @@ class AnyActivity(Subsection):
 
         :rtype: texte string of xml code
         """
-        edx_xml_problem_list = ""
+        buf = utils.StringBuffer()
+        self.writeEdxProblemsList(buf)
+        return buf.getvalue()
+
+    def writeEdxProblemsList(self, fp):
+        """Writes xml source code of all the questions in EDX XML format to the file object 'fp' """
         for question in self.questions:
-            edx_xml_problem_list += '\n'+toEDX.toEdxProblemXml(question)+'\n'
-        return edx_xml_problem_list
+            fp.write('\n'+toEDX.toEdxProblemXml(question)+'\n')
 
 
     def toXMLMoodle(self):
@@ -274,39 +519,42 @@ class AnyActivity(Subsection):
 
 class Comprehension(AnyActivity):
     """Subclass of AnyActivity defining a 'compréhension' type of activity"""
-    actnum = 0 # specific counter for this subclass of AnyActivity
-    def __init__(self, section, src):
-        AnyActivity.__init__(self,section,src)
+    __slots__ = ()
+
+    def __init__(self, section, context):
+        AnyActivity.__init__(self,section,context)
         self.title = 'Compréhension'
         self.folder = 'Comprehension'
-        Comprehension.actnum+=1
+        context.countActivity(self)
 
 class Activite(AnyActivity):
     """Subclass of AnyActivity defining a simple 'activité' type of activity"""
-    actnum = 0  # specific counter for this subclass of AnyActivity
-    def __init__(self, section, src):
-        AnyActivity.__init__(self,section,src)
+    __slots__ = ()
+
+    def __init__(self, section, context):
+        AnyActivity.__init__(self,section,context)
         self.title = 'Activité'
         self.folder = 'Activite'
-        Activite.actnum+=1
+        context.countActivity(self)
 
 class ActiviteAvancee(AnyActivity):
     """Subclass of AnyActivity defining an 'activité avancée' type of activity"""
-    actnum = 0  # specific counter for this subclass of AnyActivity
-    def __init__(self, section, src):
-        AnyActivity.__init__(self,section,src)
+    __slots__ = ()
+
+    def __init__(self, section, context):
+        AnyActivity.__init__(self,section,context)
         self.title = 'Activité avancée'
         self.folder = 'ActiviteAvancee'
-        ActiviteAvancee.actnum+=1
+        context.countActivity(self)
 
-class Section:
+class Section(object):
     """Class defining the section level in the course module model of Esc@pad
 
     :param  title:  text string title
     :type title: string
 
-    :param  f:  module source file pointer
-    :type f: File
+    :param  context:  context of the module parsing
+    :type context: ParseContext
 
     :param  module:  text string of the module name
     :type module: string
@@ -314,66 +562,69 @@ class Section:
     :param  base_url:  base url for building absolute paths for relative media (default: DEFAULT_BASE_URL defined in model.py)
     :type base_url: string
     """
-    num = 1
+    __slots__ = ('title', 'subsections', 'num', 'module', 'base_url', 'lastLine')
 
-    def __init__(self,title,f,module, base_url=DEFAULT_BASE_URL):
+    def __init__(self,title,context,module, base_url=DEFAULT_BASE_URL):
         self.title = title
         self.subsections = []
-        self.num = str(Section.num)
+        self.num = context.newSectionNum()
         self.module = module
         self.base_url = base_url
-        self.parse(f)
-        Section.num +=1
-        Subsection.num=1
+        self.parse(context)
 
-    def parse(self, f):
-        """Read lines in file pointer 'f' until the start of a new section. If the start of a new subsection or new activity is detected, parsing is continued in corresponding subsection parse method that returns the newly created object
+    def parse(self, context):
+        """Read tokens until the start of a new section. If the start of a new subsection or new activity is detected, parsing is continued in corresponding subsection parse method that returns the newly created object
         """
-        body = ''
-        self.lastLine = f.readline()
-        while self.lastLine:
+        body = [] # tokens of the lines of text not belonging to a subsection yet
+        token = context.read()
+        while token:
             # is it a new section ?
-            match = reStartSection.match(self.lastLine)
-            if match:
+            if token.kind == TOKEN_SECTION:
                 # for sections with only text:
-                if body and not body.isspace():
-                    self.subsections.append(Cours(self,src=body))
+                self.addCours(body, context)
+                context.pushBack(token)
                 break
+            # is it a new subsection ?
+            elif token.kind == TOKEN_SUBSECTION:
+                # should I create a subsection (text just below a section
+                # or between activities
+                self.addCours(body, context)
+                #parsing is then continued in Cours parse method, that pushes back the token ending the subsection
+                sub = Cours(self,context,title=token.value)
+                self.subsections.append(sub)
+                context.indexSubsection(sub, token)
+                body = []
+            # is it an activity
+            elif token.kind == TOKEN_ACTIVITY:
+                # should I create a subsection (text just below a section
+                # or between activities
+                if self.addCours(body, context):
+                    body = []
+                sub = token.value(self,context)
+                self.subsections.append(sub)
+                context.indexSubsection(sub, token)
             else:
-                # is it a new subsection ?
-                match = reStartSubsection.match(self.lastLine)
-                if match :
-                    # should I create a subsection (text just below a section
-                    # or between activities
-                    if body and not body.isspace():
-                        self.subsections.append(Cours(self,src=body))
-                    sub = Cours(self,file=f,title=match.group('title')) #parsing is then continued in Cours parse method,
-                    self.subsections.append(sub)
-                    # The next line is the last line read in the parse of the subsection
-                    self.lastLine = sub.lastLine
-                    body = ''
-                else:
-                    # is it an activity
-                    match = reStartActivity.match(self.lastLine)
-                    if match :
-                        act = goodActivity(match)
-                        if act:
-                            # should I create a subsection (text just below a section
-                            # or between activities
-                            if body and not body.isspace():
-                                self.subsections.append(Cours(self,src=body))
-                                body = ''
-                            self.subsections.append(act(self,f))
-                            # read a new line after the end of blocks
-                            self.lastLine = f.readline()
-                        else:
-                            logging.warning ("Unknown activity type %s",self.lastLine)
-                            body += self.lastLine
-                            self.lastLine = f.readline()
-                    else:
-                        # no match, add the line to the body and read a new line
-                        body += self.lastLine
-                        self.lastLine = f.readline()
+                if token.kind == TOKEN_FENCE:
+                    logging.warning ("Unknown activity type %s",token.line)
+                # no match, add the line to the body
+                body.append(token)
+            token = context.read()
+        self.lastLine = token.line if token else ''
+
+    def addCours(self, body, context):
+        """Creates a Cours subsection from the lines of text found outside of any subsection, unless they are blank.
+
+        :param body: list of the tokens of the lines of text
+        :param context: context of the module parsing
+        :rtype: True if a Cours has been added
+        """
+        src = ''.join(token.line for token in body)
+        if src and not src.isspace():
+            sub = Cours(self,context,src=src)
+            self.subsections.append(sub)
+            context.indexSubsection(sub, body[0], body[-1])
+            return True
+        return False
 
     # FIXME: is this usefull ??
     def toHTML(self, feedback_option=False):
@@ -388,45 +639,65 @@ class Section:
 
         :rtype: a string concatenating subsections HTML output
         """
-        courseHTML = ""
+        buf = utils.StringBuffer()
+        self.writeCourseHTML(buf)
+        return buf.getvalue()
+
+    def writeCourseHTML(self, fp):
+        """Writes the HTML output of Cours subsections to the file object 'fp' """
         for sub in self.subsections:
             if isinstance(sub, Cours):
-                courseHTML += "\n\n<!-- Subsection "+sub.num+" -->\n"
-                courseHTML += markdown.markdown(sub.src, MARKDOWN_EXT)
-        return courseHTML
+                fp.write("\n\n<!-- Subsection "+sub.num+" -->\n")
+                fp.write(utils.render_markdown(sub.src))
 
     def toGift(self):
         """Returns a concatenation (text string) of the GIFT source code of all questions of all activities in this section"""
-        allGifts = ""
+        buf = utils.StringBuffer()
+        self.writeGift(buf)
+        return buf.getvalue()
+
+    def writeGift(self, fp, build_state=None):
+        """Writes the GIFT source code of all questions of all activities in this section to the file object 'fp'. If given, build_state
+        (see buildState.py) provides the code of the activities unchanged since the last build"""
         for sub in self.subsections:
             if isinstance(sub, AnyActivity):
                 # Add category here
-                allGifts += "\n$CATEGORY: $course$/Quiz Bank '"+sub.num+' '+sub.title+"'\n\n"
-                allGifts += sub.toGift()
-        return allGifts
+                fp.write("\n$CATEGORY: $course$/Quiz Bank '"+sub.num+' '+sub.title+"'\n\n")
+                if build_state:
+                    fp.write(build_state.toGift(sub))
+                else:
+                    sub.writeGift(fp)
 
     def toVideoList(self):
         """Returns a text string containing all iframe code of all videos in this section"""
-        video_list = ""
+        buf = utils.StringBuffer()
+        self.writeVideoList(buf)
+        return buf.getvalue()
+
+    def writeVideoList(self, fp):
+        """Writes all iframe code of all videos in this section to the file object 'fp' """
         for sub in self.subsections:
             if isinstance(sub, Cours) and len(sub.videos) > 0:
-                video_list += sub.videoIframeList()
-        return video_list
+                sub.writeVideoIframeList(fp)
 
     def toEdxProblemsList(self):
         """Returns the xml source code (string) of all questions in EDX XML format"""
-        edx_xml_problem_list = ""
+        buf = utils.StringBuffer()
+        self.writeEdxProblemsList(buf)
+        return buf.getvalue()
+
+    def writeEdxProblemsList(self, fp):
+        """Writes the xml source code of all questions in EDX XML format to the file object 'fp' """
         for sub in self.subsections:
             if isinstance(sub, AnyActivity):
                 # add subsection title
-                edx_xml_problem_list += "<!-- "+sub.num+" "+sub.title+" -->\n\n"
-                edx_xml_problem_list += sub.toEdxProblemsList()
-        return edx_xml_problem_list
+                fp.write("<!-- "+sub.num+" "+sub.title+" -->\n\n")
+                sub.writeEdxProblemsList(fp)
 
 class Module:
     """ Module structure.
 
-    :param  f:  module source file pointer
+    :param  f:  module source file pointer. If None, nothing is parsed and sections can be parsed one at a time with iterSections()
     :type f: File
 
     :param  module:  module name
@@ -439,7 +710,6 @@ class Module:
 
     def __init__(self,f, module, base_url=DEFAULT_BASE_URL):
         self.sections = []
-        Section.num = 1
         self.module = module
         self.ims_archive_path = ''
         self.language = 'fr'
@@ -448,30 +718,25 @@ class Module:
         self.author = 'culture numerique'
         self.css = 'http://culturenumerique.univ-lille3.fr/css/base.css'
         self.base_url = base_url
-        self.parse(f)
-        self.act_counter = { c.__name__ : c.actnum for c in [Comprehension, Activite, ActiviteAvancee]}
-
+        if f is not None:
+            self.parse(f)
 
-    def __del__(self):
-        for c in [Comprehension, Activite, ActiviteAvancee]:
-            c.actnum = 0
 
+    def parseHead(self,tokens) :
+        """Called by module.parse() method. Captures meta-data within the first lines of the source file. Stops and return the token of the first line starting with #, which means the start of the first section
 
-    def parseHead(self,f) :
-        """Called by module.parse() method. Captures meta-data within the first lines of the source file. Stops and return the first line starting with #, which means the start of the first section
+        :param  tokens :  token stream of the module source file
+        :type tokens: TokenStream
 
-        :param  f :  module source file pointer
-        :type f: File
-
-        :rtype: string, last line parsed
+        :rtype: Token, last token read (None at the end of the file)
         """
-        l = f.readline()
-        while l and not reEndHead.match(l) :
-            m = reMetaData.match(l)
+        token = tokens.read()
+        while token and token.kind == TOKEN_META :
+            m = token.value
             if m:
                 setattr(self, m.group('meta').lower(), m.group('value'))
-            l = f.readline()
-        return l
+            token = tokens.read()
+        return token
 
     def toJson(self):
         """Returns the JSON representation of the module object. Uses the custom ComplexEncoder class"""
@@ -480,16 +745,94 @@ class Module:
 
 
     def parse(self,f):
-        """Parse module source file, starting by the head to retrieve the meta-data. Read all the lines until the start of a new section (see reStartSection regex). In this case, parsing is continued in Section.parse() method that returns a new Section object and the
-         last line parsed. Parsing goes on until that last line returned is not the start of a new Section.
-        """
-        l = self.parseHead(f) ## up to first section
-        match = reStartSection.match(l)
-        while l and match:
-            s = Section(match.group('title'),f, self.module, self.base_url)
+        """Parse module source file and store all its sections in self.sections (see iterSections())"""
+        for s in self.iterSections(f):
             self.sections.append( s )
-            l = s.lastLine
-            match = reStartSection.match(l)
+
+    def iterSections(self, f):
+        """Parse the head of the module source file to retrieve the meta-data, then return a generator parsing the rest of the file and yielding each Section object as soon as it is parsed.
+        The file is read once through a ParseContext (see tokenize()), that also holds the numbering of this parse only. Read all the tokens until the start of a new section. In this case, parsing is continued in Section.parse() method that returns a new Section object and
+        pushes back the last token read. Parsing goes on until that last token is not the start of a new Section. The act_counter attribute is set once all sections are parsed.
+
+        Sections are not stored in self.sections, so a caller writing each section before asking for the next one only keeps one of them in memory, e.g::
+
+            m = Module(None, 'module1')
+            m.writeGift(gift_file, m.iterSections(md_file))
+
+        :param  f:  module source file pointer
+        :type f: File
+
+        :rtype: generator of Section objects
+        """
+        context = ParseContext(f)
+        self.index = context.index
+        token = self.parseHead(context) ## up to first section
+
+        def sections(token):
+            while token and token.kind == TOKEN_SECTION:
+                section = Section(token.value, context, self.module, self.base_url)
+                context.indexSection(section, token)
+                yield section
+                token = context.read()
+            self.act_counter = context.act_counter
+
+        return sections(token)
+
+    def toIndexJson(self):
+        """Returns the JSON representation of the offset index of the module source file, built by iterSections(): byte offsets ('start', 'end') and line numbers ('line', 'end_line') of each section and of each of its subsections"""
+        return json.dumps({'module': self.module, 'parser_version': PARSER_VERSION, 'sections': self.index},
+                          sort_keys=True, indent=4, separators=(',', ': '))
+
+    def writeIndex(self, fp):
+        """Writes the JSON offset index (see toIndexJson()) to the file object 'fp' """
+        fp.write(self.toIndexJson())
+
+    def readBlock(self, filein, entry):
+        """Returns the text (unicode string) of the block of the source file 'filein' described by the index 'entry', with '\n' line endings as given by tokenize().
+        Only this block is read from the file"""
+        with open(filein, 'rb') as md_file:
+            md_file.seek(entry['start'])
+            block = md_file.read(entry['end'] - entry['start']).decode('utf-8')
+        return block.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+
+    def readSection(self, filein, entry):
+        """Parse only the section described by the index 'entry' (see toIndexJson()) from the source file 'filein', without reading the rest of the file.
+
+        :param  filein:  path of the module source file the index was built from
+        :type filein: string
+
+        :param  entry:  index entry of the section, i.e an item of self.index
+
+        :rtype: Section object, numbered as in a parse of the whole file
+        """
+        context = ParseContext(io.StringIO(self.readBlock(filein, entry)), in_head=False, section_num=int(entry['num'])-1)
+        token = context.read()
+        return Section(token.value, context, self.module, self.base_url)
+
+    def readSubsection(self, filein, section_entry, entry):
+        """Parse only the subsection (lecture or activity) described by the index 'entry' from the source file 'filein'. The returned subsection belongs to a new Section object
+        holding only this subsection.
+
+        :param  filein:  path of the module source file the index was built from
+        :type filein: string
+
+        :param  section_entry:  index entry of the section containing the subsection
+        :param  entry:  index entry of the subsection, i.e an item of section_entry['subsections']
+
+        :rtype: Subsection object, numbered as in a parse of the whole file
+        """
+        src = self.readBlock(filein, entry)
+        section = Section(section_entry['title'], ParseContext(io.StringIO(u''), in_head=False, section_num=int(section_entry['num'])-1), self.module, self.base_url)
+        context = ParseContext(io.StringIO(src), in_head=False, section_num=int(section.num), subsection_num=int(entry['num'].split('-')[1])-1)
+        token = context.read()
+        if token.kind == TOKEN_SUBSECTION:
+            sub = Cours(section, context, title=token.value)
+        elif token.kind == TOKEN_ACTIVITY:
+            sub = token.value(section, context)
+        else: # text found outside of any subsection
+            sub = Cours(section, context, src=src)
+        section.subsections.append(sub)
+        return sub
 
     # FIXME : is it usefull ?
     def toHTML(self, feedback_option=False):
@@ -497,39 +840,93 @@ class Module:
         for s in self.sections:
             s.toHTML(feedback_option)
 
-    def toCourseHTML(self):
+    def toCourseHTML(self, sections=None):
         """Loops through all sections.
 
+        :param sections: iterable of sections to render, e.g iterSections(f) (default self.sections)
+
         :rtype: Returns a string of the concatenation of their HTML output"""
-        courseHTML = ""
-        for sec in self.sections:
-            courseHTML += "\n\n<!-- Section "+sec.num+" -->\n"
-            courseHTML += sec.toCourseHTML()
-        return courseHTML
+        buf = utils.StringBuffer()
+        self.writeCourseHTML(buf, sections)
+        return buf.getvalue()
 
-    def toGift(self):
+    def writeCourseHTML(self, fp, sections=None):
+        """Writes the HTML output of all sections to the file object 'fp' (see toCourseHTML())"""
+        for sec in (self.sections if sections is None else sections):
+            fp.write("\n\n<!-- Section "+sec.num+" -->\n")
+            sec.writeCourseHTML(fp)
+
+    def toGift(self, sections=None):
         """Returns a text string with all questions of all the activities of this modules object.
-            Can be used for import a questions bank into moodle"""
-        questions_bank = ""
-        for s in self.sections:
-            questions_bank += s.toGift()
-        return questions_bank
+            Can be used for import a questions bank into moodle
 
-    def toVideoList(self):
-        """Returns a text string with all video iframe codes """
-        video_list = ""
+        :param sections: iterable of sections to export, e.g iterSections(f) (default self.sections)
+        """
+        buf = utils.StringBuffer()
+        self.writeGift(buf, sections)
+        return buf.getvalue()
+
+    def writeGift(self, fp, sections=None, build_state=None):
+        """Writes all questions of all the activities of this module to the file object 'fp' (see toGift() and Section.writeGift())"""
+        for s in (self.sections if sections is None else sections):
+            s.writeGift(fp, build_state)
+
+    def loadQuestions(self, index=None, sections=None):
+        """Processes the questions of all the activities of this module not processed yet, through the questions index 'index' if given (see AnyActivity.loadQuestions())
+
+        :param sections: iterable of sections whose questions are processed (default self.sections)
+        """
+        for s in (self.sections if sections is None else sections):
+            for sub in s.subsections:
+                if isinstance(sub, AnyActivity):
+                    sub.loadQuestions(index)
+
+    def getLoadedQuestions(self):
+        """Returns a dict mapping the number of each activity of this module whose questions are processed to the list of its questions"""
+        return dict((sub.num, sub._questions) for s in self.sections for sub in s.subsections
+                    if isinstance(sub, AnyActivity) and hasattr(sub, '_questions'))
+
+    def setLoadedQuestions(self, questions):
+        """Gives the activities of this module their questions processed before, as returned by getLoadedQuestions()"""
         for s in self.sections:
-            video_list += s.toVideoList()+'\n\n'
-        return video_list
+            for sub in s.subsections:
+                if sub.num in questions and isinstance(sub, AnyActivity):
+                    sub._questions = questions[sub.num]
+
+    def toVideoList(self, sections=None):
+        """Returns a text string with all video iframe codes
+
+        :param sections: iterable of sections to export, e.g iterSections(f) (default self.sections)
+        """
+        buf = utils.StringBuffer()
+        self.writeVideoList(buf, sections)
+        return buf.getvalue()
+
+    def writeVideoList(self, fp, sections=None):
+        """Writes all video iframe codes to the file object 'fp' (see toVideoList())"""
+        for s in (self.sections if sections is None else sections):
+            s.writeVideoList(fp)
+            fp.write('\n\n')
 
     # FIXME: should use a template file
-    def toEdxProblemsList(self):
-        """Returns the xmlL source code of all questions in EDX XML. Usefull for importing a library of problems into EDX. *depends on toEDX.py module*"""
-        edx_xml_problem_list = '<library xblock-family="xblock.v1" display_name="'+self.module+'_'+self.menutitle+'" org="ULille3" library="'+self.module+'_'+self.menutitle+'">\n\n"'
-        for s in self.sections:
-            edx_xml_problem_list += s.toEdxProblemsList()
-        edx_xml_problem_list += "\n</library>"
-        return edx_xml_problem_list
+    def toEdxProblemsList(self, sections=None):
+        """Returns the xmlL source code of all questions in EDX XML. Usefull for importing a library of problems into EDX. *depends on toEDX.py module*
+
+        :param sections: iterable of sections to export, e.g iterSections(f) (default self.sections)
+        """
+        buf = utils.StringBuffer()
+        self.writeEdxProblemsList(buf, sections)
+        return buf.getvalue()
+
+    def writeEdxProblemsList(self, fp, sections=None):
+        """Writes the EDX library of all questions to the file object 'fp' (see toEdxProblemsList())"""
+        fp.write('<library xblock-family="xblock.v1" display_name="'+self.module+'_'+self.menutitle+'" org="ULille3" library="'+self.module+'_'+self.menutitle+'">\n\n"')
+        for s in (self.sections if sections is None else sections):
+            s.writeEdxProblemsList(fp)
+        fp.write("\n</library>")
+
+# Activity registry used by tokenize(), built once all activity classes are defined
+ACTIVITY_TYPES.update((act.__name__, act) for act in [Comprehension, Activite, ActiviteAvancee])
 
 # param syntax
 # :param mode: Specifies the mode of transport to use when calculating
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+######################################################################################
+#
+#    On-disk cache of parsed modules. A module object built by model.Module is
+#    pickled under a key made of the hash of its markdown source, the parser version,
+#    the module name and the base url, so that unchanged modules are not parsed again
+#    from one build to the next. The questions of its activities are pickled apart under
+#    the same key once processed, so that they are not processed again either.
+#
+######################################################################################
+
+import hashlib
+import logging
+import os
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import model
+
+DEFAULT_MAX_SIZE = 100*1024*1024 # in bytes
+CACHE_SUFFIX = '.module.pickle'
+QUESTIONS_SUFFIX = '.questions.pickle'
+
+
+class ParseCache:
+    """ Directory of pickled module objects and of their questions, evicting least recently used entries when its size goes above max_size
+
+    :param cache_dir: path of the cache directory (created if needed)
+    :type cache_dir: string
+
+    :param max_size: maximum size in bytes of all cached entries (default DEFAULT_MAX_SIZE)
+    :type max_size: int
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def getKey(self, filein, module, base_url):
+        """ returns the cache key of markdown file 'filein' parsed as module 'module' with 'base_url' """
+        h = hashlib.sha1()
+        for part in (model.PARSER_VERSION, module, base_url):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        with open(filein, 'rb') as md_file:
+            for chunk in iter(lambda: md_file.read(65536), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def getPath(self, key, suffix=CACHE_SUFFIX):
+        return os.path.join(self.cache_dir, key+suffix)
+
+    def load(self, key):
+        """ returns the module object stored under 'key', with the questions stored by storeQuestions() if any, None if there is none (or if it cannot be read) """
+        module_obj = self.read(self.getPath(key))
+        if module_obj is None:
+            return None
+        questions = self.read(self.getPath(key, QUESTIONS_SUFFIX))
+        if questions is not None:
+            module_obj.setLoadedQuestions(questions)
+        logging.info("[parseCache] hit for module %s, %d activities with their questions", module_obj.module, len(questions or {}))
+        return module_obj
+
+    def read(self, path):
+        """ returns the object pickled in the entry 'path', None if there is none (or if it cannot be read) """
+        try:
+            with open(path, 'rb') as cache_file:
+                obj = pickle.load(cache_file)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            logging.warning("[parseCache] removing unreadable cache entry %s", path)
+            self.remove(path)
+            return None
+        # mark as recently used for eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return obj
+
+    def store(self, key, module_obj):
+        """ pickle 'module_obj' under 'key', then evict old entries if needed """
+        if not self.write(self.getPath(key), module_obj):
+            return False
+        self.evict()
+        return True
+
+    def storeQuestions(self, key, module_obj):
+        """ pickle the questions processed so far for the activities of 'module_obj' under 'key' (see model.Module.getLoadedQuestions()),
+        then evict old entries if needed """
+        if not self.write(self.getPath(key, QUESTIONS_SUFFIX), module_obj.getLoadedQuestions()):
+            return False
+        self.evict()
+        return True
+
+    def write(self, path, obj):
+        """ pickle 'obj' in the entry 'path'. The file is written under a temporary name and renamed, so that concurrent builds never read a partial entry """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                pickle.dump(obj, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except Exception:
+            logging.exception("[parseCache] cannot write cache entry %s", path)
+            self.remove(tmp_path)
+            return False
+        return True
+
+    def evict(self):
+        """ remove least recently used entries until the cache fits in max_size """
+        entries = []
+        total_size = 0
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith((CACHE_SUFFIX, QUESTIONS_SUFFIX)):
+                path = os.path.join(self.cache_dir, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+        entries.sort()
+        while total_size > self.max_size and entries:
+            mtime, size, path = entries.pop(0)
+            logging.info("[parseCache] evicting %s", path)
+            self.remove(path)
+            total_size -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
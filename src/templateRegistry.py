@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+######################################################################################
+#
+#    Registry of the Jinja templates of the site and of the EDX archives, shared by
+#    the whole process. Templates are loaded and compiled once (auto_reload is off
+#    unless asked for), and their compiled bytecode can be kept between builds in a
+#    cache directory. They can also be compiled ahead of time into python modules
+#    (see compileTemplates()), which are then loaded without any parsing.
+#
+######################################################################################
+
+import argparse
+import io
+import logging
+import os
+import sys
+import threading
+
+from jinja2 import ChoiceLoader, Environment, FileSystemBytecodeCache, FileSystemLoader, ModuleLoader
+
+import utils
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+TEMPLATES_PATH = os.path.join(BASE_PATH, 'templates')
+EDX_TEMPLATES_PATH = os.path.join(TEMPLATES_PATH, 'toEDX')
+# templates are looked for in the site templates, then in the EDX ones, so both can be named as in their own folder
+SEARCH_PATH = [TEMPLATES_PATH, EDX_TEMPLATES_PATH]
+TEMPLATE_EXTENSIONS = ('html', 'xml', 'json') # files of SEARCH_PATH compiled by compileTemplates()
+STREAM_BUFFER_EVENTS = 64 # pieces of output joined by the template streams before being written
+FILE_BUFFER_SIZE = 64*1024 # buffer of the files written by renderToFile()
+
+_settings = {'bytecode_dir': None, 'compiled_dir': None, 'auto_reload': False}
+_environment = None
+_lock = threading.Lock()
+
+
+def configure(bytecode_dir=None, compiled_dir=None, auto_reload=False):
+    """ Set up the templates registry, before the templates are used
+
+    :param bytecode_dir: directory where the bytecode of the templates is kept between builds (None for no bytecode cache)
+    :param compiled_dir: directory of the templates compiled by compileTemplates(), loaded first (None to compile all templates from source)
+    :param auto_reload: whether templates are checked for changes each time they are used (useful when editing them only)
+    """
+    global _environment
+    with _lock:
+        _settings.update(bytecode_dir=bytecode_dir, compiled_dir=compiled_dir, auto_reload=auto_reload)
+        _environment = None
+
+
+def createEnvironment(bytecode_dir=None, compiled_dir=None, auto_reload=False):
+    """ returns a new Jinja environment loading the templates of SEARCH_PATH, with the filters they use (see configure() for the parameters) """
+    loader = FileSystemLoader(SEARCH_PATH)
+    if compiled_dir:
+        loader = ChoiceLoader([ModuleLoader(compiled_dir), loader])
+    bytecode_cache = None
+    if bytecode_dir:
+        if not os.path.isdir(bytecode_dir):
+            os.makedirs(bytecode_dir)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+    jenv = Environment(loader=loader, bytecode_cache=bytecode_cache, auto_reload=auto_reload)
+    jenv.filters['slugify'] = utils.cnslugify
+    jenv.filters['tohtml'] = utils.cntohtml
+    return jenv
+
+
+def getEnvironment():
+    """ returns the Jinja environment shared by the process, created on first use """
+    global _environment
+    with _lock:
+        if _environment is None:
+            _environment = createEnvironment(**_settings)
+        return _environment
+
+
+def getTemplate(name):
+    """ returns the compiled template 'name' (path in the site or EDX templates folder), loaded once for the process """
+    return getEnvironment().get_template(name)
+
+
+def streamTemplate(name, **context):
+    """ returns an iterator over the output of the template 'name' rendered with 'context', encoded in utf-8, piece by piece, without the whole output in memory """
+    stream = getTemplate(name).stream(**context)
+    stream.enable_buffering(STREAM_BUFFER_EVENTS)
+    return (chunk.encode('utf-8') for chunk in stream)
+
+
+def renderToFile(name, filename, **context):
+    """ render the template 'name' with 'context' straight into the file 'filename', in utf-8 """
+    with io.open(filename, 'wb', buffering=FILE_BUFFER_SIZE) as outfile:
+        outfile.writelines(streamTemplate(name, **context))
+    return filename
+
+
+def compileTemplates(target, zip=None):
+    """ compile all the templates of SEARCH_PATH into python modules in the directory (or zip file if 'zip' is 'deflated' or 'stored') 'target',
+    to be loaded by configure(compiled_dir=target). They must be compiled again whenever a template changes """
+    jenv = createEnvironment()
+    jenv.compile_templates(target, extensions=TEMPLATE_EXTENSIONS, zip=zip, ignore_errors=False,
+                           log_function=logging.info)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Compiles ahead of time the Jinja templates of the site and of the EDX archives, to be used with the --compiled-templates option of cnExport.py")
+    parser.add_argument("target", help="Directory of the compiled templates")
+    args = parser.parse_args(argv[1:])
+    compileTemplates(args.target)
+    print("templates compiled in %s" % args.target)
+
+
+############### main ################
+if __name__ == "__main__":
+    main(sys.argv)
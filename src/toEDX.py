@@ -6,24 +6,23 @@ import json
 import os
 import sys
 import logging
-import shutil
 import glob
-import tarfile
 
 from lxml import etree
 from lxml import html
 import markdown
 from lxml.html.clean import Cleaner
 from io import open
-from jinja2 import Template, Environment, FileSystemLoader
 
+import archives
 import utils
 import model
+import templateRegistry
 
 
 MARKDOWN_EXT = ['markdown.extensions.extra', 'superscript']
 BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
-EDX_TEMPLATES_PATH = os.path.join(BASE_PATH, 'templates', 'toEDX' )
+EDX_TEMPLATES_PATH = templateRegistry.EDX_TEMPLATES_PATH
 EDX_DEFAULT_FILES = {
     'about':'overview.html',
     'assets':'assets.xml',
@@ -38,63 +37,84 @@ EDX_GRADER_MAP = {
     'webcontent': None,
 }
 
-def loadJinjaEnv():
-    jenv = Environment(loader=FileSystemLoader(EDX_TEMPLATES_PATH))
-    jenv.filters['slugify'] = utils.cnslugify
-    jenv.filters['tohtml'] = utils.cntohtml
-    return jenv
-
 def toEdxProblemXml(question):
-    """ given a question object, return EDX Xml """
-    jenv = loadJinjaEnv()
-    problem_template = jenv.get_template("edx_problem_template.xml")
-    return problem_template.render(q=question)
+    """ given a question object, return EDX Xml (rendered once for each question, the script of essays using its id) """
+    return question.output(('edx', question.id), lambda: renderEdxProblemXml(question))
+
+def renderEdxProblemXml(question):
+    return templateRegistry.getTemplate("edx_problem_template.xml").render(q=question)
+
+
+EDX_ARCHIVE_ROOT = 'EDX' # folder of the files in the EDX archive
+EDX_POLICIES_FILES = ['grading_policy.json', 'policy.json'] # templates of policies/course, rendered for each module
+
+_skeleton = None
+
+def loadSkeleton():
+    """ returns the static files of EDX archives, read once from the folders EDX_DEFAULT_FILES of the templates, as a list of (path in the archive, bytes) """
+    global _skeleton
+    if _skeleton is None:
+        skeleton = []
+        rendered = [os.path.join('policies', 'course', pfile) for pfile in EDX_POLICIES_FILES]
+        for folder in sorted(EDX_DEFAULT_FILES):
+            for dirpath, dirnames, filenames in os.walk(os.path.join(EDX_TEMPLATES_PATH, folder)):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    path = os.path.relpath(os.path.join(dirpath, filename), EDX_TEMPLATES_PATH)
+                    if path not in rendered:
+                        with open(os.path.join(dirpath, filename), 'rb') as skeleton_file:
+                            skeleton.append((path.replace(os.sep, '/'), skeleton_file.read()))
+        _skeleton = skeleton
+    return _skeleton
 
 
-def generateEDXArchive(module, moduleOutDir):
-    """ Given a module object and destination dir, generate EDX archive """
+def generateEDXArchive(module, moduleOutDir, build_state=None, compress_level=None, compress_workers=1, write_tree=False):
+    """ Given a module object and destination dir, generate EDX archive, compressed with compress_level by compress_workers threads (see archives.openTarGz()).
+    Files are rendered in memory and written straight into the archive, the static ones being taken from loadSkeleton(). If write_tree is True, they are also
+    written in moduleOutDir/EDX, for debugging. If given, build_state (see buildState.py) provides the problems of the activities unchanged since the last build, whose questions are not processed """
 
     # Module data
     module.advanced_EDX_module_list = EDX_ADVANCED_MODULE_LIST.__str__()
 
-    # create EDX archive temp folder
-    edx_outdir = os.path.join(moduleOutDir, 'EDX')
-    os.makedirs(edx_outdir)
-
-    # generate content files: html/webcontent | problem/(Activite|ActiviteAvancee|Comprehension)
-    for sec in module.sections:
-        for sub in sec.subsections:
-            if sub.folder == 'webcontent': # these go to EDX/html/
-                utils.write_file(sub.html_src, edx_outdir, 'html', sub.getFilename() )
-            elif sub.folder in ('Activite', 'ActiviteAvancee', 'Comprehension'):
-                for question in sub.questions:
-                    fname =  ('%s.xml' % question.id)
-                    utils.write_file(toEdxProblemXml(question), edx_outdir, 'problem', fname )
-
-    # Add other files
-    for folder, dfile in EDX_DEFAULT_FILES.items():
-        shutil.copytree(os.path.join(EDX_TEMPLATES_PATH, folder), os.path.join(edx_outdir,folder))
-
-    # Render and add policies/course files
-    course_policies_files =  ['grading_policy.json', 'policy.json']
-
-    jenv = loadJinjaEnv()
-    for pfile in course_policies_files:
-        pfile_template = jenv.get_template(os.path.join('policies','course', pfile))
-        pjson = pfile_template.render(module=module)
-        pjson = json.dumps(json.loads(pjson),ensure_ascii=True,indent=4,separators=(',', ': '))
-        utils.write_file(pjson, os.getcwd(), os.path.join(edx_outdir, 'policies', 'course'), pfile)
-
-    # Write main course.xml file
-    course_template = jenv.get_template("course.tmpl.xml")
-    course_xml = course_template.render(module=module, grademap=EDX_GRADER_MAP)
-    utils.write_file(course_xml, os.getcwd(), edx_outdir, 'course.xml')
-
-    # pack it up into a tar archive
-    archive_file = os.path.join(moduleOutDir, ('%s_edx.tar.gz' % module.module))
-    with tarfile.open(archive_file, "w:gz") as tar:
-        for afile in os.listdir(edx_outdir):
-            tar.add(os.path.join(edx_outdir, afile))
-    tar.close()
-
-    return ('%s_edx.tar.gz' % module.module)
+    archive_name = '%s_edx.tar.gz' % module.module
+    with archives.openTarGz(os.path.join(moduleOutDir, archive_name), compress_level, compress_workers) as tar:
+        def add(path, data):
+            """ data: bytes, or binary file object (see archives.addTarMember()) """
+            if write_tree:
+                folder, name = os.path.split(path)
+                if not isinstance(data, bytes):
+                    data = data.read()
+                utils.write_file(data, os.path.join(moduleOutDir, EDX_ARCHIVE_ROOT), folder, name)
+            archives.addTarMember(tar, EDX_ARCHIVE_ROOT+'/'+path, data)
+
+        # content files: html/webcontent | problem/(Activite|ActiviteAvancee|Comprehension)
+        problem_ids = {} # subsection number -> ids of its problems, listed in course.xml
+        for sec in module.sections:
+            for sub in sec.subsections:
+                if sub.folder == 'webcontent': # these go to EDX/html/
+                    add('html/'+sub.getFilename(), sub.html_src.encode('utf-8'))
+                elif sub.folder in ('Activite', 'ActiviteAvancee', 'Comprehension'):
+                    if build_state:
+                        problems = build_state.toEdxProblems(sub, toEdxProblemXml)
+                    else:
+                        problems = [(question.id, toEdxProblemXml(question)) for question in sub.questions]
+                    problem_ids[sub.num] = [problem_id for problem_id, problem_xml in problems]
+                    for problem_id, problem_xml in problems:
+                        add('problem/%s.xml' % problem_id, problem_xml.encode('utf-8'))
+
+        # Add other files
+        for path, data in loadSkeleton():
+            add(path, data)
+
+        # Render and add policies/course files
+        for pfile in EDX_POLICIES_FILES:
+            pfile_template = templateRegistry.getTemplate('policies/course/'+pfile)
+            pjson = pfile_template.render(module=module)
+            pjson = json.dumps(json.loads(pjson),ensure_ascii=True,indent=4,separators=(',', ': '))
+            add('policies/course/'+pfile, pjson.encode('utf-8'))
+
+        # Write main course.xml file, streamed into the archive
+        with archives.spoolChunks(templateRegistry.streamTemplate("course.tmpl.xml", module=module, grademap=EDX_GRADER_MAP, problem_ids=problem_ids)) as course_xml:
+            add('course.xml', course_xml)
+
+    return archive_name
@@ -2,11 +2,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals    # at top of module
 
+import io
 import json
 import logging
 import os
 import sys
-import zipfile
 import random
 from io import open
 
@@ -17,6 +17,7 @@ from pprint import pprint
 from yattag import indent
 from yattag import Doc
 
+import archives
 import model
 import utils
 
@@ -69,9 +70,9 @@ IMS_HEADER = """<?xml version="1.0" encoding="UTF-8"?><manifest xmlns="http://ww
     xmlns:lomimscc="http://ltsc.ieee.org/xsd/imsccv1p1/LOM/manifest" xmlns:lom="http://ltsc.ieee.org/xsd/imsccv1p1/LOM/resource" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" identifier="M_3E1AEC6D" xsi:schemaLocation="http://www.imsglobal.org/xsd/imsccv1p1/imscp_v1p1 http://www.imsglobal.org/profile/cc/ccv1p1/ccv1p1_imscp_v1p2_v1p0.xsd http://ltsc.ieee.org/xsd/imsccv1p1/LOM/manifest http://www.imsglobal.org/profile/cc/ccv1p1/LOM/ccv1p1_lommanifest_v1p0.xsd http://ltsc.ieee.org/xsd/imsccv1p1/LOM/resource http://www.imsglobal.org/profile/cc/ccv1p1/LOM/ccv1p1_lomresource_v1p0.xsd">
     """
 
-HEADER_TEST = """<?xml version="1.0" encoding="UTF-8"?>
-    <questestinterop xmlns="http://www.imsglobal.org/xsd/ims_qtiasiv1p2" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemalocation="http://www.imsglobal.org/xsd/ims_qtiasiv1p2 http://www.imsglobal.org/profile/cc/ccv1p1/ccv1p1_qtiasiv1p2p1_v1p0.xsd">
-    """
+# Constant parts of the IMS QTI tests, serialized once (see write_ims_test())
+HEADER_TEST = b'<?xml version="1.0" encoding="UTF-8"?>\n<questestinterop xmlns="http://www.imsglobal.org/xsd/ims_qtiasiv1p2" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemalocation="http://www.imsglobal.org/xsd/ims_qtiasiv1p2 http://www.imsglobal.org/profile/cc/ccv1p1/ccv1p1_qtiasiv1p2p1_v1p0.xsd">'
+FOOTER_TEST = b'</questestinterop>\n'
 
 DEFAULT_QTI_META = {
     'cc_profile' : 'cc.exam.v0p1',
@@ -83,177 +84,204 @@ DEFAULT_QTI_META = {
     'cc_maxattempts':'unlimited'
 }
 
-def set_qti_metadata(max_attempts):
-
-    meta, tag, text = Doc().tagtext()
-    meta.asis("<!--  Metadata  -->")
-    metadata = DEFAULT_QTI_META
-    metadata['cc_maxattempts'] = max_attempts
-    with tag('qtimetadata'):
-        for key, value in metadata.iteritems():
-            with tag('qtimetadatafield'):
-                with tag('fieldlabel'):
-                    text(key)
-                with tag('fieldentry'):
-                    text(value)
+_qti_metadata = {} # max_attempts -> serialized metadata of a test
+
+def qti_metadata(max_attempts):
+    """ returns the serialized metadata of a test allowing max_attempts attempts, built once for each value """
+    max_attempts = unicode(max_attempts)
+    try:
+        return _qti_metadata[max_attempts]
+    except KeyError:
+        pass
+    metadata = etree.Element('qtimetadata')
+    for key, value in DEFAULT_QTI_META.iteritems():
+        field = etree.SubElement(metadata, 'qtimetadatafield')
+        etree.SubElement(field, 'fieldlabel').text = key
+        etree.SubElement(field, 'fieldentry').text = max_attempts if key == 'cc_maxattempts' else value
+    fragment = _qti_metadata[max_attempts] = etree.tostring(etree.Comment('  Metadata  '))+etree.tostring(metadata, encoding='utf-8')
+    return fragment
+
+def _rubric():
+    rubric = etree.Element('rubric')
+    etree.SubElement(etree.SubElement(rubric, 'material', label='Summary'), 'mattext', texttype='text/html').text = ''
+    return etree.tostring(rubric, encoding='utf-8')
+
+RUBRIC_TEST = _rubric()
+
+# Constant elements of the items
+OUTCOMES_DECVAR = etree.Element('decvar', varname='SCORE', vartype='Decimal', minvalue='0', maxvalue='100')
+CONDITION_OTHER = etree.Element('other')
+RENDER_FIB = etree.Element('render_fib', rows='5', prompt='Box', fibtype='String')
+
+def flat(value):
+    """ returns value as a single line of text: new lines are dropped from the texts of the tests because of a bug in moodle that turns them in <br> """
+    return unicode(value).replace('\n', '')
+
+def _field(xf, label, entry):
+    with xf.element('qtimetadatafield'):
+        with xf.element('fieldlabel'):
+            xf.write(label)
+        with xf.element('fieldentry'):
+            xf.write(entry)
+
+def _mattext(xf, html_text):
+    with xf.element('material'):
+        with xf.element('mattext', texttype='text/html'):
+            xf.write(flat(html_text))
+
+def _displayfeedback(xf, linkrefid):
+    xf.write(etree.Element('displayfeedback', feedbacktype='Response', linkrefid=linkrefid))
+
+def write_ims_item(xf, question, idx, test_title):
+    """
+    write with xf (lxml.etree.xmlfile writer) the item of the question at position idx of the test titled test_title, in IMS QTI
+    """
+    response_id = 'response_'+unicode(question.id)
+    answer_id = 'answer_'+unicode(question.id)+'_'
+    with xf.element('item', ident='q_'+unicode(idx), title=flat(question.title)):
+        #<!--  metatata  -->
+        with xf.element('itemmetadata'):
+            with xf.element('qtimetadata'):
+                # default to essay
+                _field(xf, 'cc_profile', CC_PROFILES.get(question.type, CC_PROFILES['ESSAY']))
+                _field(xf, 'cc_question_category', flat('Quiz Bank '+test_title))
+        #Contenu de la question
+        with xf.element('presentation'):
+            # Enoncé
+            _mattext(xf, question.text)
+            # réponses possibles
+            if 'ESSAY' in question.type:
+                with xf.element('response_str', rcardinality='Single', ident=response_id):
+                    xf.write(RENDER_FIB)
+            elif question.type in (('MULTICHOICE', 'MULTIANSWER', 'TRUEFALSE')):
+                # rcardinality optional, but a priori 'Single' form MChoice, 'Multiple' for Manswer;
+                rcardinality = 'Multiple' if question.type == 'MULTIANSWER' else 'Single'
+                with xf.element('response_lid', rcardinality=rcardinality, ident=response_id):
+                    with xf.element('render_choice', shuffle='No'):
+                        for id_a, answer in enumerate(question.answers):
+                            with xf.element('response_label', ident=answer_id+unicode(id_a)):
+                                _mattext(xf, answer.answer_text)
+            else: # FIXME add support for NUMERIC, MATCHING, etc
+                pass
+        # Response Processing
+        with xf.element('resprocessing'):
+            # outcomes: FIXME: allways the same ?
+            with xf.element('outcomes'):
+                xf.write(OUTCOMES_DECVAR)
+            # respconditions pour décrire quelle est la bonne réponse, les interactions, etc
+            if question.global_feedback != '':
+                with xf.element('respcondition', {'title': 'General feedback', 'continue': 'Yes'}):
+                    with xf.element('conditionvar'):
+                        xf.write(CONDITION_OTHER)
+                    _displayfeedback(xf, 'general_fb')
+            ## lister les autres interactions/conditions
+            if question.type in (('MULTICHOICE','TRUEFALSE')):
+                for id_a, answer in enumerate(question.answers):
+                    if answer.is_right:
+                        title = 'Correct'
+                        score = 100
+                    else:
+                        title = ''
+                        score = answer.credit
+                    with xf.element('respcondition', title=title):
+                        with xf.element('conditionvar'):
+                            with xf.element('varequal', respident=response_id): # respoident is id of response_lid element
+                                xf.write(answer_id+unicode(id_a))
+                        with xf.element('setvar', varname='SCORE', action='Set'):
+                            xf.write(unicode(score))
+                        _displayfeedback(xf, 'feedb_'+unicode(id_a))
+            elif question.type == 'MULTIANSWER':
+                # Correct combination
+                with xf.element('respcondition', {'title': 'Correct', 'continue': 'No'}):
+                    with xf.element('conditionvar'):
+                        with xf.element('and'):
+                            for id_a, answer in enumerate(question.answers):
+                                score = 0
+                                try:
+                                    score = float(answer.credit)
+                                except:
+                                    pass
+                                if score <= 0:
+                                    with xf.element('not'):
+                                        with xf.element('varequal', case='Yes', respident=response_id): # respoident is id of response_lid element
+                                            xf.write(answer_id+unicode(id_a))
+                                else:
+                                    with xf.element('varequal', case='Yes', respident=response_id): # respoident is id of response_lid element
+                                        xf.write(answer_id+unicode(id_a))
+                    with xf.element('setvar', varname='SCORE', action='Set'):
+                        xf.write('100')
+                    _displayfeedback(xf, 'general_fb')
+                # default processing in any case
+                for id_a, answer in enumerate(question.answers):
+                    with xf.element('respcondition', {'continue': 'No'}):
+                        with xf.element('conditionvar'):
+                            with xf.element('varequal', respident=response_id, case='Yes'):
+                                xf.write(answer_id+unicode(id_a))
+                        _displayfeedback(xf, 'feedb_'+unicode(id_a))
+            else:
+                pass
+        # liste les feedbacks
+        ## feedback general
+        if question.global_feedback != '':
+            with xf.element('itemfeedback', ident='general_fb'):
+                with xf.element('flow_mat'):
+                    _mattext(xf, question.global_feedback)
+        ## autres feedbacks
+        for id_a, answer in enumerate(question.answers):
+            with xf.element('itemfeedback', ident='feedb_'+unicode(id_a)):
+                with xf.element('flow_mat'):
+                    _mattext(xf, answer.feedback)
+        ## FIXME add wrong and correct feedbacks for TRUEFALSE
+
+def create_ims_item(question, idx, test_title):
+    """
+    returns the item of the question at position idx of the test titled test_title, in IMS QTI, serialized in utf-8 (see write_ims_item())
+    """
+    buf = io.BytesIO()
+    with etree.xmlfile(buf, encoding='utf-8') as xf:
+        write_ims_item(xf, question, idx, test_title)
+    return buf.getvalue()
 
-    return indent(meta.getvalue())
 
 def create_ims_test(questions, test_id, test_title):
     """
     Supported types : ESSAY, MULTICHOICE, MULTIANSWER, TRUEFALSE, DESCRIPTION
 
     """
-    # create magic yattag triple
-    doc, tag, text = Doc().tagtext()
-    doc.asis(HEADER_TEST+'\n')
     if 'ESSAY' in questions[0].type:
         max_attempts = 'unlimited'
     else:
         max_attempts = 1
-    with tag('assessment', ident=test_id, title=test_title):
-        doc.asis(set_qti_metadata(max_attempts))
-        #<!-- Titre de l'execercice  -->
-        with tag('rubric'):
-            with tag('material', label="Summary"):
-                with tag('mattext', texttype="text/html"):
-                    text()
-        # only one section in a test
-        with tag('section', ident='section_1_test_'+test_id):
-        # loop on questions
-            for idx, question in enumerate(questions):
-                with tag('item', ident='q_'+str(idx), title=question.title):
-                    #<!--  metatata  -->
-                    with tag('itemmetadata'):
-                        with tag('qtimetadata'):
-                            with tag('qtimetadatafield'):
-                                with tag('fieldlabel'):
-                                    text("cc_profile")
-                                with tag('fieldentry'):
-                                    try:
-                                        text(CC_PROFILES[question.type])
-                                    except:
-                                        # default to essay
-                                        text(CC_PROFILES['ESSAY'])
-                            with tag('qtimetadatafield'):
-                                with tag('fieldlabel'):
-                                    text("cc_question_category")
-                                with tag('fieldentry'):
-                                    text('Quiz Bank '+test_title)
-                    #Contenu de la question
-                    with tag('presentation'):
-                        # Enoncé
-                        with tag('material'):
-                            with tag('mattext', texttype='text/html'):
-                                text(question.text )
-                        # réponses possibles
-                        if 'ESSAY' in question.type:
-                            with tag('response_str', rcardinality='Single', ident='response_'+str(question.id)):
-                                doc.stag('render_fib', rows=5, prompt='Box', fibtype="String")
-                        elif question.type in (('MULTICHOICE', 'MULTIANSWER', 'TRUEFALSE')):
-                            if question.type == 'MULTIANSWER':
-                                rcardinality = 'Multiple'
-                            else:
-                                rcardinality = 'Single'
-                            # rcardinality optional, but a priori 'Single' form MChoice, 'Multiple' for Manswer;
-                            with tag('response_lid', rcardinality=rcardinality, ident='response_'+str(question.id)):
-                                with tag('render_choice', shuffle='No'):
-                                    for id_a, answer in enumerate(question.answers):
-                                        with tag('response_label', ident='answer_'+str(question.id)+'_'+str(id_a)):
-                                            with tag('material'):
-                                                with tag('mattext', texttype="text/html"):
-                                                    text(answer['answer_text'])
-                        else: # FIXME add support for NUMERIC, MATCHING, etc
-                            pass
-                    # Response Processing
-                    with tag('resprocessing'):
-                        # outcomes: FIXME: allways the same ?
-                        with tag('outcomes'):
-                            doc.stag('decvar', varname='SCORE', vartype='Decimal', minvalue="0", maxvalue="100")
-                        # respconditions pour décrire quelle est la bonne réponse, les interactions, etc
-                        if question.global_feedback != '':
-                            with tag('respcondition', title='General feedback', kontinue='Yes'):
-                                with tag('conditionvar'):
-                                    doc.stag('other')
-                                doc.stag('displayfeedback', feedbacktype="Response", linkrefid='general_fb')
-                        ## lister les autres interactions/conditions
-                        if question.type in (('MULTICHOICE','TRUEFALSE')):
-                            for id_a, answer in enumerate(question.answers):
-                                score = 0
-                                if answer['is_right']:
-                                    title = 'Correct'
-                                    score = 100
-                                else:
-                                    title = ''
-                                    score = answer['credit']
-                                with tag('respcondition', title=title):
-                                    with tag('conditionvar'):
-                                        with tag('varequal', respident='response_'+str(question.id)): # respoident is id of response_lid element
-                                            text('answer_'+str(question.id)+'_'+str(id_a))
-                                    with tag('setvar', varname='SCORE', action='Set'):
-                                        text(score)
-                                    doc.stag('displayfeedback', feedbacktype='Response', linkrefid='feedb_'+str(id_a))
-                        elif question.type == 'MULTIANSWER':
-                            # Correct combination
-                            with tag('respcondition', title="Correct", kontinue='No'):
-                                with tag('conditionvar'):
-                                    with tag('and'):
-                                        for id_a, answer in enumerate(question.answers):
-                                            score = 0
-                                            try:
-                                                score = float(answer['credit'])
-                                            except:
-                                                pass
-                                            if score <= 0:
-                                                with tag('not'):
-                                                    with tag('varequal', case='Yes', respident='response_'+str(question.id)): # respoident is id of response_lid element
-                                                        text('answer_'+str(question.id)+'_'+str(id_a))
-                                            else:
-                                                with tag('varequal', case='Yes', respident='response_'+str(question.id)): # respoident is id of response_lid element
-                                                    text('answer_'+str(question.id)+'_'+str(id_a))
-                                with tag('setvar', varname='SCORE', action='Set'):
-                                    text('100')
-                                doc.stag('displayfeedback', feedbacktype='Response', linkrefid='general_fb')
-                            # default processing in any case
-                            for id_a, answer in enumerate(question.answers):
-                                with tag('respcondition', kontinue='No'):
-                                    with tag('conditionvar'):
-                                        with tag('varequal', respident='response_'+str(question.id), case="Yes"):
-                                            text('answer_'+str(question.id)+'_'+str(id_a))
-                                    doc.stag('displayfeedback', feedbacktype='Response', linkrefid='feedb_'+str(id_a))
-                        else:
-                            pass
-                    # liste les feedbacks
-                    ## feedback general
-                    if question.global_feedback != '':
-                        with tag('itemfeedback', ident='general_fb'):
-                            with tag('flow_mat'):
-                                with tag('material'):
-                                    with tag('mattext', texttype='text/html'):
-                                        text(question.global_feedback)
-                    ## autres feedbacks
-                    for id_a, answer in enumerate(question.answers):
-                        with tag('itemfeedback', ident='feedb_'+str(id_a)):
-                            with tag('flow_mat'):
-                                with tag('material'):
-                                    with tag('mattext', texttype='text/html'):
-                                        text(answer['feedback'])
-                    ## FIXME add wrong and correct feedbacks for TRUEFALSE
-    doc.asis('</questestinterop>\n')
-    doc_value = indent(doc.getvalue().replace('\n', '')) #pre-escaping new lines because of a bug in moodle that turn them in <br>
-    doc_value = doc_value.replace('kontinue', 'continue')
-    return doc_value
+    items = (question.output(('qti', question.id, idx, test_title), lambda: create_ims_item(question, idx, test_title))
+             for idx, question in enumerate(questions))
+    buf = io.BytesIO()
+    write_ims_test(buf, items, test_id, test_title, max_attempts)
+    return buf.getvalue().decode('utf-8')
+
+def write_ims_test(fp, items, test_id, test_title, max_attempts=1):
+    """
+    write to the binary file object fp the IMS QTI test made of items (iterable of xml sources given by create_ims_item()), each item being written as soon as it is given.
+    Only the tags of the assessment and of its section are serialized for each test, the other parts being constant
+    """
+    fp.write(HEADER_TEST)
+    with etree.xmlfile(fp, encoding='utf-8', buffered=False) as xf:
+        with xf.element('assessment', ident=test_id, title=flat(test_title)):
+            fp.write(qti_metadata(max_attempts))
+            #<!-- Titre de l'execercice  -->
+            fp.write(RUBRIC_TEST)
+            # only one section in a test
+            with xf.element('section', ident='section_1_test_'+test_id):
+                for item in items:
+                    fp.write(item)
+    fp.write(FOOTER_TEST)
 
 def create_empty_ims_test(id, num, title, max_attempts):
     """
         create empty imsc test source code
     """
-    src = HEADER_TEST
-    src += '<assessment ident="'+id+'" title="'+num+' '+title+'">\n'
-    src += set_qti_metadata(max_attempts)
-    src += "</assessment></questestinterop>\n"
-
-    return src
+    buf = io.BytesIO()
+    write_ims_test(buf, [], id, num+' '+title, max_attempts)
+    return buf.getvalue().decode('utf-8')
 
 
 def generateIMSManifest(m):
@@ -339,45 +367,33 @@ def generateIMSManifest(m):
     doc.asis("</manifest>") # IMS footer
     return indent(doc.getvalue())
 
-def generateImsArchive(module_object, module_name, module_directory):
-    # Prepare paths and directories
-    cur_dir = os.getcwd()
-    os.chdir(module_directory)
-    ims_outdir = os.path.join(module_directory, 'IMS')
-    os.makedirs(ims_outdir)
-    utils.createDirs(ims_outdir, FOLDERS)
-
-    # Generate Html and XML files
+def generateImsArchive(module_object, module_name, module_directory, build_state=None, compress_level=None, compress_workers=1):
+    """ Generate the IMSCC archive of module_object in module_directory, and returns its file name. Its files (imsmanifest.xml, html of the webcontents
+    and IMS QTI tests of the activities) are rendered in memory and written straight into the archive, deflated with compress_level
+    by compress_workers threads (see archives.DeflatedZipFile).
+    If given, build_state (see buildState.py) provides the tests of the activities unchanged since the last build """
+    # name of each file in the archive, needed by the manifest
+    resources = []
     for section in module_object.sections:
         for sub in section.subsections:
             if sub.folder == 'webcontent':
-                utils.write_file(sub.html_src, ims_outdir, sub.folder, sub.getFilename())
-            else:
-                utils.write_file(sub.toXMLMoodle(), ims_outdir, sub.folder, sub.getFilename('xml'))
+                resources.append((sub.folder+'/'+sub.getFilename(), sub))
+            elif sub.folder in FOLDERS:
+                resources.append((sub.folder+'/'+sub.getFilename('xml'), sub))
 
-    # parse data and generate imsmanifest.xml
-    imsfilename = os.path.join(ims_outdir, 'imsmanifest.xml')
-    imsfile = open(imsfilename, 'w', encoding='utf-8')
-    imsfile.write(generateIMSManifest(module_object))
-    imsfile.close()
-    logging.warning("[toIMS] imsmanifest.xml saved for module %s", module_directory)
-
-    # Compress relevant files
     fileout = module_name+'.imscc.zip'
-    zipf = zipfile.ZipFile(fileout, 'w')
-    zipf.write(imsfilename)
-    for dir_name in FOLDERS:
-        try:
-            if os.listdir(os.path.join(ims_outdir, dir_name)):
-                for afile in os.listdir(os.path.join(ims_outdir, dir_name)):
-                    filepath = os.path.join(ims_outdir, dir_name, afile)
-                    logging.info("[toIMS] Adding %s to archive " % (filepath))
-                    zipf.write(filepath)
-        except:
-            continue
-
-    zipf.close()
-    os.chdir(cur_dir)
+    with archives.DeflatedZipFile(os.path.join(module_directory, fileout), compress_level, compress_workers) as zipf:
+        zipf.writestr('imsmanifest.xml', generateIMSManifest(module_object).encode('utf-8'))
+        for arcname, sub in resources:
+            if sub.folder == 'webcontent':
+                src = sub.html_src
+            elif build_state:
+                src = build_state.toXMLMoodle(sub)
+            else:
+                src = sub.toXMLMoodle()
+            logging.info("[toIMS] Adding %s to archive " % (arcname))
+            zipf.writestr(arcname, src.encode('utf-8'))
+    logging.warning("[toIMS] IMS archive saved for module %s", module_directory)
     return fileout
 
 def main(argv):
@@ -3,119 +3,182 @@ from __future__ import division
 #!cnappenv/bin/python
 
 
+import hashlib
 import os
+import re
 import shutil
 import tarfile
-import requests
+import threading
 import markdown
 
-from bs4 import BeautifulSoup
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from io import open
 from lxml import etree
 from lxml import html
-from urlparse import urlparse
 from slugify import slugify
 
 import model
+import videoProviders
 import logging
 
 MARKDOWN_EXT = ['markdown.extensions.extra', 'superscript']
+MARKDOWN_DEFAULT_FORMAT = 'xhtml1' # default output format of markdown.markdown()
+MARKDOWN_CACHE_SIZE = 32*1024*1024 # memory budget of the markdown conversions cache, in characters of html
 
 FOLDERS = ['Comprehension', 'Activite', 'ActiviteAvancee', 'webcontent']
 STATIC_FOLDERS = ['static/js', 'static/img', 'static/svg', 'static/css', 'static/fonts']
 VERBOSITY = False
-DEFAULT_VIDEO_THUMB_URL = 'https://i.vimeocdn.com/video/536038298_640.jpg'
 
 
-def fetch_vimeo_thumb(video_link):
-    """ fetch video thumbnail for vimeo videos """
-    # get video id
-    video_id = video_link.rsplit('/', 1)[1]
-    logging.info ("== video ID = %s" % video_id)
-    try:
-        response = requests.request('GET', VIDEO_THUMB_API_URL+video_id+'.json')
-        data = response.json()[0]
-        image_link = data['thumbnail_large']
-        image_link = image_link.replace('wepb', 'jpg')
-    except Exception:
-        logging.exception (" ----------------  error while fetching video %s" % (video_link))
-        image_link = DEFAULT_VIDEO_THUMB_URL
-    return image_link
+def postprocess_html(html_src, video_class=None, media_url=None, method='html'):
+    """ Rewrites a piece of html code in a single pass: the code is parsed once with lxml, all rewrites are done in one walk through the tree,
+        and the tree is serialized once:
 
+        - add target="_blank" attribute to all anchors
+        - if 'video_class' is given, add the iframe of the video (see videoProviders.getEmbed()) in a div.video before each anchor of that class
+        - if 'media_url' is given, relative links to the media folder (in src and href attributes) are turned absolute with 'media_url'
 
-def get_embed_code_for_url(url):
-    """
-    parses a given url and retrieve embed code.
+    :param html_src: html code
+    :param method: serialization method of lxml, 'html' or 'xml' (for xhtml code)
+    :rtype: text string with the rewritten html code
     """
-    hostname = url and urlparse(url).hostname
-    # VIMEO case
-    if hostname == "vimeo.com":
-        # For vimeo videos, one can use OEmbed API, but it slows down the code enormously (from <1s to 4s+ for rendering one module)
-            # params = { 'url': url, 'format':'json', 'api':False }
-            # try:
-            #     r = requests.get('https://vimeo.com/api/oembed.json', params=params)
-            #     r.raise_for_status()
-            # except Exception as e:
-            #     return hostname, '<p>Error getting video from provider ({error})</p>'.format(error=e)
-            # res = r.json()
-            # return hostname, res['html']
-        vid_id = url.strip('/').rsplit('/', 1)[1]
-        embed_code = """<iframe src="https://player.vimeo.com/video/{0}" width="500" height="281" frameborder="0" webkitallowfullscreen mozallowfullscreen allowfullscreen></iframe>""".format(vid_id)
-        return hostname, embed_code
-
-    # CanalU.tv
-    elif hostname == "www.canal-u.tv":
-        # build embed url from template : https://www.canal-u.tv/video/universite_de_tous_les_savoirs/pourquoi_il_fait_nuit.1207 == hostname/video/[channel]/[videoname]
-        embed_code = """<iframe src="{0}/embed.1/{1}?width=100%&amp;height=100%&amp" width="550" height="306" frameborder="0" allowfullscreen scrolling="no"></iframe>""".format(url.rsplit('/', 1)[0],url.split('/')[-1])
-        return hostname, embed_code
-
-    # not supported
-    else:
-        return hostname, '<p>Unsupported video provider ({0})</p>'.format(hostname)
-
-
-def get_video_src(video_link):
-    """ get video src link for iframe embed.
-        FIXME : Supports only vimeo and canal-u.tv so far """
-    host, embed = get_embed_code_for_url(video_link)
-    soup = BeautifulSoup(embed, 'html.parser')
-    try:
-        src_link = soup.iframe['src']
-    except Exception as e:
-        src_link = ''
-    return src_link
+    if not html_src or html_src.isspace():
+        return html_src
+    root = html.fragment_fromstring(html_src, create_parent='div')
+    video_anchors = []
+    for element in root.iter(tag=etree.Element):
+        if media_url:
+            for attribute in ('src', 'href'):
+                link = element.get(attribute)
+                if link and re.match('(\./)*media/', link):
+                    element.set(attribute, media_url+re.sub('^(\./)*media/', '', link))
+        if element.tag == 'a':
+            element.set('target', '_blank')
+            if video_class and video_class in element.get('class', '').split():
+                video_anchors.append(element)
+    for anchor in video_anchors:
+        embed = videoProviders.getEmbed(anchor.get('href'))
+        if embed:
+            video_div = etree.Element('div')
+            video_div.set('class', 'video')
+            iframe = etree.SubElement(video_div, 'iframe')
+            for name, value in embed.iframeAttributes():
+                iframe.set(name, value)
+            anchor.addprevious(video_div)
+    # serialize the children of the parent div only
+    output = etree.tostring(root, encoding='unicode', method=method)
+    return output[len('<div>'):-len('</div>')]
+
+
+class StringBuffer:
+    """ Minimal file-like object keeping written strings in a list, that are joined only once by getvalue().
+        Lets the write* methods of the model build strings without repeated concatenation """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, src):
+        self.parts.append(src)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+class MarkdownPool:
+    """ Pool of Markdown converters configured once with the MARKDOWN_EXT extensions, kept apart for each output format.
+        A converter is taken out of the pool for the time of one conversion, then reset and given back, so the pool can be shared between threads.
+        Use render_markdown() rather than markdown.markdown(), which loads the extensions again on each call """
+    def __init__(self, extensions=MARKDOWN_EXT):
+        self.extensions = extensions
+        self.free = {} # output format -> list of available converters
+        self.lock = threading.Lock()
+
+    def acquire(self, output_format):
+        with self.lock:
+            converters = self.free.get(output_format)
+            if converters:
+                return converters.pop()
+        return markdown.Markdown(extensions=self.extensions, output_format=output_format)
+
+    def release(self, output_format, converter):
+        converter.reset()
+        with self.lock:
+            self.free.setdefault(output_format, []).append(converter)
+
+    def convert(self, text, output_format=MARKDOWN_DEFAULT_FORMAT):
+        converter = self.acquire(output_format)
+        try:
+            return converter.convert(text)
+        finally:
+            self.release(output_format, converter)
 
+markdown_pool = MarkdownPool()
 
-def add_target_blank(html_src):
-    """ add target="_blank" attribute to anchors in html_src """
-    soup = BeautifulSoup(html_src, 'html.parser')
-    anchor_list = soup.find_all('a')
-    for anchor in anchor_list:
-        anchor['target'] = "_blank"
-    return soup.prettify()
 
+class MarkdownCache:
+    """ Memo of markdown conversions, keyed by the output format and the hash of the markdown text. The least recently used conversions are dropped
+        when the size of the html kept goes above max_size. Counts hits and misses, see stats()
 
-def iframize_video_anchors(htmlsrc, anchor_class):
-    """ given a piece of html code, scan for video anchors
-        filtered by given class and add corresponding video iframe code before each anchor
-        nb. uses get_embed_code_for_url()
+    :param max_size: memory budget, in characters of html (default MARKDOWN_CACHE_SIZE)
+    :type max_size: int
     """
-    if anchor_class not in htmlsrc:
-        return htmlsrc
-    soup = BeautifulSoup(htmlsrc, 'html.parser')
-    anchor_list = soup.find_all('a', class_=anchor_class)
-    if len(anchor_list) < 1:
-        return htmlsrc
-    for anchor in anchor_list:
-        host, embed = get_embed_code_for_url(anchor['href'])
-        embed_soup = BeautifulSoup(embed, 'html.parser')
-        video_div = soup.new_tag('div', class_='video')
-        if embed_soup.iframe:
-            embed_soup.iframe.wrap(video_div)
-            anchor.insert_before(video_div)
-    output = soup.prettify()
-    return output.replace('class_', 'class')
+    def __init__(self, max_size=MARKDOWN_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict() # (output format, hash) -> html, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def getKey(self, text, output_format):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        return (output_format, hashlib.sha1(text).digest())
+
+    def get(self, key):
+        """ returns the html stored under 'key', None if there is none """
+        with self.lock:
+            html_src = self.entries.pop(key, None)
+            if html_src is None:
+                self.misses += 1
+                return None
+            self.entries[key] = html_src # now the most recently used
+            self.hits += 1
+            return html_src
+
+    def put(self, key, html_src):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = html_src
+            self.size += len(html_src)
+            while self.size > self.max_size and self.entries:
+                old_key, old_html = self.entries.popitem(last=False)
+                self.size -= len(old_html)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """ returns a dict with the number of hits, misses and entries, and the size of the cache """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'size': self.size}
+
+markdown_cache = MarkdownCache()
+
+
+def render_markdown(text, output_format=MARKDOWN_DEFAULT_FORMAT):
+    """ returns the html conversion of markdown 'text', like markdown.markdown(text, MARKDOWN_EXT, output_format=output_format).
+        Conversions are memoized in markdown_cache, and done with a converter of the shared pool """
+    key = markdown_cache.getKey(text, output_format)
+    html_src = markdown_cache.get(key)
+    if html_src is None:
+        html_src = markdown_pool.convert(text, output_format)
+        markdown_cache.put(key, html_src)
+    return html_src
 
 
 def totimestamp(dt, epoch=datetime(1970,1,1)):
@@ -235,4 +298,4 @@ def cnslugify(value):
 
 def cntohtml(value):
     """ filter taking input in md or html and rendering it anyway """
-    return markdown.markdown(value, MARKDOWN_EXT, output_format='xhtml')
+    return render_markdown(value, 'xhtml')
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+######################################################################################
+#
+#    Registry of the video providers supported in lectures. Each provider matches
+#    the url of a video with a compiled pattern and returns its embed data (src,
+#    size and thumbnail of the iframe) directly, without going through html.
+#    Supporting a new host is a matter of registering a new VideoProvider.
+#
+#    Metadata needing a request to the provider (thumbnail, title and html from its
+#    oEmbed API) are fetched by a VideoMetadataResolver for all the videos of a course
+#    at once, and kept in a cache file between builds.
+#
+######################################################################################
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+DEFAULT_VIDEO_THUMB_URL = 'https://i.vimeocdn.com/video/536038298_640.jpg'
+METADATA_TTL = 7*24*3600 # in seconds, time before fetching again the metadata of a video
+METADATA_ERROR_TTL = 3600 # in seconds, time before trying again for a video whose metadata could not be fetched
+METADATA_MAX_WORKERS = 8 # maximum number of concurrent requests to the providers
+METADATA_TIMEOUT = 10 # in seconds
+
+
+class VideoEmbed(namedtuple('VideoEmbed', ['provider', 'src', 'width', 'height', 'thumbnail', 'attributes', 'oembed'])):
+    """ Embed data of a video: name of the provider, src, width and height of the iframe, url of a thumbnail (None if unknown),
+    other attributes of the iframe (tuple of (name, value) pairs, an empty value giving a boolean attribute)
+    and url of the oEmbed API of the provider (None if it has none) """
+    __slots__ = ()
+
+    def iframeAttributes(self):
+        """ returns the list of the (name, value) attributes of the iframe of the video """
+        return [('src', self.src), ('width', str(self.width)), ('height', str(self.height))] + list(self.attributes)
+
+
+class VideoProvider(object):
+    """ Abstract class for a video provider: 'pattern' is the compiled regex matching the urls of its videos, embed() builds the embed data from the match """
+    name = ''
+    pattern = None
+
+    def match(self, url):
+        return self.pattern.match(url)
+
+    def embed(self, match):
+        raise NotImplementedError
+
+
+class VimeoProvider(VideoProvider):
+    # Thumbnails of vimeo videos are only known from the oEmbed API, see VideoMetadataResolver
+    name = 'vimeo'
+    pattern = re.compile('^https?://vimeo\.com/(.*/)?(?P<id>[^/]+?)/*$')
+
+    def embed(self, match):
+        return VideoEmbed(self.name, 'https://player.vimeo.com/video/'+match.group('id'), 500, 281, DEFAULT_VIDEO_THUMB_URL,
+                          (('frameborder', '0'), ('webkitallowfullscreen', ''), ('mozallowfullscreen', ''), ('allowfullscreen', '')),
+                          'https://vimeo.com/api/oembed.json')
+
+
+class CanalUProvider(VideoProvider):
+    # embed url built from template : https://www.canal-u.tv/video/universite_de_tous_les_savoirs/pourquoi_il_fait_nuit.1207 == hostname/video/[channel]/[videoname]
+    name = 'canal-u'
+    pattern = re.compile('^(?P<base>https?://www\.canal-u\.tv/.*)/(?P<name>[^/]+)$')
+
+    def embed(self, match):
+        return VideoEmbed(self.name, match.group('base')+'/embed.1/'+match.group('name')+'?width=100%&height=100%', 550, 306, None,
+                          (('frameborder', '0'), ('allowfullscreen', ''), ('scrolling', 'no')), None)
+
+
+class YouTubeProvider(VideoProvider):
+    name = 'youtube'
+    pattern = re.compile('^https?://(www\.|m\.)?(youtube\.com/(watch\?(.*&)?v=|embed/)|youtu\.be/)(?P<id>[\w-]+)')
+
+    def embed(self, match):
+        vid_id = match.group('id')
+        return VideoEmbed(self.name, 'https://www.youtube.com/embed/'+vid_id, 560, 315, 'https://img.youtube.com/vi/'+vid_id+'/hqdefault.jpg',
+                          (('frameborder', '0'), ('allowfullscreen', '')), 'https://www.youtube.com/oembed')
+
+
+class PeerTubeProvider(VideoProvider):
+    # PeerTube instances have their own host names, so only the path of the url is checked
+    name = 'peertube'
+    pattern = re.compile('^(?P<base>https?://[^/]+)/(videos/(watch|embed)|w)/(?P<id>[\w-]+)/*$')
+
+    def embed(self, match):
+        return VideoEmbed(self.name, match.group('base')+'/videos/embed/'+match.group('id'), 560, 315, None,
+                          (('frameborder', '0'), ('allowfullscreen', ''), ('sandbox', 'allow-same-origin allow-scripts allow-popups')),
+                          match.group('base')+'/services/oembed')
+
+
+VIDEO_PROVIDERS = []
+_embeds = {} # url -> VideoEmbed (None for unsupported urls)
+
+def registerProvider(provider, first=False):
+    """ add 'provider' (VideoProvider instance) to the providers tried by getEmbed(), after the others unless 'first' is True """
+    if first:
+        VIDEO_PROVIDERS.insert(0, provider)
+    else:
+        VIDEO_PROVIDERS.append(provider)
+    _embeds.clear()
+
+for provider in [VimeoProvider(), CanalUProvider(), YouTubeProvider(), PeerTubeProvider()]:
+    registerProvider(provider)
+
+
+def getEmbed(url):
+    """ returns the VideoEmbed of the video at 'url' given by the first matching provider, None if no provider supports it. Results are memoized for each url """
+    url = url and url.strip()
+    try:
+        return _embeds[url]
+    except KeyError:
+        pass
+    embed = None
+    if url:
+        for provider in VIDEO_PROVIDERS:
+            match = provider.match(url)
+            if match:
+                embed = provider.embed(match)
+                break
+    _embeds[url] = embed
+    return embed
+
+
+class VideoMetadataResolver(object):
+    """ Fetches the metadata of videos (thumbnail, title and html code, as a dict) from the oEmbed API of their provider, with at most 'max_workers' concurrent requests.
+    Metadata are kept in the JSON file 'cache_path' between builds, and only fetched again when older than 'ttl' seconds ('error_ttl' after a failure).
+    In offline mode, no request is done and only the metadata in cache are given, even the outdated ones.
+
+    :param cache_path: path of the cache file (None to keep metadata in memory only)
+    :param offline: wether requests to the providers are forbidden (default False)
+    """
+    def __init__(self, cache_path=None, offline=False, max_workers=METADATA_MAX_WORKERS, ttl=METADATA_TTL, error_ttl=METADATA_ERROR_TTL, timeout=METADATA_TIMEOUT):
+        self.cache_path = cache_path
+        self.offline = offline
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.timeout = timeout
+        self.entries = self.load() # url -> {'fetched': timestamp, 'metadata': dict, or None after a failure}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                return json.loads(cache_file.read().decode('utf-8'))
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            logging.warning("[videoProviders] ignoring unreadable metadata cache %s", self.cache_path)
+            return {}
+
+    def save(self):
+        """ write the cache file, under a temporary name renamed afterwards """
+        if not self.cache_path:
+            return
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_path))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with self.lock:
+            data = json.dumps(self.entries, sort_keys=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(data.encode('utf-8'))
+            os.rename(tmp_path, self.cache_path)
+        except Exception:
+            logging.exception("[videoProviders] cannot save metadata cache %s", self.cache_path)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def get(self, url):
+        """ returns the cached metadata of the video at 'url', None if there are none """
+        entry = self.entries.get(url)
+        return entry and entry['metadata']
+
+    def isFresh(self, entry, now):
+        ttl = self.ttl if entry['metadata'] is not None else self.error_ttl
+        return now - entry['fetched'] < ttl
+
+    def fetch(self, url):
+        """ requests the metadata of the video at 'url' from its provider. Returns None on failure """
+        embed = getEmbed(url)
+        try:
+            response = requests.get(embed.oembed, params={'url': url, 'format': 'json'}, timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            logging.warning("[videoProviders] cannot fetch metadata of video %s: %s", url, e)
+            return None
+        return {'thumbnail': data.get('thumbnail_url'), 'title': data.get('title'), 'html': data.get('html')}
+
+    def resolveAll(self, urls):
+        """ Fetches the metadata of all the videos at 'urls' that are not in cache (or outdated), concurrently, then saves the cache.
+
+        :rtype: dict giving the metadata (or None) of each url
+        """
+        urls = set(url.strip() for url in urls if url)
+        now = time.time()
+        todo = []
+        if not self.offline:
+            for url in urls:
+                embed = getEmbed(url)
+                entry = self.entries.get(url)
+                if embed and embed.oembed and not (entry and self.isFresh(entry, now)):
+                    todo.append(url)
+        if todo:
+            pool = ThreadPool(min(self.max_workers, len(todo)))
+            try:
+                results = pool.map(self.fetch, todo)
+            finally:
+                pool.close()
+            with self.lock:
+                for url, metadata in zip(todo, results):
+                    entry = self.entries.get(url)
+                    if metadata is None and entry and entry['metadata'] is not None:
+                        # keep outdated metadata rather than none, and try again after error_ttl
+                        self.entries[url] = {'fetched': now - self.ttl + self.error_ttl, 'metadata': entry['metadata']}
+                    else:
+                        self.entries[url] = {'fetched': now, 'metadata': metadata}
+            self.save()
+        return dict((url, self.get(url)) for url in urls)
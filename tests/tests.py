@@ -1,16 +1,39 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import io
 from io import open
 import json
 import unittest
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from lxml import etree
 from jinja2 import Template, Environment, FileSystemLoader
 # Path hack for getting access to src python modules
 import sys, os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+import tarfile
+import gzip
+import BaseHTTPServer
+from urlparse import urlparse, parse_qs
 sys.path.insert(0, os.path.abspath('..'))
 
 from src import model
+from src import parseCache
+from src import buildState
+from src import utils
+from src import videoProviders
+from src import giftParser
+from src import fromGIFT
+from src import giftBank
+from src import toEDX
+from src import toIMS
+from src import archives
+from src import templateRegistry
 
 
 class ModuleParsingTestCase(unittest.TestCase):
@@ -96,6 +119,688 @@ class ModuleParsingTestCase(unittest.TestCase):
         print("[ModuleParsingTestCase]-- Exact match OK --")
 
 
+class TokenizerTestCase(unittest.TestCase):
+    """ Check the line classification done by model.tokenize() """
+
+    def runTest(self):
+        src = io.StringIO(u"TITLE: Test\n# Section\n## Sub\ntext\n```activité-avancée\n# not a section\n```\n```python\n")
+        kinds = [token.kind for token in model.tokenize(src)]
+        self.assertEqual(kinds, [model.TOKEN_META, model.TOKEN_SECTION, model.TOKEN_SUBSECTION, model.TOKEN_TEXT,
+            model.TOKEN_ACTIVITY, model.TOKEN_TEXT, model.TOKEN_ACTIVITY_END, model.TOKEN_FENCE])
+        self.assertIs(model.activityClass(u' Compréhension'), model.Comprehension)
+        self.assertIsNone(model.activityClass(u'cours'))
+        print("[TokenizerTestCase]-- Tokens OK --")
+
+
+class IterSectionsTestCase(unittest.TestCase):
+    """ Check that sections parsed one at a time with model.Module.iterSections() match the eager parsing """
+
+    def runTest(self):
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            eager = model.Module(sample_file, "tests")
+            eager_nums = [(s.num, s.title, len(s.subsections)) for s in eager.sections]
+            del eager
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            lazy = model.Module(None, "tests")
+            sections = lazy.iterSections(sample_file)
+            self.assertEqual(lazy.menutitle, "Internet") # head is parsed before the first section
+            lazy_nums = [(s.num, s.title, len(s.subsections)) for s in sections]
+        self.assertEqual(eager_nums, lazy_nums)
+        self.assertEqual(lazy.sections, [])
+        self.assertEqual(lazy.act_counter, {'Activite': 3, 'ActiviteAvancee': 2, 'Comprehension': 4})
+        print("[IterSectionsTestCase]-- Sections OK --")
+
+
+class SourceIndexTestCase(unittest.TestCase):
+    """ Check that sections and subsections read again from the offset index match the parsing of the whole file """
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def check_index(self, filein):
+        with model.openSource(filein) as sample_file:
+            m = model.Module(sample_file, "tests")
+        self.assertEqual(len(m.index), len(m.sections))
+        for entry, section in zip(m.index, m.sections):
+            read = m.readSection(filein, entry)
+            self.assertEqual((read.num, read.title), (section.num, section.title))
+            self.assertEqual([(s.num, s.src) for s in read.subsections], [(s.num, s.src) for s in section.subsections])
+            for sub_entry, sub in zip(entry['subsections'], section.subsections):
+                read_sub = m.readSubsection(filein, entry, sub_entry)
+                self.assertEqual(read_sub.__class__, sub.__class__)
+                self.assertEqual((read_sub.num, read_sub.title, read_sub.src), (sub.num, sub.title, sub.src))
+        self.assertEqual(json.loads(m.toIndexJson())['sections'], m.index)
+        return m
+
+    def runTest(self):
+        m = self.check_index("module_test.md")
+        # same source with a byte order mark and windows line endings
+        crlf_file = os.path.join(self.out_dir, 'module_crlf.md')
+        with open("module_test.md", 'rb') as sample_file, open(crlf_file, 'wb') as out_file:
+            out_file.write(b'\xef\xbb\xbf' + sample_file.read().replace(b'\n', b'\r\n'))
+        crlf = self.check_index(crlf_file)
+        self.assertEqual(crlf.menutitle, m.menutitle)
+        self.assertEqual([(s.num, s.title, [sub.src for sub in s.subsections]) for s in crlf.sections],
+                         [(s.num, s.title, [sub.src for sub in s.subsections]) for s in m.sections])
+        print("[SourceIndexTestCase]-- Index OK --")
+
+
+class GiftParserTestCase(unittest.TestCase):
+    """ Check the tree of GIFT questions given by giftParser, and escaped characters """
+
+    def runTest(self):
+        node = giftParser.parse(u"::Title \\: one::[markdown]What is \\{x\\} ?{\n~%50%a \\= b#half\nright ~c#no\n=%100%d\n####[markdown]Because\\} }")
+        self.assertEqual(node.title, u"Title : one")
+        self.assertEqual(node.format, 'markdown')
+        self.assertEqual(node.text, u"What is {x} ?")
+        self.assertEqual(node.kind, 'MULTICHOICE')
+        self.assertEqual([(a.is_right, a.credit, a.text, a.feedback) for a in node.answers],
+                         [(False, '50', u"a = b", u"half\nright "), (False, None, u"c", u"no\n"), (True, '100', u"d\n", u"")])
+        self.assertEqual((node.global_feedback_format, node.global_feedback), ('markdown', u"Because} "))
+        node = giftParser.parse(u"::TF::It is true {TRUE#Wrong#Right}")
+        self.assertEqual((node.kind, node.is_true, node.feedback_for_wrong, node.feedback_for_right), ('TRUEFALSE', True, u"Wrong", u"Right"))
+        node = giftParser.parse(u"Pi ? {#3.14:0.01}")
+        self.assertEqual((node.kind, node.answers[0].numeric), ('NUMERIC', (3.14, 0.01)))
+        node = giftParser.parse(u"Between ? {#=1..3#Yes =%50%2:2}")
+        self.assertEqual([a.numeric for a in node.answers], [(2.0, 1.0), (2.0, 2.0)])
+        node = giftParser.parse(u"Match {=a -> 1 =b -> 2}")
+        self.assertEqual((node.kind, [a.match for a in node.answers]), ('MATCH', [(u"a", u"1"), (u"b", u"2")]))
+        self.assertEqual(giftParser.parse(u"Just text").kind, 'DESCRIPTION')
+        self.assertEqual(giftParser.parse(u"Write {}").kind, 'ESSAY')
+        # escaped braces are kept escaped in the html source of questions
+        question = fromGIFT.process_questions([u"::T::A \\{set\\} {=a ~b}"])[0]
+        self.assertEqual(question.gift_src, u"::T::<p>A \\{set\\} </p>{=a ~b}")
+        self.assertEqual((question.type, question.text), ('MULTICHOICE', u"<p>A {set} </p>"))
+        print("[GiftParserTestCase]-- GIFT parser OK --")
+
+
+class RenderOnceTestCase(unittest.TestCase):
+    """ Check that questions are converted to html when processed, and that their outputs are rendered once """
+
+    def runTest(self):
+        question = fromGIFT.process_questions([u"::T::[markdown]Some *text* {=a ~b ####Some **feedback**}"])[0]
+        self.assertEqual((question.text_format, question.text), ('html', u"<p>Some <em>text</em> </p>"))
+        self.assertEqual(question.global_feedback, u"<p>Some <strong>feedback</strong></p>")
+        self.assertEqual(question.gift_src, u"::T::[html]<p>Some <em>text</em> </p>{=a ~b ####<p>Some <strong>feedback</strong></p>}")
+        html = question.to_html(True)
+        self.assertIn(u"<b><em>Feedback:</em></b><br/><p>Some <strong>feedback</strong></p>", html)
+        self.assertIs(question.to_html(True), html)
+        self.assertNotEqual(question.to_html(False), html)
+        rendered = question.rendered_html('global_feedback')
+        question.global_feedback = u"changed"
+        self.assertIs(question.rendered_html('global_feedback'), rendered)
+        self.assertIs(question.to_html(True), html)
+        print("[RenderOnceTestCase]-- Render once OK --")
+
+
+class QuestionIdsTestCase(unittest.TestCase):
+    """ Check that ids of questions are given by their source and position, and the same from one parsing to another """
+
+    def questionIds(self):
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            module_obj = model.Module(sample_file, "tests")
+        return [question.id for sec in module_obj.sections for sub in sec.subsections for question in getattr(sub, 'questions', [])]
+
+    def runTest(self):
+        ids = self.questionIds()
+        self.assertEqual(self.questionIds(), ids)
+        self.assertEqual(len(set(ids)), len(ids))
+        questions = fromGIFT.process_questions([u"::T:: Text {=a ~b}", u"::T::Text\n {=a\n~b}", u"::T:: Text {=a ~b}"], 'm/1-1')
+        self.assertEqual(questions[0].id, fromGIFT.question_id(u"::T:: Text {=a ~b}\r\n", 'm/1-1/0'))
+        self.assertNotEqual(questions[0].id, fromGIFT.question_id(u"::T:: Text  {=a ~b}", 'm/1-1/0'))
+        self.assertNotEqual(questions[0].id, questions[2].id)
+        self.assertNotEqual(questions[0].id, fromGIFT.process_questions([u"::T:: Text {=a ~c}"], 'm/1-1')[0].id)
+        self.assertIsNone(fromGIFT.GiftQuestion().id) # no random id for questions not loaded
+        print("[QuestionIdsTestCase]-- Question ids OK --")
+
+
+class GiftBankTestCase(unittest.TestCase):
+    """ Check the streaming conversion of a bank of GIFT questions by fromGIFT, in one or several processes """
+
+    def setUp(self):
+        self.bank_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.bank_dir)
+
+    def runTest(self):
+        bank = u"\n\n".join(u"// question %d\n::Q%d::[markdown]Question *%d* ?{\n=yes#good\n~no#bad\n####Because}" % (i, i, i) for i in range(11))
+        self.assertEqual(list(fromGIFT.iter_questions(io.StringIO(bank))), fromGIFT.extract_questions(bank))
+        sources = fromGIFT.extract_questions(bank)
+        alone = list(giftBank.convert_questions(sources, 'bank.gift', ('html', 'qti', 'edx'), processes=1))
+        workers = list(giftBank.convert_questions(iter(sources), 'bank.gift', ('html', 'qti', 'edx'), processes=2, chunk_size=3))
+        self.assertEqual(workers, alone)
+        self.assertEqual(len(alone), 11)
+        self.assertIn(u"Question <em>10</em>", alone[10]['html'])
+        bank_path = os.path.join(self.bank_dir, 'bank.gift')
+        with open(bank_path, 'w', encoding='utf-8') as bank_file:
+            bank_file.write(bank)
+        giftBank.main(['giftBank.py', bank_path, '-q', '-e', '-j', '2'])
+        with open(bank_path+'.html', encoding='utf-8') as html_file:
+            self.assertEqual(html_file.read(), fromGIFT.HEADER+u''.join(output['html'] for output in alone)+fromGIFT.FOOTER)
+        self.assertEqual(len(etree.parse(bank_path+'.qti.xml').findall('.//{http://www.imsglobal.org/xsd/ims_qtiasiv1p2}item')), 11)
+        self.assertEqual(sorted(os.listdir(os.path.join(bank_path+'_edx', 'problem'))), sorted(output['edx'][0]+'.xml' for output in alone))
+        print("[GiftBankTestCase]-- GIFT bank OK --")
+
+
+class QuestionsIndexTestCase(unittest.TestCase):
+    """ Check that questions found again are copies of the first ones, with their own ids """
+
+    def runTest(self):
+        src = u"::Q1:: Combien font 1+1 ? {=2 ~3}\n\n::Q2:: Expliquez. {}\n\n::Q1:: Combien font 1+1 ? {=2 ~3}\r\n"
+        index = fromGIFT.QuestionsIndex()
+        first = fromGIFT.process_questions(fromGIFT.extract_questions(src), 'module1/1-1', index)
+        second = fromGIFT.process_questions(fromGIFT.extract_questions(src), 'module2/1-1', index)
+        self.assertEqual(index.stats(), {'questions': 2, 'duplicates': 4})
+        # builds running at the same time each have their own index
+        modules = []
+        for i in range(2):
+            with open("module_test.md", encoding='utf-8') as sample_file:
+                modules.append(model.Module(sample_file, "tests"))
+        indexes = [fromGIFT.QuestionsIndex() for m in modules]
+        pool = ThreadPool(2)
+        for m, build_index in zip(modules, indexes):
+            pool.apply_async(m.loadQuestions, (build_index,))
+        pool.close()
+        pool.join()
+        self.assertEqual(indexes[0].stats(), indexes[1].stats())
+        self.assertGreater(indexes[0].stats()['questions'], 0)
+        self.assertEqual(index.stats(), {'questions': 2, 'duplicates': 4})
+        ids = set(question.id for question in first+second)
+        self.assertEqual(len(ids), 6)
+        self.assertIs(first[2].to_html(True), first[0].to_html(True))
+        self.assertIs(second[0].to_html(True), first[0].to_html(True))
+        self.assertEqual(second[0].answers, first[0].answers)
+        # the EDX problem of essays holds the id of the question
+        self.assertIn(str(second[1].id), toEDX.toEdxProblemXml(second[1]))
+        self.assertIn(str(first[1].id), toEDX.toEdxProblemXml(first[1]))
+        bank = io.StringIO()
+        index.writeGift(bank)
+        self.assertEqual(bank.getvalue().count('::Q1::'), 1)
+        self.assertEqual(bank.getvalue().count('::Q2::'), 1)
+        # whitespace is significant in Markdown: questions differing only by it are distinct
+        src = u"::Q3:: Lisez  \nla suite {=2 ~3}\n\n::Q3:: Lisez\nla suite {=2 ~3}\n"
+        line_break, no_line_break = fromGIFT.process_questions(fromGIFT.extract_questions(src), 'module3/1-1', index)
+        self.assertEqual(index.stats(), {'questions': 4, 'duplicates': 4})
+        self.assertIn('<br', line_break.to_html(False))
+        self.assertNotIn('<br', no_line_break.to_html(False))
+        print("[QuestionsIndexTestCase]-- questions index OK --")
+
+
+class QtiWriterTestCase(unittest.TestCase):
+    """ Check the IMS QTI tests written by toIMS """
+
+    def runTest(self):
+        src = u"::Q1:: Combien\nfont 1+1 ? {=2#Oui ~%50%3#Presque ####Facile}\n\n::Q2:: Lesquels ? {~%50%a ~%50%b ~%-100%c}\n"
+        questions = fromGIFT.process_questions(fromGIFT.extract_questions(src), 'tests/1-1')
+        meta = dict(toIMS.DEFAULT_QTI_META)
+        test = toIMS.create_ims_test(questions, u'1-1_test', u'Activité')
+        self.assertEqual(toIMS.DEFAULT_QTI_META, meta)
+        self.assertEqual(test.count('\n'), 2) # after the declaration and at the end only
+        ns = {'q': 'http://www.imsglobal.org/xsd/ims_qtiasiv1p2'}
+        root = etree.fromstring(test.encode('utf-8'))
+        self.assertEqual(root.xpath('//q:assessment/@title', namespaces=ns), [u'Activité'])
+        self.assertEqual(root.xpath('//q:fieldlabel[.="cc_maxattempts"]/../q:fieldentry/text()', namespaces=ns), ['1'])
+        self.assertEqual(len(root.xpath('//q:item', namespaces=ns)), 2)
+        self.assertEqual(root.xpath('//q:item[1]//q:respcondition/@continue', namespaces=ns), ['Yes'])
+        self.assertEqual(root.xpath('//q:item[1]//q:setvar/text()', namespaces=ns), ['100', '50'])
+        self.assertEqual(len(root.xpath('//q:item[2]//q:and/q:not', namespaces=ns)), 1)
+        # items are rendered once, and written as given
+        out = io.BytesIO()
+        toIMS.write_ims_test(out, [toIMS.create_ims_item(question, idx, u'Activité') for idx, question in enumerate(questions)], u'1-1_test', u'Activité')
+        self.assertEqual(out.getvalue().decode('utf-8'), test)
+        print("[QtiWriterTestCase]-- IMS QTI tests OK --")
+
+
+class ImsArchiveTestCase(unittest.TestCase):
+    """ Check that the IMSCC archive is written from memory, without intermediate files nor change of the working directory """
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def runTest(self):
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            m = model.Module(sample_file, "tests")
+        m.toHTML(False)
+        cwd = os.getcwd()
+        fileout = toIMS.generateImsArchive(m, 'module_test', self.out_dir, compress_level=9)
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(os.listdir(self.out_dir), [fileout])
+        with zipfile.ZipFile(os.path.join(self.out_dir, fileout)) as archive:
+            self.assertIsNone(archive.testzip())
+            names = archive.namelist()
+            self.assertEqual(names[0], 'imsmanifest.xml')
+            self.assertTrue(all(info.compress_type == zipfile.ZIP_DEFLATED for info in archive.infolist()))
+            manifest = etree.fromstring(archive.read('imsmanifest.xml'))
+            hrefs = manifest.xpath('//*[local-name()="resource"]/@href')
+            self.assertEqual(sorted(hrefs), sorted(names[1:]))
+            sub = m.sections[0].subsections[0]
+            self.assertEqual(archive.read(sub.folder+'/'+sub.getFilename()).decode('utf-8'), sub.html_src)
+            self.assertEqual(set(info.date_time for info in archive.infolist()), set([archives.ZIP_EPOCH]))
+        # the same module gives the same archive, byte for byte
+        with open(os.path.join(self.out_dir, fileout), 'rb') as archive_file:
+            first = archive_file.read()
+        time.sleep(2) # zip dates have a resolution of 2 seconds
+        toIMS.generateImsArchive(m, 'module_test', self.out_dir, compress_level=9)
+        with open(os.path.join(self.out_dir, fileout), 'rb') as archive_file:
+            self.assertEqual(archive_file.read(), first)
+        print("[ImsArchiveTestCase]-- IMS archive OK --")
+
+
+class TemplateRegistryTestCase(unittest.TestCase):
+    """ Check that templates are loaded once for the process, from their bytecode cache or compiled ahead of time """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        templateRegistry.configure()
+        shutil.rmtree(self.cache_dir)
+
+    def runTest(self):
+        template = templateRegistry.getTemplate("edx_problem_template.xml")
+        self.assertIs(templateRegistry.getTemplate("edx_problem_template.xml"), template)
+        question = fromGIFT.process_questions(fromGIFT.extract_questions(u"::Q:: Expliquez. {}\n"), 'tests/1-1')[0]
+        problem = template.render(q=question)
+        problem_path = templateRegistry.renderToFile("edx_problem_template.xml", os.path.join(self.cache_dir, 'problem.xml'), q=question)
+        with open(problem_path, encoding='utf-8') as problem_file:
+            self.assertEqual(problem_file.read(), problem)
+        # bytecode cache
+        bytecode_dir = os.path.join(self.cache_dir, 'bytecode')
+        templateRegistry.configure(bytecode_dir=bytecode_dir)
+        self.assertEqual(templateRegistry.getTemplate("edx_problem_template.xml").render(q=question), problem)
+        self.assertEqual(len(os.listdir(bytecode_dir)), 2) # the template and its include
+        # templates compiled ahead of time
+        compiled_dir = os.path.join(self.cache_dir, 'compiled')
+        templateRegistry.compileTemplates(compiled_dir)
+        templateRegistry.configure(compiled_dir=compiled_dir)
+        compiled = templateRegistry.getTemplate("edx_problem_template.xml")
+        self.assertTrue(compiled.filename.startswith(compiled_dir)) # loaded from its python module, not from source
+        self.assertEqual(compiled.render(q=question), problem)
+        print("[TemplateRegistryTestCase]-- Templates OK --")
+
+
+class EdxArchiveTestCase(unittest.TestCase):
+    """ Check that the EDX archive is written from memory, the EDX tree being written only on demand """
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def runTest(self):
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            m = model.Module(sample_file, "tests")
+        m.toHTML(False)
+        self.assertIs(toEDX.loadSkeleton(), toEDX.loadSkeleton())
+        skeleton = dict(toEDX.loadSkeleton())
+        self.assertIn('about/overview.html', skeleton)
+        self.assertNotIn('policies/course/policy.json', skeleton)
+        fileout = toEDX.generateEDXArchive(m, self.out_dir)
+        self.assertEqual(os.listdir(self.out_dir), [fileout])
+        with tarfile.open(os.path.join(self.out_dir, fileout)) as tar:
+            members = dict((member.name, tar.extractfile(member).read()) for member in tar.getmembers())
+            self.assertEqual(set(member.mtime for member in tar.getmembers()), set([0]))
+        # the same module gives the same archive, byte for byte, dated from SOURCE_DATE_EPOCH if set
+        with open(os.path.join(self.out_dir, fileout), 'rb') as archive_file:
+            first = archive_file.read()
+        time.sleep(1)
+        toEDX.generateEDXArchive(m, self.out_dir)
+        with open(os.path.join(self.out_dir, fileout), 'rb') as archive_file:
+            self.assertEqual(archive_file.read(), first)
+        os.environ['SOURCE_DATE_EPOCH'] = '1500000000'
+        try:
+            toEDX.generateEDXArchive(m, self.out_dir)
+            self.assertEqual(archives.zipDateTime(), (2017, 7, 14, 2, 40, 0))
+        finally:
+            del os.environ['SOURCE_DATE_EPOCH']
+        with tarfile.open(os.path.join(self.out_dir, fileout)) as tar:
+            self.assertEqual(set(member.mtime for member in tar.getmembers()), set([1500000000]))
+        self.assertEqual(members['EDX/about/overview.html'], skeleton['about/overview.html'])
+        json.loads(members['EDX/policies/course/policy.json'].decode('utf-8'))
+        course = etree.fromstring(members['EDX/course.xml'])
+        for problem in course.iter('problem'):
+            self.assertIn('EDX/problem/%s.xml' % problem.get('url_name'), members)
+        # on demand, the same files are written in the EDX folder
+        toEDX.generateEDXArchive(m, self.out_dir, write_tree=True)
+        for name, data in members.items():
+            with open(os.path.join(self.out_dir, name), 'rb') as tree_file:
+                self.assertEqual(tree_file.read(), data)
+        print("[EdxArchiveTestCase]-- EDX archive OK --")
+
+
+class ArchivesTestCase(unittest.TestCase):
+    """ Check that archives compressed by several threads are read back as written """
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def runTest(self):
+        files = [('dir/file%d.txt' % i, (u'contenu numéro %d\n' % i).encode('utf-8')*(i*50)) for i in range(20)]
+        zip_path = os.path.join(self.out_dir, 'test.zip')
+        with archives.DeflatedZipFile(zip_path, 9, workers=3) as archive:
+            for name, data in files:
+                archive.writestr(name, data)
+        with zipfile.ZipFile(zip_path) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual([(name, archive.read(name)) for name in archive.namelist()], files)
+        # gzip members of 1000 bytes each
+        gz_path = os.path.join(self.out_dir, 'test.gz')
+        gz_file = archives.ParallelGzipFile(gz_path, workers=3, block_size=1000)
+        for name, data in files:
+            gz_file.write(data)
+        gz_file.close()
+        with gzip.open(gz_path) as gz_file:
+            self.assertEqual(gz_file.read(), b''.join(data for name, data in files))
+        tar_path = os.path.join(self.out_dir, 'test.tar.gz')
+        with archives.openTarGz(tar_path, workers=3) as tar:
+            for name, data in files*10:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            # member streamed from chunks, beyond what is kept in memory
+            with archives.spoolChunks(data for name, data in files*10) as spool:
+                self.assertTrue(spool._rolled)
+                archives.addTarMember(tar, 'dir/spooled.txt', spool)
+        self.assertGreater(os.path.getsize(tar_path), 0)
+        with tarfile.open(tar_path) as tar:
+            self.assertEqual([(member.name, tar.extractfile(member).read()) for member in tar.getmembers()],
+                             files*10 + [('dir/spooled.txt', b''.join(data for name, data in files*10))])
+        # tar.gz archives are compressed at level 9 by default, whatever the number of workers (XFL byte of the gzip header)
+        for workers in (1, 3):
+            with archives.openTarGz(tar_path, workers=workers) as tar:
+                archives.addTarMember(tar, 'dir/file.txt', files[-1][1])
+            with open(tar_path, 'rb') as tar_file:
+                self.assertEqual(tar_file.read(10)[8:9], b'\x02')
+        print("[ArchivesTestCase]-- Archives OK --")
+
+
+class SlotsTestCase(unittest.TestCase):
+    """ Check that sections, subsections and questions are slotted objects """
+
+    def runTest(self):
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            module_obj = model.Module(sample_file, "tests")
+        for section in module_obj.sections:
+            self.assertFalse(hasattr(section, '__dict__'))
+            for sub in section.subsections:
+                self.assertFalse(hasattr(sub, '__dict__'))
+                for question in getattr(sub, 'questions', []):
+                    self.assertFalse(hasattr(question, '__dict__'))
+                    for answer in question.answers:
+                        self.assertEqual(answer['is_right'], answer.is_right)
+        print("[SlotsTestCase]-- Slots OK --")
+
+
+class LazyQuestionsTestCase(unittest.TestCase):
+    """ Check that the questions of an activity are only processed when first needed """
+
+    def runTest(self):
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            module_obj = model.Module(sample_file, "tests")
+        activities = [sub for sec in module_obj.sections for sub in sec.subsections if isinstance(sub, model.AnyActivity)]
+        self.assertFalse(any(hasattr(act, '_questions') for act in activities))
+        questions = activities[0].questions
+        self.assertTrue(len(questions) > 0)
+        self.assertIs(activities[0].questions, questions)
+        print("[LazyQuestionsTestCase]-- Lazy questions OK --")
+
+
+class MarkdownPoolTestCase(unittest.TestCase):
+    """ Check that converters of utils.MarkdownPool give the same html as markdown.markdown(), also when reused and shared between threads """
+
+    def runTest(self):
+        import markdown
+        texts = ["Texte[^1] *important*\n\n[^1]: une note", "Abbr HTML\n\n*[HTML]: Hyper Text", "2^10^ octets"]
+        for output_format in ('xhtml1', 'xhtml'):
+            expected = [markdown.markdown(text, utils.MARKDOWN_EXT, output_format=output_format) for text in texts]
+            pool = utils.MarkdownPool()
+            self.assertEqual([pool.convert(text, output_format) for text in texts*2], expected*2)
+            self.assertEqual(len(pool.free[output_format]), 1)
+            results = ThreadPool(4).map(lambda text: pool.convert(text, output_format), texts*10)
+            self.assertEqual(results, expected*10)
+        print("[MarkdownPoolTestCase]-- Markdown pool OK --")
+
+
+class MarkdownCacheTestCase(unittest.TestCase):
+    """ Check hits, misses and LRU eviction of utils.MarkdownCache """
+
+    def runTest(self):
+        cache = utils.MarkdownCache(max_size=10)
+        key_a = cache.getKey("*a*", 'xhtml1')
+        self.assertNotEqual(key_a, cache.getKey("*a*", 'xhtml'))
+        self.assertIsNone(cache.get(key_a))
+        cache.put(key_a, "<p>aaa</p>")
+        self.assertEqual(cache.get(key_a), "<p>aaa</p>")
+        key_b = cache.getKey("*b*", 'xhtml1')
+        cache.put(key_b, "<p>b</p>") # above max_size, least recently used 'a' is dropped
+        self.assertIsNone(cache.get(key_a))
+        self.assertEqual(cache.get(key_b), "<p>b</p>")
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 2, 'entries': 1, 'size': 8})
+        print("[MarkdownCacheTestCase]-- Markdown cache OK --")
+
+
+class PostprocessHtmlTestCase(unittest.TestCase):
+    """ Check the rewrites of utils.postprocess_html() """
+
+    def runTest(self):
+        src = '<p>Voir <a class="lien_video" href="https://vimeo.com/122104210">la video</a> &amp; <img src="./media/schema.png"/></p>\n<pre><code>a  &lt; b</code></pre>'
+        self.assertEqual(utils.postprocess_html(src, video_class='lien_video', media_url='http://localhost/module1/media/'),
+            '<p>Voir <div class="video"><iframe src="https://player.vimeo.com/video/122104210" width="500" height="281" frameborder="0" webkitallowfullscreen="" mozallowfullscreen="" allowfullscreen=""></iframe></div>'
+            '<a class="lien_video" href="https://vimeo.com/122104210" target="_blank">la video</a> &amp; <img src="http://localhost/module1/media/schema.png"></p>\n<pre><code>a  &lt; b</code></pre>')
+        self.assertEqual(utils.postprocess_html('<p><a href="#">x</a><br /></p>', method='xml'), '<p><a href="#" target="_blank">x</a><br/></p>')
+        self.assertEqual(utils.postprocess_html('\n'), '\n')
+        print("[PostprocessHtmlTestCase]-- Html post-processing OK --")
+
+
+class VideoProvidersTestCase(unittest.TestCase):
+    """ Check the embed data given by the providers of videoProviders.py """
+
+    def runTest(self):
+        embed = videoProviders.getEmbed(" https://vimeo.com/122104376 ")
+        self.assertEqual((embed.provider, embed.src, embed.width), ('vimeo', 'https://player.vimeo.com/video/122104376', 500))
+        self.assertIs(videoProviders.getEmbed("https://vimeo.com/122104376"), embed)
+        embed = videoProviders.getEmbed("https://www.canal-u.tv/video/universite_de_tous_les_savoirs/pourquoi_il_fait_nuit.1207")
+        self.assertEqual(embed.src, 'https://www.canal-u.tv/video/universite_de_tous_les_savoirs/embed.1/pourquoi_il_fait_nuit.1207?width=100%&height=100%')
+        for url in ("https://www.youtube.com/watch?v=dQw4w9WgXcQ", "https://youtu.be/dQw4w9WgXcQ"):
+            self.assertEqual(videoProviders.getEmbed(url).src, 'https://www.youtube.com/embed/dQw4w9WgXcQ')
+        embed = videoProviders.getEmbed("https://framatube.org/videos/watch/9c9de5e8-0a1e-484a-b099-e80766180a6d")
+        self.assertEqual(embed.src, 'https://framatube.org/videos/embed/9c9de5e8-0a1e-484a-b099-e80766180a6d')
+        self.assertIsNone(videoProviders.getEmbed("https://example.com/video.mp4"))
+        print("[VideoProvidersTestCase]-- Video providers OK --")
+
+
+class StubOEmbedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ oEmbed API of a stub PeerTube server, answering for videos whose id does not start with 'missing' """
+    requested = []
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        video_id = query['url'][0].rsplit('/', 1)[1]
+        StubOEmbedHandler.requested.append(video_id)
+        if video_id.startswith('missing'):
+            self.send_error(404)
+            return
+        body = json.dumps({'title': 'Video '+video_id, 'thumbnail_url': 'http://thumbs/'+video_id+'.jpg', 'html': '<iframe></iframe>'})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class VideoMetadataResolverTestCase(unittest.TestCase):
+    """ Check videoProviders.VideoMetadataResolver against a local stub server, in online and offline mode """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubOEmbedHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        StubOEmbedHandler.requested = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def runTest(self):
+        base = 'http://127.0.0.1:%d/videos/watch/' % self.server.server_port
+        urls = [base+'video%d' % i for i in range(6)] + [base+'missing']
+        cache_path = os.path.join(self.cache_dir, 'videos.json')
+        resolver = videoProviders.VideoMetadataResolver(cache_path, max_workers=3)
+        metadata = resolver.resolveAll(urls + urls[:2])
+        self.assertEqual(sorted(StubOEmbedHandler.requested), sorted(['video%d' % i for i in range(6)] + ['missing']))
+        self.assertEqual(metadata[base+'video1']['thumbnail'], 'http://thumbs/video1.jpg')
+        self.assertIsNone(metadata[base+'missing'])
+        # fresh entries, even failures, are not requested again
+        videoProviders.VideoMetadataResolver(cache_path).resolveAll(urls)
+        self.assertEqual(len(StubOEmbedHandler.requested), 7)
+        # offline mode only gives cached metadata, outdated ones included
+        offline = videoProviders.VideoMetadataResolver(cache_path, offline=True, ttl=0)
+        metadata = offline.resolveAll(urls + [base+'video9'])
+        self.assertEqual(len(StubOEmbedHandler.requested), 7)
+        self.assertEqual(metadata[base+'video5']['title'], 'Video video5')
+        self.assertIsNone(metadata[base+'video9'])
+        # outdated entries are requested again online
+        videoProviders.VideoMetadataResolver(cache_path, ttl=0, error_ttl=3600).resolveAll(urls)
+        self.assertEqual(len(StubOEmbedHandler.requested), 13)
+        print("[VideoMetadataResolverTestCase]-- Video metadata OK --")
+
+
+class ParseCacheTestCase(unittest.TestCase):
+    """ Check that a module stored in parseCache.ParseCache is loaded back, and that old entries get evicted """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def runTest(self):
+        cache = parseCache.ParseCache(self.cache_dir)
+        key = cache.getKey("module_test.md", "tests", "http://culturenumerique.univ-lille3.fr")
+        self.assertNotEqual(key, cache.getKey("module_test.md", "tests", "http://localhost"))
+        self.assertIsNone(cache.load(key))
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            module_obj = model.Module(sample_file, "tests", "http://culturenumerique.univ-lille3.fr")
+        self.assertTrue(cache.store(key, module_obj))
+        cached = cache.load(key)
+        self.assertEqual(json.loads(cached.toJson()), json.loads(module_obj.toJson()))
+        # a cache too small for two entries only keeps the last one stored
+        cache.max_size = os.path.getsize(cache.getPath(key)) + 1
+        cache.store('other', module_obj)
+        self.assertIsNone(cache.load(key))
+        self.assertIsNotNone(cache.load('other'))
+        # questions processed once are cached with the module, a cache hit does not process them again
+        cache = parseCache.ParseCache(self.cache_dir)
+        self.assertTrue(cache.store(key, module_obj))
+        module_obj.loadQuestions()
+        self.assertTrue(cache.storeQuestions(key, module_obj))
+        process_questions = model.process_questions
+        def fail(*args):
+            self.fail("questions processed again")
+        model.process_questions = fail
+        try:
+            cached = cache.load(key)
+            cached.loadQuestions()
+        finally:
+            model.process_questions = process_questions
+        self.assertTrue(module_obj.getLoadedQuestions())
+        self.assertEqual(sorted(cached.getLoadedQuestions()), sorted(module_obj.getLoadedQuestions()))
+        for num, questions in module_obj.getLoadedQuestions().items():
+            self.assertEqual([q.id for q in cached.getLoadedQuestions()[num]], [q.id for q in questions])
+        # and they still make the bank of questions of the build
+        index = fromGIFT.QuestionsIndex()
+        cached.loadQuestions(index)
+        self.assertGreater(index.stats()['questions'], 0)
+        print("[ParseCacheTestCase]-- Cache OK --")
+
+
+class BuildStateTestCase(unittest.TestCase):
+    """ Check that only the subsections changed since the last build are rendered again by buildState.BuildState """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def build(self, edit=None, base_url=model.DEFAULT_BASE_URL):
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            module_obj = model.Module(sample_file, "tests", base_url)
+        if edit:
+            edit(module_obj)
+        state = buildState.BuildState(self.cache_dir, ".")
+        state.outputs = {}
+        for section in module_obj.sections:
+            for sub in section.subsections:
+                state.toHTML(sub, True)
+                if isinstance(sub, model.AnyActivity):
+                    state.outputs[sub.num] = (state.toGift(sub), state.toXMLMoodle(sub), state.toEdxProblems(sub, toEDX.toEdxProblemXml))
+        state.save()
+        return state, module_obj
+
+    def runTest(self):
+        first, first_module = self.build()
+        self.assertEqual(first.reused, 0)
+        # nothing changed: the quiz outputs come from the build state, no question is processed
+        unchanged, unchanged_module = self.build()
+        self.assertEqual(unchanged.rendered, 0)
+        self.assertTrue(first.outputs)
+        self.assertEqual(unchanged.outputs, first.outputs)
+        for sec in unchanged_module.sections:
+            for sub in sec.subsections:
+                self.assertFalse(hasattr(sub, '_questions'))
+        def edit(module_obj):
+            module_obj.sections[0].subsections[0].src += "typo fix\n"
+        second, second_module = self.build(edit)
+        self.assertEqual(second.rendered, 1)
+        self.assertEqual(second.reused, first.rendered - 1)
+        first_subs = [sub for sec in first_module.sections for sub in sec.subsections]
+        second_subs = [sub for sec in second_module.sections for sub in sec.subsections]
+        for first_sub, second_sub in zip(first_subs, second_subs)[1:]:
+            self.assertEqual(first_sub.html_src, second_sub.html_src)
+            self.assertEqual([q.id for q in getattr(first_sub, 'questions', [])], [q.id for q in getattr(second_sub, 'questions', [])])
+        # media links depend on the base url (-u option): everything is rendered again when it changes
+        def add_image(module_obj):
+            module_obj.sections[0].subsections[0].src += '<img src="media/a.png"/>\n'
+        third, third_module = self.build(add_image)
+        self.assertIn(model.DEFAULT_BASE_URL+u"/tests/media/a.png", third_module.sections[0].subsections[0].html_src)
+        fourth, fourth_module = self.build(add_image, "http://example.org")
+        self.assertEqual(fourth.reused, 0)
+        self.assertIn(u"http://example.org/tests/media/a.png", fourth_module.sections[0].subsections[0].html_src)
+        print("[BuildStateTestCase]-- Build state OK --")
+
+
+class ConcurrentParsingTestCase(unittest.TestCase):
+    """ Check that modules parsed at the same time in several threads get the same numbering as a module parsed alone """
+
+    def parse(self):
+        with open("module_test.md", encoding='utf-8') as sample_file:
+            return model.Module(sample_file, "tests").toJson()
+
+    def runTest(self):
+        expected = self.parse()
+        pool = ThreadPool(4)
+        results = pool.map(lambda i: self.parse(), range(8))
+        pool.close()
+        for result in results:
+            self.assertEqual(json.loads(result), json.loads(expected))
+        print("[ConcurrentParsingTestCase]-- Numbering OK --")
+
+
 class HtmlGenerationTestCase(ModuleParsingTestCase):
     """ Basic class for testing output generation in HTML """
     def setUp(self):